@@ -1,3 +1,12 @@
+import asyncio
+import csv
+import json
+import sys
+import time
+from collections import Counter
+from urllib.parse import quote
+
+import aiohttp
 import requests
 from requests.adapters import HTTPAdapter
 import socket
@@ -6,23 +15,34 @@ import click
 
 g_host = 'fe80::e3a6:46e4:bff9:fb8e'
 g_port = 8000
+g_interface = 'ens33'
+
+# Required fields of the bulk records of each kind
+BULK_FIELDS = {
+    'reserve': ('serial', 'type', 'id_token'),
+    'login': ('serial', 'password'),
+}
 
 
 # Custom HTTPAdapter to bind to the correct network interface
 class MyHTTPAdapter(HTTPAdapter):
     def init_poolmanager(self, *args, **kwargs):
-        kwargs['socket_options'] = [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, b'ens33')]  
+        if g_interface:
+            kwargs['socket_options'] = [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, g_interface.encode())]
         return super(MyHTTPAdapter, self).init_poolmanager(*args, **kwargs)
 
 
 @click.group()
 @click.option('--host', help='The host of the API server', default='fe80::e3a6:46e4:bff9:fb8e', type=str)
 @click.option('--port', help='The port of the API server', default=8000, type=int)
-def cli(host: str = 'fe80::e3a6:46e4:bff9:fb8e', port: int = 8000):
+@click.option('--interface', help='The network interface to bind to, empty for any', default='ens33', type=str)
+def cli(host: str = 'fe80::e3a6:46e4:bff9:fb8e', port: int = 8000, interface: str = 'ens33'):
     global g_host
     global g_port
+    global g_interface
     g_host = host
     g_port = port
+    g_interface = interface
 
 
 @cli.command('login')
@@ -125,5 +145,155 @@ def list_events(serial: str, token_type: str, token_id: str, host: str = 'fe80::
     except requests.exceptions.RequestException as e:
         click.echo(f"Error during the request: {e}")
 
+
+@cli.command('bulk')
+@click.argument('kind', type=click.Choice(list(BULK_FIELDS)))
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--concurrency', help='The most requests in flight', default=64, type=click.IntRange(min=1))
+@click.option('--batch', help='Reservations sent per /api/reserve_batch request, 1 sends them one by one', default=1, type=click.IntRange(min=1))
+@click.option('--timeout', help='Seconds a request may take', default=30.0, type=float)
+def _send_bulk_requests(kind: str, file: str, concurrency: int, batch: int, timeout: float):
+    # Records of a CSV file with a header line, or of a JSONL file (.jsonl,
+    # .ndjson) with one object per line: serial, type, id_token[, evse_id]
+    # [, expiry] to reserve, serial, password to login
+    if kind != 'reserve':
+        batch = 1
+    outcomes, latencies, requests_sent, elapsed = asyncio.run(
+        send_bulk_requests(kind, _read_records(file, kind), g_host, g_port, concurrency, batch, timeout)
+    )
+
+    records = sum(outcomes.values())
+    click.echo(f"Sent {records} records in {requests_sent} requests over {elapsed:.2f} s: "
+               f"{records / elapsed:.0f} records/s, {requests_sent / elapsed:.0f} requests/s")
+    if latencies:
+        click.echo(f"Latency p50 {_percentile(latencies, 50) * 1000:.1f} ms, p99 {_percentile(latencies, 99) * 1000:.1f} ms, "
+                   f"max {max(latencies) * 1000:.1f} ms")
+    for outcome, count in outcomes.most_common():
+        click.echo(f"{count:>9}  {outcome}")
+    if records != outcomes['OK']:
+        sys.exit(1)
+
+
+# Records of a bulk file, None for the lines that are not valid records
+def _read_records(path: str, kind: str):
+    with open(path, newline='') as file:
+        if path.endswith(('.jsonl', '.ndjson')):
+            lines = (line for line in file if line.strip())
+            rows = (_parse_json_record(line) for line in lines)
+        else:
+            rows = csv.DictReader(file)
+        for row in rows:
+            yield _get_record(row, kind)
+
+
+def _parse_json_record(line: str):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _get_record(row, kind: str) -> dict | None:
+    if not isinstance(row, dict):
+        return None
+    # Empty CSV columns are missing fields
+    record = {name: value for name, value in row.items() if value not in (None, '')}
+    if any(not isinstance(record.get(name), str) for name in BULK_FIELDS[kind]):
+        return None
+    if isinstance(record.get('evse_id'), str):
+        if not record['evse_id'].isdigit():
+            return None
+        record['evse_id'] = int(record['evse_id'])
+    return record
+
+
+# Lists of `size` valid records, the invalid ones are counted in `outcomes`
+def _get_chunks(records, size: int, outcomes: Counter):
+    chunk = []
+    for record in records:
+        if record is None:
+            outcomes['Invalid record'] += 1
+            continue
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _percentile(latencies: list, percentile: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+# Socket bound to the network interface, for the connection pool of the bulk mode
+def _bound_socket(addr_info) -> socket.socket:
+    family, kind, proto, _, _ = addr_info
+    sock = socket.socket(family, kind, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, g_interface.encode())
+    return sock
+
+
+# "OK", or the status and message of the answer
+async def _get_outcome(response: aiohttp.ClientResponse) -> tuple[str, object]:
+    try:
+        message = (await response.json(content_type=None)).get('message')
+    except (ValueError, AttributeError):
+        message = None
+    if response.status == 200:
+        return 'OK', message
+    return f'{response.status} {message if isinstance(message, str) else response.reason}', message
+
+
+async def _send_bulk_chunk(session: aiohttp.ClientSession, kind: str, chunk: list) -> Counter:
+    if kind == 'login':
+        record = chunk[0]
+        request = session.post('/api/login', params={'serial': record['serial'], 'password': record['password']})
+    elif len(chunk) == 1:
+        record = chunk[0]
+        params = {name: str(record[name]) for name in ('type', 'id_token', 'evse_id', 'expiry') if name in record}
+        request = session.post(f"/api/reserve_now/{quote(record['serial'], safe='')}", params=params)
+    else:
+        request = session.post('/api/reserve_batch', json=chunk)
+
+    async with request as response:
+        outcome, message = await _get_outcome(response)
+    if len(chunk) == 1 or outcome != 'OK':
+        return Counter({outcome: len(chunk)})
+    # Status of each reservation of the batch
+    return Counter('OK' if result['status'] == 'Accepted' else f"Rejected: {result.get('reason')}" for result in message['results'])
+
+
+# Send the records over one pool of keep-alive connections, with at most
+# `concurrency` requests in flight. Returns the count of each outcome, the
+# latency of every request, the number of requests and the elapsed time.
+async def send_bulk_requests(kind: str, records, host: str = 'fe80::e3a6:46e4:bff9:fb8e', port: int = 8000,
+                             concurrency: int = 64, batch: int = 1, timeout: float = 30) -> tuple[Counter, list, int, float]:
+    outcomes = Counter()
+    latencies = []
+    chunks = _get_chunks(records, batch, outcomes)
+
+    connector = aiohttp.TCPConnector(limit=concurrency, socket_factory=_bound_socket if g_interface else None)
+    base_url = f'http://[{host}]:{port}' if ':' in host else f'http://{host}:{port}'
+    async with aiohttp.ClientSession(base_url, connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+
+        # Each worker takes the next chunk once its request is answered
+        async def worker():
+            for chunk in chunks:
+                start = time.perf_counter()
+                try:
+                    outcomes.update(await _send_bulk_chunk(session, kind, chunk))
+                except (aiohttp.ClientError, TimeoutError) as e:
+                    outcomes[type(e).__name__] += len(chunk)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return outcomes, latencies, len(latencies), elapsed
+
+
 if __name__ == '__main__':
     cli()
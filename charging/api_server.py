@@ -1,94 +1,576 @@
+import argparse
+import asyncio
+import functools
+import hashlib
 import json
-from typing import Any
+import multiprocessing
+import re
+import socket
+import sys
+from collections.abc import Sequence
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+sys.path.append('.')
 
-from flask import Flask, jsonify, request
-from db import add_event, auth_user, add_user, check_user, chg_password, get_events
+import websockets
+import yaml
+from aiohttp import ETag, hdrs, web
+from websockets.exceptions import WebSocketException
+from charging.stream import STREAM_TYPES, EventStream
+from charging.db import add_event, add_events, auth_user, add_user, check_user, chg_password, get_events_page, get_events_version, get_reservations, get_reservation, provision_users, CREDENTIAL_GENERATORS
 
 
-app = Flask(__name__)
+# Operator channel of the CSMS, used for the live fleet state. By default
+# the one on the ip of the server config (--operator-uri to change it).
+OPERATOR_PORT = 9008
+# Every interface, IPv6 and IPv4 (--host to listen on one address only)
+HOST = '::'
+# Sites of the stations for the stream filter, when not run in the CSMS process
+CONFIG_FILE = 'charging/server_config.yaml'
+PORT = 8000
+# Seconds a request may take before a 504 (streams are not limited)
+REQUEST_TIMEOUT = 10
+# Seconds an idle keep-alive connection stays open
+KEEPALIVE_TIMEOUT = 75
+# Events read per page when streaming
+PAGE_SIZE = 1000
+# Most reservations accepted by one /api/reserve_batch request
+RESERVE_BATCH_SIZE = 10000
+# Seconds without events after which a stream sends a keep-alive
+STREAM_KEEPALIVE = 15
+# Answers from this size (bytes) on are compressed for the clients accepting it
+COMPRESS_MIN_SIZE = 1024
 
+# Answers operator commands ('fleet [dimension]', 'status <serial>'),
+# the operator channel unless the API runs in the CSMS process
+OPERATOR = web.AppKey('operator', Callable[[str], Awaitable[Any]])
+# Called once an event is committed, wakes the dispatcher of the CSMS process
+NOTIFY = web.AppKey('notify', Callable[[], None])
+# Whether an EVSE of a station has an active reservation, known in the CSMS process only
+CONFLICT = web.AppKey('conflict', Callable[[str, int], bool])
+TIMEOUT = web.AppKey('request_timeout', float)
+STREAM = web.AppKey('stream', EventStream)
 
-def _get_message(message: Any, code: int = 200):
-    return jsonify({'message': message, 'code': code}), code
+routes = web.RouteTableDef()
 
 
-@app.route('/api/reserve_now/<serial_number>', methods=['GET', 'PUT', 'POST'])
-def reserve_now(serial_number: str):
+def _get_message(message: Any, code: int = 200) -> web.Response:
+    return web.json_response({'message': message, 'code': code}, status=code)
+
+
+# Query parameter converted with `type`, `default` if missing or not convertible
+def _get_arg(request: web.Request, name: str, default=None, type=str):
+    value = request.query.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        return default
+
+
+def _streaming(handler):
+    handler.streaming = True
+    return handler
+
+
+# Every answer is {"message": ..., "code": ...}, including errors and timeouts
+@web.middleware
+async def _json_answers(request: web.Request, handler):
+    try:
+        if getattr(handler, 'streaming', False):
+            return await handler(request)
+        async with asyncio.timeout(request.app[TIMEOUT]):
+            return await handler(request)
+    except web.HTTPException as e:
+        return _get_message(e.reason, e.status)
+    except TimeoutError:
+        return _get_message('Request timeout', 504)
+    except AttributeError as e:
+        # Storage errors
+        return _get_message(f'Storage error: {e}', 500)
+
+
+# Conditional requests: the client sends the ETag of the answer it has in
+# If-None-Match and gets a 304 without body while the answer is the same
+def _is_cached(request: web.Request, etag: ETag) -> bool:
+    return request.if_none_match is not None and any(tag.value in (etag.value, '*') for tag in request.if_none_match)
+
+
+def _not_modified(etag: ETag) -> web.Response:
+    response = web.Response(status=304, headers={hdrs.VARY: 'Accept-Encoding'})
+    response.etag = etag
+    return response
+
+
+# Tag the answers to GET requests with a hash of their body and compress the
+# large ones. The event routes stream their answer, they tag it with the
+# version of the events (_stream_events) so an unchanged list is not read.
+@web.middleware
+async def _cached_answers(request: web.Request, handler):
+    response = await handler(request)
+    if request.method not in ('GET', 'HEAD') or not isinstance(response, web.Response) or response.status != 200 \
+            or not isinstance(response.body, bytes):
+        return response
+    etag = ETag(value=hashlib.blake2b(response.body, digest_size=16).hexdigest(), is_weak=True)
+    if _is_cached(request, etag):
+        return _not_modified(etag)
+    response.etag = etag
+    response.headers[hdrs.VARY] = 'Accept-Encoding'
+    if len(response.body) >= COMPRESS_MIN_SIZE:
+        response.enable_compression()
+    return response
+
+
+# Stream events as the message of the usual answer, one page in memory at a
+# time. next_after_id is the after_id of the next page, null at the end.
+# `version` is the get_events_version of the events read, taken before them.
+async def _stream_events(request: web.Request, after_id: int = 0, limit: int = None, version: str = None, **filters) -> web.StreamResponse:
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    if version is not None and request.method in ('GET', 'HEAD'):
+        etag = ETag(value=version, is_weak=True)
+        if _is_cached(request, etag):
+            return _not_modified(etag)
+        response.etag = etag
+        response.headers[hdrs.VARY] = 'Accept-Encoding'
+
+    # Sent with the first page, which tells if the answer is large
+    chunk = b'{"message": ['
+    count, last_id = 0, None
+    while limit is None or count < limit:
+        size = PAGE_SIZE if limit is None else min(PAGE_SIZE, limit - count)
+        page = await asyncio.to_thread(get_events_page, after_id, size, **filters)
+        if not page:
+            break
+        chunk += ((', ' if count else '') + ', '.join(json.dumps(event) for event in page)).encode()
+        if not response.prepared:
+            await _prepare_events(request, response, chunk)
+        await response.write(chunk)
+        chunk = b''
+        count, last_id = count + len(page), page[-1]['id']
+        after_id = last_id
+        if len(page) < size:
+            break
+    chunk += f'], "next_after_id": {json.dumps(last_id if limit is not None and count == limit else None)}, "code": 200}}'.encode()
+    if not response.prepared:
+        await _prepare_events(request, response, chunk)
+    await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def _prepare_events(request: web.Request, response: web.StreamResponse, first_chunk: bytes):
+    if len(first_chunk) >= COMPRESS_MIN_SIZE:
+        response.enable_compression()
+    await response.prepare(request)
+
+
+# ISO 8601 date to the format of the event timestamps (UTC)
+def _get_event_time(value: str) -> str:
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc)
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Operator channel of the CSMS configured in the server config
+def _load_operator_uri(path: str = CONFIG_FILE) -> str:
+    try:
+        with open(path, 'r') as file:
+            ip = (yaml.safe_load(file) or {}).get('ip')
+    except (OSError, yaml.YAMLError, AttributeError):
+        ip = None
+    # A server listening on every address is reached locally
+    if not isinstance(ip, str) or ip in ('', '0.0.0.0', '::'):
+        ip = 'localhost'
+    return f'ws://[{ip}]:{OPERATOR_PORT}' if ':' in ip else f'ws://{ip}:{OPERATOR_PORT}'
+
+
+# Send a command to the CSMS operator channel and parse its JSON answer
+async def _ask_operator(command: str, uri: str = None):
+    async with websockets.connect(uri or _load_operator_uri(), open_timeout=5) as websocket:
+        await websocket.send(command)
+        return json.loads(await asyncio.wait_for(websocket.recv(), 5))
+
+
+# Site of a serial number according to the sites of the server config
+def _load_site_of(path: str = CONFIG_FILE) -> Callable[[str], str]:
+    try:
+        with open(path, 'r') as file:
+            sites = [(re.compile(site['serial_number_regex']), site['name']) for site in (yaml.safe_load(file) or {}).get('sites') or []]
+    except (OSError, yaml.YAMLError, KeyError, TypeError, re.error):
+        sites = []
+
+    def site_of(serial_number: str) -> str:
+        for regex, name in sites:
+            if regex.match(serial_number):
+                return name
+        return 'default'
+    return site_of
+
+
+# Reservation event data, None if a parameter is not valid. The EVSE and
+# expiry date (ISO 8601) are optional, otherwise the server default applies.
+def _get_reservation(token_type, id_token, evse_id=None, expiry=None) -> dict | None:
+    if not isinstance(token_type, str) or not isinstance(id_token, str) or not token_type or not id_token:
+        return None
+    token = {'type': token_type, 'id_token': id_token}
+    if evse_id is not None:
+        if not isinstance(evse_id, int) or isinstance(evse_id, bool) or evse_id < 0:
+            return None
+        token['evse_id'] = evse_id
+    if expiry is not None:
+        try:
+            datetime.fromisoformat(expiry.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            return None
+        token['expiry'] = expiry
+    return token
+
+
+# Store an event and answer once it is committed
+async def _add_event(request: web.Request, event_type: str, target: str, data: dict):
+    await asyncio.wrap_future(add_event(event_type, target, data))
+    request.app[NOTIFY]()
+
+
+@routes.get('/api/reserve_now/{serial_number}')
+@routes.put('/api/reserve_now/{serial_number}')
+@routes.post('/api/reserve_now/{serial_number}')
+async def reserve_now(request: web.Request):
 
     # Get request parameters
-    token = {
-        'type': request.args.get('type', None, type=str),
-        'id_token': request.args.get('id_token', None, type=str),
-    }
+    token = _get_reservation(
+        _get_arg(request, 'type'), _get_arg(request, 'id_token'), _get_arg(request, 'evse_id', type=int), _get_arg(request, 'expiry')
+    )
 
     # Check token is set correctly
-    if token['type'] is None or token['id_token'] is None:
+    if token is None:
         return _get_message('Bad request', 400)
-    
-    # Add event to DB
-    add_event('reserve_now', serial_number, token)
+
+    await _add_event(request, 'reserve_now', request.match_info['serial_number'], token)
 
     return _get_message('OK')
 
-@app.route('/api/list/<serial_number>', methods=['GET', 'PUT', 'POST'])
-def list(serial_number: str):
+@routes.post('/api/reserve_batch')
+async def reserve_batch(request: web.Request):
+    # JSON list of {"serial", "type", "id_token"[, "evse_id"][, "expiry"]}
+    # reservations. The valid ones are stored in one transaction and handed
+    # to the dispatcher together, the answer has the status of each item in
+    # the order of the request. Items taking an EVSE already taken earlier
+    # in the batch (or by an active reservation, when served by the CSMS)
+    # are rejected with 'Conflict'. 'Accepted' means queued: the dispatcher
+    # may still store the reservation as 'Conflict' (see /api/reservations).
+    try:
+        items = await request.json()
+    except ValueError:
+        return _get_message('Bad request', 400)
+    if not isinstance(items, Sequence) or isinstance(items, str) or not items:
+        return _get_message('Bad request', 400)
+    if len(items) > RESERVE_BATCH_SIZE:
+        return _get_message(f'At most {RESERVE_BATCH_SIZE} reservations per request', 413)
+
+    results, events = [], []
+    # EVSEs taken by the batch per station, EVSE 0 takes the whole station
+    taken = {}
+    for item in items:
+        token = None
+        if isinstance(item, dict) and isinstance(item.get('serial'), str) and item['serial']:
+            token = _get_reservation(item.get('type'), item.get('id_token'), item.get('evse_id'), item.get('expiry'))
+        if token is None:
+            results.append({'serial': item.get('serial') if isinstance(item, dict) else None, 'status': 'Rejected', 'reason': 'Bad request'})
+            continue
+        evse_id, evses = token.get('evse_id', 0), taken.setdefault(item['serial'], set())
+        if evse_id in evses or 0 in evses or (evse_id == 0 and evses) or request.app[CONFLICT](item['serial'], evse_id):
+            results.append({'serial': item['serial'], 'status': 'Rejected', 'reason': 'Conflict'})
+            continue
+        evses.add(evse_id)
+        results.append({'serial': item['serial'], 'status': 'Accepted'})
+        events.append(('reserve_now', item['serial'], token))
+
+    # Answer once committed
+    if events:
+        await asyncio.wrap_future(add_events(events))
+        request.app[NOTIFY]()
+
+    return _get_message({'accepted': len(events), 'rejected': len(results) - len(events), 'results': results})
+
+@routes.get('/api/list/{serial_number}')
+@routes.put('/api/list/{serial_number}')
+@routes.post('/api/list/{serial_number}')
+@_streaming
+async def list(request: web.Request):
     # Get request parameters
     token = {
-        'type': request.args.get('type', None, type=str),
-        'id_token': request.args.get('id_token', None, type=str),
+        'type': _get_arg(request, 'type'),
+        'id_token': _get_arg(request, 'id_token'),
     }
 
     # Check token is set correctly
     if token['type'] is None or token['id_token'] is None:
         return _get_message('Bad request', 400)
-    
-    # Add event to DB
-    list = get_events(serial_number, token)
-    print('*********************************************************************************************')
-    print(list)
 
-    return _get_message(list)
+    # Events of the charger with this token, tagged with the version of its events
+    serial = request.match_info['serial_number']
+    version = await asyncio.to_thread(get_events_version, serial)
+    return await _stream_events(request, version=version, target=serial, data=token)
+
+@routes.get('/api/events')
+@_streaming
+async def events(request: web.Request):
+    # Events in id order, filtered by type, target and ISO 8601 time range.
+    # Page with limit and the next_after_id of the previous answer as after_id,
+    # without limit every matching event is streamed.
+    try:
+        since = _get_arg(request, 'since')
+        until = _get_arg(request, 'until')
+        filters = {
+            'event_type': _get_arg(request, 'type'),
+            'target': _get_arg(request, 'target'),
+            'since': _get_event_time(since) if since is not None else None,
+            'until': _get_event_time(until) if until is not None else None,
+        }
+    except ValueError:
+        return _get_message('Bad request', 400)
+    after_id = _get_arg(request, 'after_id', 0, type=int)
+    limit = _get_arg(request, 'limit', type=int)
+    if limit is not None and limit <= 0:
+        return _get_message('Bad request', 400)
+
+    version = await asyncio.to_thread(get_events_version, filters['target'])
+    return await _stream_events(request, after_id, limit, version, **filters)
+
+@routes.get('/api/stream')
+@_streaming
+async def stream(request: web.Request):
+    # Station events as they happen, as server-sent events or with
+    # format=jsonl as JSON lines. Filter with type (comma separated), station
+    # and site. after_id (or the Last-Event-ID header of a reconnecting
+    # EventSource) resumes after the last event received.
+    types = _get_arg(request, 'type')
+    types = tuple(types.split(',')) if types else None
+    if types is not None and not set(types) <= set(STREAM_TYPES):
+        return _get_message(f'type must be among {", ".join(STREAM_TYPES)}', 400)
+    sse = _get_arg(request, 'format', 'sse') == 'sse'
+    if not sse and _get_arg(request, 'format') != 'jsonl':
+        return _get_message('format must be sse or jsonl', 400)
+    after_id = _get_arg(request, 'after_id', type=int)
+    if after_id is None and request.headers.get('Last-Event-ID', '').isdigit():
+        after_id = int(request.headers['Last-Event-ID'])
+
+    subscription = request.app[STREAM].subscribe(types, _get_arg(request, 'station'), _get_arg(request, 'site'), after_id)
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream' if sse else 'application/x-ndjson',
+        'Cache-Control': 'no-cache',
+    })
+    try:
+        await response.prepare(request)
+        while True:
+            events = await subscription.get(STREAM_KEEPALIVE)
+            if events is None:
+                await response.write(b': keep-alive\n\n' if sse else b'\n')
+            elif sse:
+                await response.write(''.join(f"id: {event.id}\nevent: {event.type}\ndata: {event.json}\n\n" for event in events).encode())
+            else:
+                await response.write(''.join(event.json + '\n' for event in events).encode())
+    except ConnectionResetError:
+        # Client gone
+        pass
+    finally:
+        subscription.close()
+    return response
+
+@routes.get('/api/reservations/{serial_number}')
+async def reservations(request: web.Request):
+    # Get reservations of the charger, optionally filtered by token and status
+    data = await asyncio.to_thread(
+        get_reservations,
+        station=request.match_info['serial_number'],
+        id_token=_get_arg(request, 'id_token'),
+        status=_get_arg(request, 'status'),
+        limit=_get_arg(request, 'limit', 100, type=int)
+    )
+
+    return _get_message(data)
+
+@routes.get(r'/api/cancel_reservation/{reservation_id:\d+}')
+@routes.put(r'/api/cancel_reservation/{reservation_id:\d+}')
+@routes.post(r'/api/cancel_reservation/{reservation_id:\d+}')
+async def cancel_reservation(request: web.Request):
+    reservation_id = int(request.match_info['reservation_id'])
+    reservation = await asyncio.to_thread(get_reservation, reservation_id)
+    if reservation is None:
+        return _get_message('Reservation not found', 404)
+
+    if reservation['status'] not in ('Pending', 'Accepted'):
+        return _get_message(f"Reservation is {reservation['status']}", 409)
+
+    # The server sends CancelReservation to the charger
+    await _add_event(request, 'cancel_reservation', reservation['station'], {'id': reservation_id})
+
+    return _get_message('OK')
+
+@routes.get('/api/fleet')
+@routes.get('/api/fleet/{dimension}')
+async def fleet(request: web.Request):
+    dimension = request.match_info.get('dimension')
+    if dimension is not None and dimension not in ('site', 'model', 'version'):
+        return _get_message('Bad request', 400)
+    try:
+        return _get_message(await request.app[OPERATOR]('fleet' if dimension is None else f'fleet {dimension}'))
+    except (OSError, TimeoutError, WebSocketException) as e:
+        return _get_message(f'CSMS not reachable: {e}', 503)
+
+@routes.get('/api/status/{serial_number}')
+async def status(request: web.Request):
+    try:
+        data = await request.app[OPERATOR](f"status {request.match_info['serial_number']}")
+    except (OSError, TimeoutError, WebSocketException) as e:
+        return _get_message(f'CSMS not reachable: {e}', 503)
+    if data is None:
+        return _get_message('Charger not found', 404)
+    return _get_message(data)
 
-@app.route('/api/login', methods=['GET', 'PUT', 'POST'])
-def login():
+@routes.get('/api/login')
+@routes.put('/api/login')
+@routes.post('/api/login')
+async def login(request: web.Request):
     # Get request parameters
     token = {
-        'serial': request.args.get('serial', None, type=str),
-        'password': request.args.get('password', None, type=str),
+        'serial': _get_arg(request, 'serial'),
+        'password': _get_arg(request, 'password'),
     }
-    
+
     # Check token is set correctly
     if token['serial'] is None or token['password'] == '':
         return _get_message('Bad request', 400)
-    
-    if check_user(token['serial']) != None:
+
+    if await asyncio.to_thread(check_user, token['serial']) != None:
         return _get_message('User already exists', 403)
 
     # Add user to DB
-    add_user(token['serial'], token['password'])
+    await asyncio.wrap_future(add_user(token['serial'], token['password']))
 
     return _get_message('OK')
 
-@app.route('/api/change_password', methods=['GET', 'PUT', 'POST'])
-def change_password():
+@routes.get('/api/change_password')
+@routes.put('/api/change_password')
+@routes.post('/api/change_password')
+async def change_password(request: web.Request):
     # Get request parameters
     token = {
-        'serial': request.args.get('serial', None, type=str),
-        'old_password': request.args.get('old_password', None, type=str),
-        'new_password': request.args.get('new_password', None, type=str),
+        'serial': _get_arg(request, 'serial'),
+        'old_password': _get_arg(request, 'old_password'),
+        'new_password': _get_arg(request, 'new_password'),
     }
-    
+
     # Check token is set correctly
     if token['serial'] is None or token['old_password'] == '' or token['new_password'] == '':
         return _get_message('Bad request', 400)
-    
-    if not auth_user(token['serial'], token['old_password']):
+
+    if not await asyncio.to_thread(auth_user, token['serial'], token['old_password']):
         return _get_message('Wrong password', 404)
 
     # Add user to DB
-    chg_password(token['serial'], token['new_password'])
+    await asyncio.wrap_future(chg_password(token['serial'], token['new_password']))
 
     return _get_message('OK')
 
+@routes.post('/api/provision')
+async def provision(request: web.Request):
+    # JSON list of {"serial": ..., "password": ...} or {"serial": ..., "generate": "key"|"password"}
+    # records, stored in one transaction. Running it again keeps the
+    # generated credentials.
+    try:
+        records = await request.json()
+    except ValueError:
+        return _get_message('Bad request', 400)
+    if not isinstance(records, Sequence) or not records:
+        return _get_message('Bad request', 400)
+
+    rows = []
+    for record in records:
+        if not isinstance(record, dict) or not isinstance(record.get('serial'), str) or not record['serial']:
+            return _get_message('Bad request', 400)
+        password, generate = record.get('password'), record.get('generate')
+        if (password is not None and not isinstance(password, str)) or (generate is not None and generate not in CREDENTIAL_GENERATORS):
+            return _get_message('Bad request', 400)
+        rows.append((record['serial'], password, generate))
+
+    # Answer once committed, with the credential of every station
+    return _get_message(await asyncio.wrap_future(provision_users(rows)))
+
+
+# Run the event stream reader while the app is up
+async def _run_stream(app: web.Application):
+    task = asyncio.create_task(app[STREAM].run())
+    yield
+    task.cancel()
+
+
+def create_app(operator: Callable[[str], Awaitable[Any]] = _ask_operator, notify: Callable[[], None] = lambda: None,
+               request_timeout: float = REQUEST_TIMEOUT, stream: EventStream = None,
+               conflict: Callable[[str, int], bool] = lambda station, evse_id: False) -> web.Application:
+    app = web.Application(middlewares=[_cached_answers, _json_answers])
+    app[OPERATOR] = operator
+    app[NOTIFY] = notify
+    app[CONFLICT] = conflict
+    app[TIMEOUT] = request_timeout
+    app[STREAM] = stream if stream is not None else EventStream(_load_site_of())
+    app.cleanup_ctx.append(_run_stream)
+    app.add_routes(routes)
+    return app
+
+
+# Serve the API in the running event loop (the CSMS one), stop it with runner.cleanup()
+async def serve(host: str, port: int, keepalive_timeout: float = KEEPALIVE_TIMEOUT, **kwargs) -> web.AppRunner:
+    runner = web.AppRunner(create_app(**kwargs), keepalive_timeout=keepalive_timeout, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, backlog=1024).start()
+    return runner
+
+
+def _run_worker(sock: socket.socket, request_timeout: float, keepalive_timeout: float, operator_uri: str):
+    app = create_app(operator=functools.partial(_ask_operator, uri=operator_uri), request_timeout=request_timeout)
+    web.run_app(app, sock=sock, keepalive_timeout=keepalive_timeout, access_log=None, print=None)
+
+
+# Standalone server: the workers share one listening socket, each has its own
+# event loop and database connections
+def main():
+    parser = argparse.ArgumentParser(description="EmuOCPP API server")
+    parser.add_argument('--host', type=str, default=HOST, help="Address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes")
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help="Request timeout in seconds")
+    parser.add_argument('--keepalive', type=float, default=KEEPALIVE_TIMEOUT, help="Keep-alive timeout in seconds")
+    parser.add_argument('--operator-uri', type=str, default=None, help="Operator channel of the CSMS (fleet and status), "
+                        f"ws://<ip of {CONFIG_FILE}>:{OPERATOR_PORT} by default")
+    args = parser.parse_args()
+    operator_uri = args.operator_uri or _load_operator_uri()
+
+    family, kind, proto, _, address = socket.getaddrinfo(args.host, args.port, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, kind, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if family == socket.AF_INET6:
+        # '::' also accepts IPv4 clients
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    sock.bind(address)
+    sock.listen(1024)
+    print(f"API server on {args.host} port {args.port} with {args.workers} workers, CSMS operator channel {operator_uri}")
+
+    if args.workers <= 1:
+        return _run_worker(sock, args.timeout, args.keepalive, operator_uri)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_run_worker, args=(sock, args.timeout, args.keepalive, operator_uri)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
 if __name__ == '__main__':
-    app.run(host='fe80::e3a6:46e4:bff9:fb8e%ens33', port=8000)
+    main()
@@ -0,0 +1,113 @@
+import sys
+sys.path.append('.')
+
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+from charging import db
+
+# Checks that consuming the event queue costs the same whatever the size of
+# the acked history. The Events table of a scratch database is filled with
+# acked events up to each checkpoint, then a backlog of pending events is
+# dequeued and acked the way the server dispatcher does, and stations poll
+# their events with get_event.
+#
+#   python3 charging/benchmarks/event_queue_benchmark.py -events 10000000
+
+parser = argparse.ArgumentParser(description="Benchmark the event queue dequeue time against the number of stored events")
+parser.add_argument('-db', type=str, required=False, default='/tmp/emuocpp_event_queue_benchmark.sqlite3', help="Scratch database file, deleted first")
+parser.add_argument('-events', type=int, required=False, default=10_000_000, help="Acked events stored at the last checkpoint")
+parser.add_argument('-stations', type=int, required=False, default=10_000, help="Stations the events are spread over")
+parser.add_argument('-pending', type=int, required=False, default=2000, help="Pending events dequeued at each checkpoint")
+parser.add_argument('-batch', type=int, required=False, default=100, help="Events read per dequeue")
+parser.add_argument('-polls', type=int, required=False, default=2000, help="get_event calls at each checkpoint")
+
+TYPES = ('reserve_now', 'cancel_reservation')
+
+
+def _percentile(latencies: list, percentile: float) -> float:
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+# Bulk load of events, not measured. The acked history is mostly status
+# notifications, pending events are reservations.
+def _fill(conn: sqlite3.Connection, count: int, stations: int, status: str):
+    def rows():
+        for _ in range(count):
+            station = f'E2507-{random.randrange(stations):04}-0000'
+            if status == 'acked' and random.random() < 0.9:
+                yield 'status_notification', station, '{"evse_id": 1, "connector_id": 1, "status": "Available"}', status
+            else:
+                yield 'reserve_now', station, '{"type": "ISO14443", "id_token": "11223344"}', status
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO Events (type, target, data, status, acked_at) VALUES (?, ?, ?, ?, CASE WHEN ? = 'acked' THEN current_timestamp END);",
+            ((*row, row[3]) for row in rows()),
+        )
+
+
+def _dequeue(pending: int, batch: int) -> list:
+    latencies = []
+    last_event_id = 0
+    consumed = 0
+    while consumed < pending:
+        start = time.perf_counter()
+        events = db.get_pending_events(TYPES, last_event_id, batch)
+        db.ack_events([event[0] for event in events])
+        latencies.append(time.perf_counter() - start)
+        if not events:
+            break
+        last_event_id = events[-1][0]
+        consumed += len(events)
+    db.flush_writes()
+    return latencies
+
+
+def _poll(polls: int, stations: int) -> list:
+    latencies = []
+    for _ in range(polls):
+        station = f'E2507-{random.randrange(stations):04}-0000'
+        start = time.perf_counter()
+        db.get_event('reserve_now', station)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    args = parser.parse_args()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    db.use_database(args.db)
+    loader = sqlite3.connect(args.db)
+    loader.execute("PRAGMA synchronous=OFF;")
+
+    checkpoints = [10 ** exponent for exponent in range(4, 12) if 10 ** exponent < args.events] + [args.events]
+    stored = 0
+    print(f"{'events':>11} {'fill s':>7} {'dequeue p50 us':>15} {'dequeue p99 us':>15} {'events/s':>9} {'get_event p50 us':>17} {'get_event p99 us':>17}")
+    for checkpoint in checkpoints:
+        start = time.perf_counter()
+        _fill(loader, checkpoint - stored, args.stations, 'acked')
+        _fill(loader, args.pending, args.stations, 'pending')
+        stored = checkpoint
+        # Keep the checkpoint of the loaded rows out of the measure
+        loader.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        fill_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dequeue = _dequeue(args.pending, args.batch)
+        elapsed = time.perf_counter() - start
+        poll = _poll(args.polls, args.stations)
+        print(f"{checkpoint:>11} {fill_time:>7.1f} {_percentile(dequeue, 50) * 1e6:>15.0f} {_percentile(dequeue, 99) * 1e6:>15.0f} "
+              f"{args.pending / elapsed:>9.0f} {_percentile(poll, 50) * 1e6:>17.0f} {_percentile(poll, 99) * 1e6:>17.0f}")
+
+
+if __name__ == '__main__':
+    main()
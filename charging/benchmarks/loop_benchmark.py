@@ -0,0 +1,172 @@
+import sys
+sys.path.append('.')
+
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import time
+import uuid
+
+import websockets
+
+from charging.loop import LOOPS, use_event_loop
+
+# Compares the event loops on the floods of the basic_dos scenario (stations
+# connecting and booting at once) and of the internal_dos scenario (one
+# station flooding Authorize requests). The client side runs on every loop
+# given with -loops; start the server with -loop asyncio / -loop uvloop to
+# compare its side.
+#
+#   python3 charging/benchmarks/loop_benchmark.py -server 127.0.0.1 -port 9004 -loops asyncio uvloop
+
+parser = argparse.ArgumentParser(description="Benchmark the event loops on the connection and Authorize floods")
+parser.add_argument('-server', type=str, required=False, default='::1', help="Server address (e.g., ::1)")
+parser.add_argument('-port', type=int, required=False, default=9004, help="Port of the server without security profile (e.g., 9004)")
+parser.add_argument('-loops', type=str, required=False, nargs='+', choices=LOOPS, default=list(LOOPS), help="Event loops to compare")
+parser.add_argument('-connections', type=int, required=False, default=1000, help="Stations connecting in the connection flood")
+parser.add_argument('-concurrency', type=int, required=False, default=100, help="Stations connecting at the same time")
+parser.add_argument('-requests', type=int, required=False, default=10_000, help="Authorize requests of the Authorize flood")
+parser.add_argument('-window', type=int, required=False, default=100, help="Authorize requests waiting for an answer at the same time")
+parser.add_argument('-timeout', type=float, required=False, default=10, help="Seconds to wait for an answer before counting a timeout")
+
+
+def _get_random_serial_number() -> str:
+    return f'E2507-{random.randint(0, 9999):04}-{random.randint(0, 9999):04}'
+
+
+def _percentile(latencies: list, percentile: float) -> float:
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+# Raises TimeoutError if the answer takes more than `timeout` seconds
+async def _call(websocket, action: str, payload: dict, timeout: float) -> list:
+    message_id = str(uuid.uuid4())
+    await websocket.send(json.dumps([2, message_id, action, payload]))
+    async with asyncio.timeout(timeout):
+        while True:
+            message = json.loads(await websocket.recv())
+            # Skip calls of the server, they are not part of the flood
+            if message[0] != 2 and message[1] == message_id:
+                return message
+
+
+async def _boot(websocket, serial_number: str, timeout: float):
+    await _call(websocket, 'BootNotification', {
+        'chargingStation': {'model': 'E2507', 'vendorName': 'EmuOCPPCharge', 'serialNumber': serial_number},
+        'reason': 'PowerUp'
+    }, timeout)
+
+
+# basic_dos: every station connects and sends a BootNotification, the
+# connections stay open until the flood is over
+async def connection_flood(uri: str, connections: int, concurrency: int, timeout: float) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    websockets_open = []
+    errors = timeouts = 0
+
+    async def connect():
+        nonlocal errors, timeouts
+        async with semaphore:
+            serial_number = _get_random_serial_number()
+            start = time.perf_counter()
+            try:
+                websocket = await websockets.connect(f'{uri}/{serial_number}', subprotocols=['ocpp2.0.1'], open_timeout=timeout)
+                websockets_open.append(websocket)
+                await _boot(websocket, serial_number, timeout)
+            except TimeoutError:
+                timeouts += 1
+                return
+            except (OSError, websockets.exceptions.WebSocketException):
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(websocket.close() for websocket in websockets_open), return_exceptions=True)
+    return latencies, elapsed, errors, timeouts
+
+
+# internal_dos: one station sends Authorize requests with random tokens,
+# keeping up to `window` of them waiting for an answer. Requests without an
+# answer after `timeout` seconds count as timeouts, the ones not answered
+# because the server closed the connection as errors.
+async def authorize_flood(uri: str, requests: int, window: int, timeout: float) -> tuple:
+    serial_number = _get_random_serial_number()
+    latencies = []
+    sent = {}
+    semaphore = asyncio.Semaphore(window)
+    timeouts = 0
+
+    async with websockets.connect(f'{uri}/{serial_number}', subprotocols=['ocpp2.0.1'], open_timeout=timeout) as websocket:
+        await _boot(websocket, serial_number, timeout)
+
+        async def receive():
+            nonlocal timeouts
+            while len(latencies) + timeouts < requests:
+                try:
+                    message = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+                except TimeoutError:
+                    # Nothing answered for `timeout` seconds, give up the waiting requests
+                    timeouts += len(sent)
+                    for _ in range(len(sent)):
+                        semaphore.release()
+                    sent.clear()
+                    continue
+                except websockets.exceptions.ConnectionClosed:
+                    # Wake the sender up, it stops at the closed connection
+                    for _ in range(window):
+                        semaphore.release()
+                    return
+                start = sent.pop(message[1], None)
+                if message[0] != 2 and start is not None:
+                    latencies.append(time.perf_counter() - start)
+                    semaphore.release()
+
+        receiver = asyncio.create_task(receive())
+        start = time.perf_counter()
+        try:
+            for _ in range(requests):
+                await semaphore.acquire()
+                if receiver.done():
+                    break
+                message_id = str(uuid.uuid4())
+                sent[message_id] = time.perf_counter()
+                await websocket.send(json.dumps([2, message_id, 'Authorize', {'idToken': {'idToken': secrets.token_hex(8), 'type': 'ISO15693'}}]))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        await receiver
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed, requests - len(latencies) - timeouts, timeouts
+
+
+async def run(args) -> list:
+    host = f'[{args.server}]' if ':' in args.server else args.server
+    uri = f'ws://{host}:{args.port}'
+    return [
+        ('connections', *await connection_flood(uri, args.connections, args.concurrency, args.timeout)),
+        ('authorize', *await authorize_flood(uri, args.requests, args.window, args.timeout)),
+    ]
+
+
+def main():
+    args = parser.parse_args()
+    print(f"{'loop':<8} {'flood':<12} {'ops':>7} {'errors':>6} {'timeouts':>8} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for name in args.loops:
+        loop = use_event_loop(name)
+        if loop != name:
+            continue
+        for flood, latencies, elapsed, errors, timeouts in asyncio.run(run(args)):
+            print(f"{loop:<8} {flood:<12} {len(latencies):>7} {errors:>6} {timeouts:>8} {len(latencies) / elapsed:>9.0f} "
+                  f"{_percentile(latencies, 50) * 1000:>8.2f} {_percentile(latencies, 99) * 1000:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
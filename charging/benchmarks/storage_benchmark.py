@@ -0,0 +1,108 @@
+import sys
+sys.path.append('.')
+
+import argparse
+import os
+import random
+import time
+
+from charging import db
+from charging.sqlite_storage import SQLiteStorage
+from charging.storage import MemoryStorage
+
+# Runs the same workloads against every storage backend through the
+# charging.db functions the server uses:
+#  auth: handshake of a station (auth_user, then check_user)
+#  insert: bulk add_events and add_users, until the writes are durable
+#  dequeue: dispatcher reading and acking a backlog of pending events
+#
+#   python3 charging/benchmarks/storage_benchmark.py -users 100000 -events 1000000
+
+parser = argparse.ArgumentParser(description="Benchmark the storage backends on the same workloads")
+parser.add_argument('-db', type=str, required=False, default='/tmp/emuocpp_storage_benchmark.sqlite3', help="Scratch database file of the sqlite backend, deleted first")
+parser.add_argument('-storages', type=str, nargs='+', required=False, default=['sqlite', 'memory'], help="Backends to compare")
+parser.add_argument('-users', type=int, required=False, default=100_000, help="Stations stored")
+parser.add_argument('-events', type=int, required=False, default=1_000_000, help="Events inserted, then dequeued")
+parser.add_argument('-auths', type=int, required=False, default=20_000, help="Handshakes")
+parser.add_argument('-chunk', type=int, required=False, default=10_000, help="Rows per bulk insert")
+parser.add_argument('-batch', type=int, required=False, default=100, help="Events read per dequeue")
+
+TYPES = ('reserve_now', 'cancel_reservation')
+
+
+def _percentile(latencies: list, percentile: float) -> float:
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+def _station(i: int) -> str:
+    return f'E2507-{i // 10000:04}-{i % 10000:04}'
+
+
+def _insert(users: int, events: int, chunk: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    for i in range(0, users, chunk):
+        db.add_users([(_station(j), f'password-{j}') for j in range(i, min(users, i + chunk))])
+    db.flush_writes()
+    user_rate = users / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, events, chunk):
+        db.add_events([
+            (TYPES[j % 2], _station(random.randrange(users)), {'type': 'ISO14443', 'id_token': '11223344'})
+            for j in range(i, min(events, i + chunk))
+        ])
+    db.flush_writes()
+    return user_rate, events / (time.perf_counter() - start)
+
+
+def _auth(auths: int, users: int) -> list:
+    latencies = []
+    for _ in range(auths):
+        i = random.randrange(users)
+        start = time.perf_counter()
+        db.auth_user(_station(i), f'password-{i}')
+        db.check_user(_station(i))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _dequeue(events: int, batch: int) -> tuple[list, float]:
+    latencies = []
+    last_event_id = 0
+    start = time.perf_counter()
+    while True:
+        begin = time.perf_counter()
+        page = db.get_pending_events(TYPES, last_event_id, batch)
+        db.ack_events([event[0] for event in page])
+        latencies.append(time.perf_counter() - begin)
+        if not page:
+            break
+        last_event_id = page[-1][0]
+    db.flush_writes()
+    return latencies, events / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    backends = {'sqlite': lambda: SQLiteStorage(args.db), 'memory': MemoryStorage}
+
+    print(f"{'storage':>8} {'users/s':>9} {'events/s':>9} {'auth p50 us':>12} {'auth p99 us':>12} "
+          f"{'dequeue p50 us':>15} {'dequeue p99 us':>15} {'dequeued/s':>11}")
+    for name in args.storages:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+        db.use_storage(backends[name]())
+
+        user_rate, event_rate = _insert(args.users, args.events, args.chunk)
+        auth = _auth(args.auths, args.users)
+        dequeue, dequeue_rate = _dequeue(args.events, args.batch)
+        print(f"{name:>8} {user_rate:>9.0f} {event_rate:>9.0f} {_percentile(auth, 50) * 1e6:>12.1f} {_percentile(auth, 99) * 1e6:>12.1f} "
+              f"{_percentile(dequeue, 50) * 1e6:>15.0f} {_percentile(dequeue, 99) * 1e6:>15.0f} {dequeue_rate:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
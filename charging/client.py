@@ -34,6 +34,10 @@ import argparse
 from dns.resolver import resolve, NoAnswer
 from dns import rdatatype
 
+sys.path.append('.')
+from charging.loop import LOOPS, use_event_loop
+from charging import tracing
+
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -70,6 +74,7 @@ parser.add_argument('-vendor_name', type=str, required=False, help="Vendor name
 parser.add_argument('-model', type=str, required=False, help="Model (e.g., E2507)")
 parser.add_argument('-serial_number', type=str, required=False, help="Serial number (e.g., E2507-8420-1274)") 
 parser.add_argument('-url', type=str, required=False, help="URL attached to the servers if there is a DNS server (e.g ocpp-simulator.com)") 
+parser.add_argument('-loop', type=str, required=False, choices=LOOPS, help="Event loop -> 'asyncio' or 'uvloop'")
 
 
 # Parse the arguments
@@ -88,6 +93,9 @@ COMM_CTRL = None
 CONNECTION_PROFILES = None
 CONFIGURATION = None
 RECONNECT_TIMES = 0
+EVENT_LOOP = 'asyncio'
+# Share of the OCPP messages traced to charging/traces (0 disables tracing)
+TRACE_SAMPLE_RATE = 0
 
 def _get_current_time() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -149,6 +157,8 @@ def load_config() -> bool:
     global CONNECTION_PROFILES 
     global CONFIGURATION
     global RECONNECT_TIMES
+    global EVENT_LOOP
+    global TRACE_SAMPLE_RATE
 
     # Open server config file
     with open(CONFIG_FILE, "r") as file:
@@ -192,6 +202,12 @@ def load_config() -> bool:
             if 'attempts' in content and content['attempts'] != None:
                 RECONNECT_TIMES = content['attempts']
 
+            if "event_loop" in content:
+                EVENT_LOOP = content["event_loop"]
+
+            if "trace_sample_rate" in content:
+                TRACE_SAMPLE_RATE = content["trace_sample_rate"]
+
             # Set accepted tokens
             if "security" in content:
                 if "SecurityProfile" in content["security"]:
@@ -346,10 +362,24 @@ def configuration():
         config['security']['Identity'] = args.serial_number
     if args.url != None:
         config['url'] = args.url
+    if args.loop != None:
+        config['event_loop'] = args.loop
     
     with open(CONFIG_FILE, 'w') as file:
         yaml.safe_dump(config, file, default_flow_style=False)
 
+# Name the trace file of a client process and set the sampling rate of the
+# client config. The scenarios run launch_client without loading the config,
+# they call it with their name.
+def configure_tracing(name: str = 'client'):
+    sample_rate = TRACE_SAMPLE_RATE
+    try:
+        with open(CONFIG_FILE, 'r') as file:
+            sample_rate = (yaml.safe_load(file) or {}).get('trace_sample_rate', sample_rate)
+    except (OSError, yaml.YAMLError):
+        pass
+    tracing.configure(name, sample_rate)
+
 def main():
 
     configuration()
@@ -358,6 +388,9 @@ def main():
     if not load_config():
         quit(1)
 
+    use_event_loop(EVENT_LOOP)
+    configure_tracing('client')
+
     if VERSION == 'v1.6':
         tries = RECONNECT_TIMES
         while True:
@@ -431,6 +464,12 @@ class ChargePointClientBase:
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    # Calls to the CSMS, traced with their message id
+    async def call(self, payload, suppress=True, unique_id=None):
+        unique_id = unique_id if unique_id is not None else str(self._unique_id_generator())
+        with tracing.span(payload.__class__.__name__[:-7], 'call', message_id=unique_id, station=self.id):
+            return await super().call(payload, suppress, unique_id)
+
     def print_message(self, message: str):
         print(f'[{self.id}] {message}')
 
@@ -471,7 +510,8 @@ class ChargePointClientBase:
         while True:
             # Send heartbeat
             await self.call(request)
-            # Wait for interval
+            # Wait for interval, the CSMS may have changed it since the boot
+            interval = (CONFIGURATION if VERSION == 'OCPP16' else COMM_CTRL).get('HeartbeatInterval', interval)
             await asyncio.sleep(interval)
 
     async def send_authorize(
@@ -642,6 +682,7 @@ class ChargePointClientBase:
                 COMM_CTRL['HeartbeatInterval'] = response.interval
             else:
                 CONFIGURATION['SecurityProfile'] = SECURITY_PROFILE
+                CONFIGURATION['HeartbeatInterval'] = response.interval
 
             print(f"Connected successfully with security profile {CONFIGURATION['SecurityProfile'] if VERSION == 'OCPP16' else CONNECTION_PROFILES[index].security_profile}.")
 
@@ -905,6 +946,13 @@ class ChargePointClientBase:
                 files = [file for file in entries if os.path.isfile(os.path.join(f'./charging/installedCertificates/{SERIAL_NUMBER}/root', file))]
             if original_value < CONFIGURATION['SecurityProfile'] or (original_value == 3 and (CERTIFICATE_KEY_PATH == None or CERTIFICATE_PATH == None)) or (original_value==2 and len(files)<1):
                 return call_result16.ChangeConfigurationPayload(status= 'Rejected')
+        elif key == 'HeartbeatInterval':
+            # Taken into account by the running heartbeat loop, no reboot needed
+            if not isinstance(original_value, int) or original_value <= 0:
+                return call_result16.ChangeConfigurationPayload(status='Rejected')
+            CONFIGURATION[key] = original_value
+            modify_config(variable=key, value=original_value)
+            return call_result16.ChangeConfigurationPayload(status='Accepted')
 
         CONFIGURATION[key] = original_value
         modify_config(variable=key, value=original_value, component='SecurityCtrlr')
@@ -974,21 +1022,34 @@ class ChargePointClientBase:
                 status='Accepted'
             )
 
+    @on('CancelReservation')
+    def on_cancel_reservation(
+        self,
+        reservation_id: int
+    ):
+        self.print_message(f'Reservation {reservation_id} cancelled')
+        if VERSION == 'OCPP201':
+            return call_result201.CancelReservationPayload(status='Accepted')
+        elif VERSION == 'OCPP20':
+            return call_result20.CancelReservationPayload(status='Accepted')
+        elif VERSION == 'OCPP16':
+            return call_result16.CancelReservationPayload(status='Accepted')
+
 
 # Factory function to create the correct subclass
 def ChargePointClientFactory(version):
     if version == "v2.0.1":
-        class ChargePointClient(Cp201, ChargePointClientBase):
+        class ChargePointClient(ChargePointClientBase, Cp201):
             pass
         return ChargePointClient
 
     elif version == "v2.0":
-        class ChargePointClient(Cp20, ChargePointClientBase):
+        class ChargePointClient(ChargePointClientBase, Cp20):
             pass
         return ChargePointClient
     
     elif version == "v1.6":
-        class ChargePointClient(Cp16, ChargePointClientBase):
+        class ChargePointClient(ChargePointClientBase, Cp16):
             pass
         return ChargePointClient
 
@@ -1094,12 +1155,16 @@ async def launch_client(
         expected_fqdn = "emuocpp.com"
         sslC = context
 
+    station_id = serial_number if index == None else SECURITY_CTRL['Identity']
+    connect_start = time.perf_counter()
     try:
         # Open websocket
         async with websockets.connect(
                 addr, subprotocols=[Subprotocol(vers)], extra_headers= headers, server_hostname=expected_fqdn
                 , ssl=sslC
         ) as ws:
+            connect_time = time.perf_counter() - connect_start
+            tracing.record('connect', 'connect', station_id, connect_time, connect_time, station=station_id, security_profile=secProf)
             # Initialize CP
             ChargePointClient = ChargePointClientFactory(VERSION)
             cp = ChargePointClient(serial_number if index == None else SECURITY_CTRL['Identity'], ws)
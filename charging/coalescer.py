@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Optional
+
+
+class StatusCoalescer:
+    # Collapses bursts of status changes per connector. The first change of a
+    # connector is published straight away and opens a window; changes inside
+    # the window only replace the pending value, which is published when the
+    # window closes if it differs from the last published one.
+
+    def __init__(self, window: float, publish: Callable[[Hashable, dict], None], summary_interval: float = 60):
+        self.window = window
+        self.publish = publish
+        self.summary_interval = summary_interval
+        self.received = 0
+        self.published = 0
+        self._last: Dict[Hashable, str] = {}
+        self._pending: Dict[Hashable, Optional[dict]] = {}
+        # Windows close in the order they were opened, since they all have the same length
+        self._deadlines = deque()
+        self._wakeup = asyncio.Event()
+
+    def submit(self, key: Hashable, update: dict):
+        self.received += 1
+        if key in self._pending:
+            # Window open, keep only the latest change
+            self._pending[key] = update
+            return
+        self._emit(key, update)
+        if self.window > 0:
+            self._open(key)
+
+    def _open(self, key: Hashable):
+        self._pending[key] = None
+        self._deadlines.append((time.monotonic() + self.window, key))
+        if len(self._deadlines) == 1:
+            self._wakeup.set()
+
+    def _emit(self, key: Hashable, update: dict):
+        self._last[key] = update['status']
+        self.published += 1
+        self.publish(key, update)
+
+    # Close every window that is due and publish its pending change
+    def flush_due(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key = self._deadlines.popleft()
+            update = self._pending.pop(key)
+            if update is None:
+                continue
+            if update['status'] != self._last.get(key) or update.get('error_code') not in (None, 'NoError'):
+                self._emit(key, update)
+                # Still flapping, keep suppressing
+                self._open(key)
+
+    async def run(self):
+        last_summary = time.monotonic()
+        last_received = last_published = 0
+        while True:
+            self._wakeup.clear()
+            self.flush_due()
+            now = time.monotonic()
+            if now - last_summary >= self.summary_interval:
+                received, published = self.received - last_received, self.published - last_published
+                if received > published:
+                    logging.info(f"Coalesced {received} status notifications into {published} updates in the last {int(now - last_summary)} s")
+                last_summary, last_received, last_published = now, self.received, self.published
+            timeout = self._deadlines[0][0] - now if self._deadlines else self.summary_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
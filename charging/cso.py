@@ -1,13 +1,18 @@
 import argparse
 import asyncio
+import sys
 import websockets
 import readline  
 
+sys.path.append('.')
+from charging.loop import LOOPS, use_event_loop
+
 # Create the parser
 parser = argparse.ArgumentParser(description="Process command-line arguments for CSO script")
 
 # Add arguments
 parser.add_argument('-server', type=str, required=False, help="Server IPv6 address (e.g., ::1)")
+parser.add_argument('-loop', type=str, required=False, choices=LOOPS, help="Event loop -> 'asyncio' or 'uvloop'")
 
 # Parse the arguments
 args = parser.parse_args()
@@ -18,7 +23,7 @@ if args.server:
 else:
     ip = 'fe80::e3a6:46e4:bff9:fb8e%ens33'
 
-cmd_list = ['list', 'exit', 'help', 'install', 'get', 'setProfile', 'setVariable', 'trigger', 'ping']
+cmd_list = ['list', 'exit', 'help', 'install', 'get', 'setProfile', 'setVariable', 'trigger', 'ping', 'energy', 'fleet', 'status', 'cache', 'reload', 'drain', 'loop', 'connections', 'profile', 'heartbeat']
 
 async def process_command(command, websocket):
     # Handle exit command
@@ -74,6 +79,17 @@ async def send_order():
                     print('"trigger <CP_ID> <reason> ..." --- Send trigger message to the desired CP\n')
                     print('"setProfile <CP_ID> <slot> <security_profile>" --- Set a NetworkProfile with the desired security profile into the CP\n')
                     print('"setVariable <CP_ID> ("<variable>",<data>) ..." --- Set a variables with the desired value into the CP (if data is a string put it in "")\n')
+                    print('"fleet [site|model|version]" --- Get the number of connectors per status in the fleet, or per site, model or version\n')
+                    print('"status <CP_ID>" --- Get the status of the connectors of the CP\n')
+                    print('"drain" --- Stop accepting stations, save their state for the next server and close them in batches\n')
+                    print('"reload" --- Reload server_config.yaml without restarting the server\n')
+                    print('"loop" --- Show the event loop lag and the last callbacks blocking the loop (e.g., "loop 3" for 3 stacks)\n')
+                    print('"connections [N]" --- Show the time of each connection phase per security profile and the N slowest connections\n')
+                    print('"heartbeat" --- Show the adaptive heartbeat interval and the stations not updated yet\n')
+                    print('"profile cpu <seconds> [sampling|deterministic] [top]" --- Profile the server for some seconds and show the top functions\n')
+                    print('"profile mem <start|snapshot [top]|stop>" --- Trace allocations and show the top allocation sites since the last snapshot\n')
+                    print('"cache" --- Get the statistics of the cache answering retransmitted calls\n')
+                    print('"energy <transaction|site|hour>" --- Get the energy delivered (kWh) grouped by transaction, site or hour\n')
                 elif order[0] in cmd_list:
                     # Process command
                     if not await process_command(command, websocket):
@@ -89,4 +105,5 @@ async def send_order():
         
 
 # Run the client
+use_event_loop(args.loop)
 asyncio.run(send_order())
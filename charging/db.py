@@ -1,209 +1,239 @@
-import json
-import sqlite3
+import atexit
+from concurrent.futures import Future
+from typing import Iterator
+
+from charging.sqlite_storage import BATCH_MAX_DELAY_MS, BATCH_MAX_SIZE, BatchWriter, SQLiteStorage, connect
+from charging.storage import CREDENTIAL_GENERATORS, MemoryStorage, Storage, generate_random_key, generate_random_password
+from charging.tracing import traced
 
 DATABASE_PATH = "charging/db.sqlite3"
 
-_db = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-_db.execute("PRAGMA foreign_keys=ON;")
-
-# Create DB and schema if it doesn't exist already
-_db.execute(
-    """
-CREATE TABLE IF NOT EXISTS Events (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    type VARCHAR(255) NOT NULL,
-    timestamp DATETIME NOT NULL DEFAULT current_timestamp,
-    target VARCHAR(255) NOT NULL DEFAULT '*',
-    data text NOT NULL
-);
-"""
-)
-
-_db.execute(
-    """
-CREATE TABLE IF NOT EXISTS Users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user VARCHAR(255) NOT NULL UNIQUE,
-    password VARCHAR(255)
-);
-"""
-)
+# Backends selectable with the storage key of the server config
+STORAGES = {'sqlite': lambda: SQLiteStorage(DATABASE_PATH), 'memory': MemoryStorage}
+
+# Opened on first use, so tools switching to another backend never open the default database
+_storage: Storage | None = None
+
+
+def _get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        _storage = SQLiteStorage(DATABASE_PATH)
+    return _storage
+
+
+# Block until every write submitted so far is committed. Called on drain and
+# at exit, so accepted writes are not lost on shutdown.
+def flush_writes(timeout: float = None) -> bool:
+    return _storage is None or _storage.flush(timeout)
+
+
+atexit.register(flush_writes, 5)
 
 
+# Use another backend from now on, the writes of the current one are flushed first
+def use_storage(storage: Storage):
+    global _storage
+    flush_writes()
+    _storage = storage
+
+
+# Use another database file from now on (benchmarks, tools)
+def use_database(path: str):
+    use_storage(SQLiteStorage(path))
+
+
+@traced('db')
 def purge_events():
-    # Delete all data
-    _db.execute("DELETE FROM Events;")
-    _db.execute("DELETE FROM sqlite_sequence WHERE name='Events';")
-    _db.commit()
-
-
-def add_event(event_type: str, target: str = "*", event_data=None):
-    if event_data is None:
-        event_data = {}
-
-    cursor = _db.cursor()
-
-    try:
-        cursor.execute(
-            "INSERT INTO Events (type, target, data) VALUES (?, ?, ?);",
-            (event_type, target, json.dumps(event_data)),
-        )
-
-        _db.commit()
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-
-
-def add_user(user: str, password: str = None):
-    cursor = _db.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO Users (user, password) VALUES (?, ?)",
-            (user, password)
-        )
-        _db.commit()
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-
-
-def chg_password(user: str, new_password: str):
-    cursor = _db.cursor()
-    try:
-        cursor.execute(
-            "UPDATE Users SET password = '"
-            + new_password
-            + "' WHERE user = '"
-            + user
-            + "';"
-        )
-        _db.commit()
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-
-
-def remove_user(user: str):
-    cursor = _db.cursor()
-    try:
-        # Gets the password of the user if exists
-        raw_data = cursor.execute(
-            "SELECT password FROM Users WHERE user=?;", (user,)
-        ).fetchone()
-        # If no event are available return None
-        if raw_data is None:
-            return None
-        else:
-            cursor.execute("DELETE FROM Users WHERE user=?;", (user,))
-            _db.commit()
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-
-
-def get_event(
-    event_type: str, target: str = "*", first_acceptable_id: int = 1
-) -> tuple[int, dict[str, str]] | None:
-    cursor = _db.cursor()
-
-    try:
-        # Get first un-executed event by event_type and target
-        raw_data = cursor.execute(
-            "SELECT id, data FROM Events WHERE type=? and target=? and id>=? ORDER BY id LIMIT 1;",
-            (event_type, target, first_acceptable_id),
-        ).fetchone()
-
-        # If no event are available return None
-        if raw_data is None:
-            return None
-
-        # Parse json and return it
-        return int(raw_data[0]), json.loads(raw_data[1])
-
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-
-
-def get_events(target: str = "*", data: dict = {}) -> str:
-    cursor = _db.cursor()
-    text_json = json.dumps(data).replace("%20", " ")
-    target = target.replace("%20", " ")
-    try:
-        # Get first un-executed event by event_type and target
-        raw_data = cursor.execute(
-            "SELECT * FROM Events WHERE target='"
-            + target
-            + "' and data='"
-            + text_json
-            + "';"
-        ).fetchall()
-
-        # If no event are available return None
-        if raw_data is None:
-            return None
-
-        # Parse json and return it
-        return str(raw_data)
-
-    except sqlite3.Error as e:
-        raise AttributeError(e)
-    
+    _get_storage().purge_events()
 
-def get_cps(target: str = "*", data: dict = {}) -> str:
-    cursor = _db.cursor()
-    text_json = json.dumps(data).replace("%20", " ")
-    target = target.replace("%20", " ")
-    try:
-        # Get first un-executed event by event_type and target
-        raw_data = cursor.execute(
-            "SELECT user FROM Users;"
-        ).fetchall()
 
-        # If no event are available return None
-        if raw_data is None:
-            return None
+@traced('db')
+def add_event(event_type: str, target: str = "*", event_data=None, status: str = "pending") -> Future:
+    # Events consumed in-process when they are stored are added as 'acked'
+    return _get_storage().add_event(event_type, target, event_data, status)
 
-        # Parse json and return it
-        return str(raw_data)
 
-    except sqlite3.Error as e:
-        raise AttributeError(e)
+@traced('db')
+def add_events(events: list[tuple]) -> Future:
+    # Bulk add_event of (event_type, target, event_data[, status]) tuples, in one transaction
+    return _get_storage().add_events(events)
 
 
-def auth_user(user: str, password: str) -> bool:
-    cursor = _db.cursor()
-    try:
-        # Gets the password of the user if exists
-        raw_data = cursor.execute(
-            "SELECT * FROM Users WHERE user='"
-            + user
-            + "' and password='"
-            + password
-            + "';"
-        ).fetchone()
+@traced('db')
+def add_user(user: str, password: str = None) -> Future:
+    # Fails with AttributeError if the user exists
+    return _get_storage().add_user(user, password)
+
+
+@traced('db')
+def add_users(users: list[tuple[str, str]]) -> Future:
+    # Bulk add_user of (user, password) tuples in one transaction. Existing
+    # users are left unchanged, the Future gives the number of users added.
+    return _get_storage().add_users(users)
+
+
+@traced('db')
+def chg_password(user: str, new_password: str) -> Future:
+    return _get_storage().chg_password(user, new_password)
+
+
+@traced('db')
+def remove_user(user: str) -> Future:
+    # The Future gives 0 if the user did not exist
+    return _get_storage().remove_user(user)
+
+
+@traced('db')
+def provision_users(records: list[tuple]) -> Future:
+    # Create or update the users of (serial, password[, generate]) records in
+    # one transaction. A password of None stores a user without password,
+    # generate 'key' or 'password' generates the credential unless the user
+    # already has one, so running it again gives the same credentials. The
+    # Future gives {serial: password}.
+    for record in records:
+        if len(record) > 2 and record[2] is not None and record[2] not in CREDENTIAL_GENERATORS:
+            raise AttributeError(f"Unknown credential type {record[2]}")
+    return _get_storage().provision_users([tuple(record) for record in records])
+
+
+@traced('db')
+def get_event(event_type: str, target: str = "*", first_acceptable_id: int = 1) -> tuple[int, dict[str, str]] | None:
+    # First event of a type for a target from an id on
+    return _get_storage().get_event(event_type, target, first_acceptable_id)
+
+
+@traced('db')
+def get_events_after(last_id: int, event_types: tuple, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+    # Next events of the given types for every target, in order
+    return _get_storage().get_events_after(last_id, event_types, limit)
+
+
+@traced('db')
+def get_pending_events(event_types: tuple, after_id: int = 0, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+    # Oldest pending events of the given types, in order. Consumers pass the
+    # last id they read to page through a backlog before acking it.
+    return _get_storage().get_pending_events(event_types, after_id, limit)
+
 
-        # If no event are available return None
-        if raw_data is None:
-            return False
+@traced('db')
+def ack_events(event_ids: list[int]) -> Future:
+    # Mark events as consumed, they are not returned as pending any more. The
+    # Future gives the number of events that were still pending.
+    return _get_storage().ack_events(event_ids)
 
-        # Parse json and return it
-        return True
 
-    except sqlite3.Error as e:
-        raise AttributeError(e)
+@traced('db')
+def get_last_event_id() -> int:
+    # Id of the last stored event, 0 if none
+    return _get_storage().get_last_event_id()
 
 
+@traced('db')
+def get_events_version(target: str = None) -> str:
+    # Tag of the events of a target (of all the events if None), changes
+    # whenever one of them is added, acked or deleted
+    return _get_storage().get_events_version(target)
+
+
+@traced('db')
+def compact_events(retention: int, pending_retention: int = 0, limit: int = 10000) -> tuple[int, int]:
+    # Delete up to `limit` events acked more than `retention` seconds ago and
+    # pending events older than `pending_retention` seconds (0 keeps them).
+    # Returns (acked, expired) counts. Call it repeatedly while it returns
+    # `limit` to remove a backlog without long write transactions.
+    return _get_storage().compact_events(retention, pending_retention, limit)
+
+
+@traced('db')
+def get_events_page(
+    after_id: int = 0,
+    limit: int = 1000,
+    event_type: str = None,
+    target: str = None,
+    since: str = None,
+    until: str = None,
+    data: dict = None,
+) -> list[dict]:
+    # Events with an id above `after_id` matching the filters, in id order.
+    # Pass the id of the last event as `after_id` to get the next page.
+    return _get_storage().get_events_page(after_id, limit, event_type, target, since, until, data)
+
+
+def iter_events(after_id: int = 0, page_size: int = 1000, **filters) -> Iterator[dict]:
+    # All the events matching the filters of get_events_page, one page in memory at a time
+    while True:
+        page = get_events_page(after_id, page_size, **filters)
+        yield from page
+        if len(page) < page_size:
+            return
+        after_id = page[-1]["id"]
+
+
+@traced('db')
+def get_events(target: str = "*", data: dict = None) -> list[dict]:
+    # Events of a target with exactly this data
+    return list(iter_events(target=target, data=data))
+
+
+@traced('db')
+def get_cps(target: str = "*", data: dict = {}) -> str:
+    return _get_storage().get_cps(target, data)
+
+
+@traced('db')
+def auth_user(user: str, password: str) -> bool:
+    return _get_storage().auth_user(user, password)
+
+
+@traced('db')
 def check_user(user: str) -> str:
-    cursor = _db.cursor()
-    try:
-        # Gets the password of the user if exists
-        raw_data = cursor.execute(
-            "SELECT user FROM Users WHERE user='" + user + "';"
-        ).fetchone()
-
-        # If no event are available return None
-        if raw_data is None:
-            return None
-
-        # Parse json and return it
-        return str(raw_data)
-
-    except sqlite3.Error as e:
-        raise AttributeError(e)
+    return _get_storage().check_user(user)
+
+
+@traced('db')
+def add_transaction_event(
+    transaction_id: str,
+    station: str,
+    event_type: str,
+    seq_no: int = 0,
+    timestamp: str = None,
+    id_token: str = None,
+    meter: float = None,
+):
+    # Upsert the ledger row for the transaction. The first event seen sets the
+    # start data, 'Ended' sets the stop data.
+    _get_storage().add_transaction_event(transaction_id, station, event_type, seq_no, timestamp, id_token, meter)
+
+
+@traced('db')
+def get_transactions(station: str = None, id_token: str = None, limit: int = 100) -> list[dict]:
+    return _get_storage().get_transactions(station, id_token, limit)
+
+
+@traced('db')
+def save_reservation(
+    reservation_id: int,
+    station: str,
+    evse_id: int,
+    id_token: str,
+    token_type: str,
+    expiry: str,
+    status: str,
+):
+    _get_storage().save_reservation(reservation_id, station, evse_id, id_token, token_type, expiry, status)
+
+
+@traced('db')
+def get_reservations(station: str = None, id_token: str = None, status: str = None, limit: int = 100) -> list[dict]:
+    return _get_storage().get_reservations(station, id_token, status, limit)
+
+
+@traced('db')
+def get_reservation(reservation_id: int) -> dict | None:
+    return _get_storage().get_reservation(reservation_id)
+
+
+@traced('db')
+def get_max_reservation_id() -> int:
+    return _get_storage().get_max_reservation_id()
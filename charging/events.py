@@ -0,0 +1,28 @@
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+# Callback receiving (event_type, station, data)
+Subscriber = Callable[[str, str, dict], None]
+
+
+class EventBus:
+    # In-process publish/subscribe of station events. Subscribers registered
+    # for '*' receive every event type.
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Subscriber]] = defaultdict(list)
+
+    def subscribe(self, event_type: str, callback: Subscriber):
+        self._subscribers[event_type].append(callback)
+
+    def unsubscribe(self, event_type: str, callback: Subscriber):
+        if callback in self._subscribers.get(event_type, ()):
+            self._subscribers[event_type].remove(callback)
+
+    def publish(self, event_type: str, station: str, data: dict):
+        for callback in self._subscribers.get(event_type, []) + self._subscribers.get('*', []):
+            try:
+                callback(event_type, station, data)
+            except Exception:
+                logging.exception(f"Subscriber failed to handle {event_type} event of {station}")
@@ -0,0 +1,124 @@
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Tuple
+
+# Dimensions the aggregate counters are kept for
+DIMENSIONS = ('site', 'model', 'version')
+
+# Connector status (1.6 ChargePointStatus / 2.x ConnectorStatus) -> counter category
+CATEGORIES = {
+    'Available': 'available',
+    'Occupied': 'occupied',
+    'Preparing': 'occupied',
+    'Charging': 'occupied',
+    'SuspendedEV': 'occupied',
+    'SuspendedEVSE': 'occupied',
+    'Finishing': 'occupied',
+    'Reserved': 'reserved',
+    'Unavailable': 'unavailable',
+    'Faulted': 'faulted',
+}
+
+
+def _get_category(status: Optional[str]) -> str:
+    return CATEGORIES.get(status, 'unknown')
+
+
+class FleetStatus:
+    # In-memory status table (station, EVSE, connector) -> status, charging
+    # state and last seen time. Counters per site/model/version and category
+    # are updated on every transition, so summaries never scan the stations.
+
+    def __init__(self):
+        self.stations: Dict[str, dict] = {}
+        self.connectors: Dict[Tuple[str, int, int], dict] = {}
+        self.station_connectors: Dict[str, set] = defaultdict(set)
+        self.counters: Dict[Tuple[str, str], Counter] = defaultdict(Counter)
+        self.total = Counter()
+        self.online = 0
+
+    def _count(self, station: str, category: str, delta: int):
+        self.total[category] += delta
+        meta = self.stations[station]
+        for dimension in DIMENSIONS:
+            self.counters[(dimension, meta[dimension])][category] += delta
+
+    # Add or update the station metadata (on BootNotification)
+    def register_station(self, station: str, site: str, model: str, version: str):
+        meta = {'site': site, 'model': model, 'version': version, 'online': True, 'last_seen': time.time()}
+        old = self.stations.get(station)
+        if old is None or not old['online']:
+            self.online += 1
+        if old is not None:
+            # Move the counts of its connectors to the new groups
+            for key in self.station_connectors[station]:
+                self._count(station, self.connectors[key]['category'], -1)
+        self.stations[station] = meta
+        # A reconnected station gets back the last known status of its connectors
+        for key in self.station_connectors[station]:
+            entry = self.connectors[key]
+            entry['category'] = _get_category(entry['status'])
+            self._count(station, entry['category'], 1)
+
+    def touch(self, station: str):
+        meta = self.stations.get(station)
+        if meta is not None:
+            meta['last_seen'] = time.time()
+
+    def update_connector(self, station: str, evse_id: int, connector_id: int, status: str):
+        if station not in self.stations:
+            return
+        key = (station, evse_id or 0, connector_id or 0)
+        now = time.time()
+        category = _get_category(status)
+        entry = self.connectors.get(key)
+        if entry is None:
+            entry = {'status': status, 'category': category, 'charging_state': 'Idle', 'last_seen': now}
+            self.connectors[key] = entry
+            self.station_connectors[station].add(key)
+            self._count(station, category, 1)
+        else:
+            if entry['category'] != category:
+                self._count(station, entry['category'], -1)
+                self._count(station, category, 1)
+            entry['status'] = status
+            entry['category'] = category
+            entry['last_seen'] = now
+        self.stations[station]['last_seen'] = now
+
+    # Charging state comes from TransactionEvent, which may not name the EVSE
+    def update_charging_state(self, station: str, charging_state: str, evse_id: int = None):
+        for key in self.station_connectors.get(station, ()):
+            if evse_id is None or key[1] == evse_id:
+                self.connectors[key]['charging_state'] = charging_state
+        self.touch(station)
+
+    # Connectors of a disconnected station are counted as offline
+    def set_offline(self, station: str):
+        meta = self.stations.get(station)
+        if meta is None or not meta['online']:
+            return
+        meta['online'] = False
+        self.online -= 1
+        for key in self.station_connectors[station]:
+            entry = self.connectors[key]
+            self._count(station, entry['category'], -1)
+            entry['category'] = 'offline'
+            self._count(station, 'offline', 1)
+
+    def summary(self, dimension: str = None) -> dict:
+        if dimension is None:
+            return {'total': dict(+self.total), 'stations': len(self.stations), 'online': self.online}
+        return {key: dict(+counter) for (dim, key), counter in self.counters.items() if dim == dimension}
+
+    def station(self, station: str) -> Optional[dict]:
+        meta = self.stations.get(station)
+        if meta is None:
+            return None
+        return {
+            **meta,
+            'connectors': [
+                {'evse_id': key[1], 'connector_id': key[2], **self.connectors[key]}
+                for key in sorted(self.station_connectors[station])
+            ],
+        }
@@ -0,0 +1,47 @@
+import math
+import time
+
+# A new interval is only pushed if it differs from the current one by more than this
+HYSTERESIS = 0.2
+
+
+class HeartbeatController:
+    # Computes the heartbeat interval given to the stations. It keeps the
+    # total heartbeat rate (stations / interval) under `budget` per second and
+    # stretches the interval further while the event loop is busier than
+    # `target_utilisation`. Loop utilisation is the CPU time of the loop
+    # thread over the wall time since the last sample.
+
+    def __init__(self, min_interval: int = 10, max_interval: int = 3600, budget: float = 1000, target_utilisation: float = 0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.target_utilisation = target_utilisation
+        self.interval = min_interval
+        self.utilisation = 0.0
+        self._last_sample = None
+
+    # Call from the event loop thread
+    def sample_utilisation(self) -> float:
+        now = (time.monotonic(), time.thread_time())
+        if self._last_sample is not None:
+            wall, cpu = now[0] - self._last_sample[0], now[1] - self._last_sample[1]
+            if wall > 0:
+                self.utilisation = min(1.0, cpu / wall)
+        self._last_sample = now
+        return self.utilisation
+
+    def compute(self, stations: int, utilisation: float) -> int:
+        interval = max(self.min_interval, stations / self.budget if self.budget > 0 else 0)
+        if utilisation > self.target_utilisation > 0:
+            interval *= utilisation / self.target_utilisation
+        return int(min(self.max_interval, max(self.min_interval, math.ceil(interval))))
+
+    # Update the interval, returns True if it changed enough to be pushed to the stations
+    def update(self, stations: int) -> bool:
+        interval = self.compute(stations, self.sample_utilisation())
+        # Always follow the bounds, otherwise ignore small changes
+        if self.min_interval <= self.interval <= self.max_interval and abs(interval - self.interval) <= self.interval * HYSTERESIS:
+            return False
+        self.interval = interval
+        return True
@@ -0,0 +1,95 @@
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Optional
+
+# Defaults, overridden from server_config.yaml
+CACHE_SIZE = 64
+CACHE_TTL = 120
+
+# hits, misses, stores, evictions and expirations over all stations
+stats = Counter()
+
+
+class CallResultCache:
+    # Bounded LRU of message id -> serialized CALLRESULT, entries expire after `ttl` seconds
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message_id: str) -> Optional[str]:
+        entry = self._entries.get(message_id)
+        if entry is None:
+            stats['misses'] += 1
+            return None
+        expiry, response = entry
+        if expiry < time.monotonic():
+            del self._entries[message_id]
+            stats['expirations'] += 1
+            stats['misses'] += 1
+            return None
+        self._entries.move_to_end(message_id)
+        stats['hits'] += 1
+        return response
+
+    def put(self, message_id: str, response: str):
+        now = time.monotonic()
+        self._entries[message_id] = (now + self.ttl, response)
+        self._entries.move_to_end(message_id)
+        stats['stores'] += 1
+        # Drop expired entries from the old end, then the least recently used ones
+        while self._entries:
+            oldest_id, (expiry, _) = next(iter(self._entries.items()))
+            if expiry < now:
+                stats['expirations'] += 1
+            elif len(self._entries) > self.max_size:
+                stats['evictions'] += 1
+            else:
+                break
+            del self._entries[oldest_id]
+
+
+# One cache per station, kept across reconnections since retries often follow one
+_caches: Dict[str, CallResultCache] = {}
+# Disconnected stations -> time their cache is dropped, in release order
+_released: OrderedDict = OrderedDict()
+
+
+# Drop the caches of the stations disconnected for longer than the TTL
+def _prune():
+    now = time.monotonic()
+    while _released:
+        station, expiry = next(iter(_released.items()))
+        if expiry >= now:
+            break
+        del _released[station]
+        _caches.pop(station, None)
+
+
+def get_cache(station: str) -> CallResultCache:
+    _released.pop(station, None)
+    _prune()
+    cache = _caches.get(station)
+    if cache is None:
+        cache = _caches[station] = CallResultCache(CACHE_SIZE, CACHE_TTL)
+    return cache
+
+
+# The station disconnected: its entries can not be retried after the TTL
+def release(station: str):
+    cache = _caches.get(station)
+    if cache is not None and len(cache):
+        _released[station] = time.monotonic() + cache.ttl
+        _released.move_to_end(station)
+    else:
+        _caches.pop(station, None)
+    _prune()
+
+
+def get_stats() -> dict:
+    _prune()
+    return {**stats, 'stations': len(_caches), 'entries': sum(len(cache) for cache in _caches.values())}
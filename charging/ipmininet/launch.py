@@ -1,6 +1,5 @@
 import importlib
 import re
-import string
 import time
 from ipmininet.ipnet import IPNet
 from mininet.term import makeTerm
@@ -15,20 +14,7 @@ import yaml
 sys.path.append('.')
 
 import shutil
-import secrets
-from charging.db import add_user, remove_user
-
-def generate_random_key(min_bytes=16, max_bytes=20):
-    num_bytes = secrets.choice(range(min_bytes, max_bytes + 1))
-    random_bytes = secrets.token_bytes(num_bytes)
-    hex_string = random_bytes.hex()
-    return hex_string
-
-def generate_random_password(min_chars=16, max_chars=40):
-    allowed_chars = string.ascii_letters + string.digits + "*-_=|@."
-    password_length = secrets.choice(range(min_chars, max_chars + 1))
-    random_password = ''.join(secrets.choice(allowed_chars) for _ in range(password_length))
-    return random_password
+from charging.db import provision_users, remove_user
 
 def add_folders():
     os.mkdir('./serverConfigs')
@@ -109,14 +95,18 @@ def run_topology(topology_module_name):
     servers = []
     dns = []
 
+    # (serial, password, generate) of every client, provisioned in one transaction
+    records = []
+    # Clients whose generated credential goes into their config
+    authenticated = []
+
     for host in net.hosts:
         try:
             if host.type == 'client':
                 print(f"Host {host.name} is a {host.type} with IPv6 {host.defaultIntf().ip6}")
                 print(f" - Version: {host.version}, Profile: {host.profile}, SN: {host.SN} url: {host.url}")
                 secProfiles = []
-                os.popen(f'cp ./charging/client_config.yaml ./clientConfigs/{host.SN}_config.yaml')
-                time.sleep(0.2)
+                shutil.copy('./charging/client_config.yaml', f'./clientConfigs/{host.SN}_config.yaml')
                 with open(f'./clientConfigs/{host.SN}_config.yaml', 'r') as file1, open(f'./charging/ipmininet/topologies/customTopo_config.yaml', 'r') as file2:
                     yaml1 = yaml.safe_load(file1)
                     yaml2 = yaml.safe_load(file2)
@@ -165,30 +155,10 @@ def run_topology(topology_module_name):
                         os.mkdir(f'./charging/installedCertificates/{host.SN}')
                         os.mkdir(f'./charging/installedCertificates/{host.SN}/root')
                         os.popen(f'cp emuocpp_ttp_cert.pem ./charging/installedCertificates/{host.SN}/root')
-                    auth_key = generate_random_key() if host.version == 'v1.6' else generate_random_password()
-                    add_user(user= host.SN, password=auth_key)
-                    time.sleep(0.5)
-                    while True:
-                        try:
-                            with open(f'./clientConfigs/{host.SN}_config.yaml', 'r') as file:
-                                config = yaml.safe_load(file)
-                        except:
-                            continue
-                        break
-                    while True:
-                        try:
-                            config['security']['BasicAuthPassword'] = auth_key
-                            print(f'AuthKey: {config['security']['BasicAuthPassword']}')
-                        except Exception as e:
-                            print(e)
-                            time.sleep(2)
-                            continue
-                        break
-                    with open(f'./clientConfigs/{host.SN}_config.yaml', 'w') as file:
-                        yaml.safe_dump(config, file, default_flow_style=False)
+                    records.append((host.SN, None, 'key' if host.version == 'v1.6' else 'password'))
+                    authenticated.append(host)
                 else:
-                    add_user(user= host.SN, password=None)
-                    time.sleep(0.5)
+                    records.append((host.SN, None))
             elif host.type == 'server':
                 print(f"Host {host.name} is a {host.type} with IPv6 {host.defaultIntf().ip6}")
                 print(f" - Multiple: {host.multiple} URL: {host.url}, DNS: {host.dns}")
@@ -203,6 +173,16 @@ def run_topology(topology_module_name):
                 dns.append(host)
         except AttributeError as e:
             print(f"Host {host.name} is a host with IPv6 {host.defaultIntf().ip6}")
+
+    # Register all the clients at once, a previous run's credentials are kept
+    credentials = provision_users(records).result()
+    for host in authenticated:
+        with open(f'./clientConfigs/{host.SN}_config.yaml', 'r') as file:
+            config = yaml.safe_load(file)
+        config['security']['BasicAuthPassword'] = credentials[host.SN]
+        print(f'AuthKey: {credentials[host.SN]}')
+        with open(f'./clientConfigs/{host.SN}_config.yaml', 'w') as file:
+            yaml.safe_dump(config, file, default_flow_style=False)
     
     for client in clients:
         if client.url == None:
@@ -0,0 +1,101 @@
+import heapq
+import time
+from typing import Dict, List
+
+from websockets.legacy.server import WebSocketServerProtocol
+
+from charging import metrics
+from charging import tracing
+
+# Connections kept for the dump of the slowest ones
+SLOWEST_SIZE = 100
+
+# Phase -> (mark it starts at, mark it ends at)
+#  tls: TCP accept until the TLS handshake is done (close to 0 without TLS)
+#  request: reading the HTTP upgrade request
+#  auth: Basic auth of process_request (security profiles 1 and 2)
+#  upgrade: rest of the WebSocket handshake
+#  cert_check: client certificate check in on_connect (security profile 3)
+#  boot: until the first BootNotification is answered
+PHASES = {
+    'tls': ('accepted', 'connected'),
+    'request': ('connected', 'auth_start'),
+    'auth': ('auth_start', 'auth_end'),
+    'upgrade': ('auth_end', 'opened'),
+    'cert_check': ('opened', 'cert_checked'),
+    'boot': ('cert_checked', 'booted'),
+    'total': ('accepted', 'booted'),
+}
+
+metrics.registry.help['ocpp_connection_phase_seconds'] = 'Time of each phase of a connection until the first BootNotification, by security profile'
+
+_slowest: List[tuple] = []
+
+
+class TimedServerProtocol(WebSocketServerProtocol):
+    # Websocket protocol timestamping each phase of the connection. The
+    # protocol is created on TCP accept and connection_made is called once
+    # the TLS handshake (if any) is done.
+
+    def __init__(self, *args, **kwargs):
+        self.marks: Dict[str, float] = {'accepted': time.perf_counter()}
+        super().__init__(*args, **kwargs)
+
+    def mark(self, name: str):
+        self.marks.setdefault(name, time.perf_counter())
+
+    def connection_made(self, transport):
+        self.mark('connected')
+        super().connection_made(transport)
+
+    async def process_request(self, path, request_headers):
+        self.mark('auth_start')
+        try:
+            return await super().process_request(path, request_headers)
+        finally:
+            self.mark('auth_end')
+
+
+# Record the phases of a connection once its first BootNotification is answered
+def record(connection, station: str, security_profile: int, status: str):
+    marks = getattr(connection, 'marks', None)
+    if marks is None or 'booted' in marks:
+        return
+    connection.mark('opened')
+    connection.mark('cert_checked')
+    connection.mark('booted')
+
+    phases = {phase: marks[end] - marks[start] for phase, (start, end) in PHASES.items()}
+    for phase, duration in phases.items():
+        metrics.registry.observe('ocpp_connection_phase_seconds', duration, security_profile=security_profile, phase=phase)
+
+    tracing.record('connect', 'connect', station, phases['total'], phases['total'], station=station, security_profile=security_profile,
+                   **{f'{phase}_ms': round(duration * 1000, 3) for phase, duration in phases.items()})
+
+    entry = (phases['total'], time.time(), station, security_profile, status, phases)
+    if len(_slowest) < SLOWEST_SIZE:
+        heapq.heappush(_slowest, entry)
+    elif entry > _slowest[0]:
+        heapq.heapreplace(_slowest, entry)
+
+
+def get_slowest(n: int = 10) -> List[dict]:
+    return [
+        {'station': station, 'security_profile': security_profile, 'boot_status': status, 'time': timestamp,
+         'phases_ms': {phase: round(duration * 1000, 3) for phase, duration in phases.items()}}
+        for _, timestamp, station, security_profile, status, phases in heapq.nlargest(n, _slowest)
+    ]
+
+
+# Quantiles of each phase per security profile
+def get_summary() -> dict:
+    summary = {}
+    for labels, histogram in metrics.registry.histograms.get('ocpp_connection_phase_seconds', {}).items():
+        labels = dict(labels)
+        summary.setdefault(f"SP{labels['security_profile']}", {})[labels['phase']] = {
+            'count': histogram.count,
+            'p50_ms': round(histogram.quantile(0.5) * 1000, 3),
+            'p99_ms': round(histogram.quantile(0.99) * 1000, 3),
+            'max_ms': round(histogram.max * 1000, 3),
+        }
+    return summary
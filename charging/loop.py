@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+# Event loops that can be chosen with -loop or the event_loop config key
+LOOPS = ('asyncio', 'uvloop')
+
+
+# Install the policy of the loop created by the next asyncio.run().
+# Falls back to the default asyncio loop if uvloop is not installed
+# (it is not available on Windows).
+def use_event_loop(name: str = None) -> str:
+    if name not in (None, *LOOPS):
+        raise ValueError(f"Unknown event loop '{name}', use one of {', '.join(LOOPS)}")
+
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed, using the asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
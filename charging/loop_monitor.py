@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+# Only frames of these files are used to name the handler of a slow callback
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Shortest sleep of the watchdog, so a tiny threshold does not make it spin
+MIN_WATCH_INTERVAL = 0.01
+
+
+def _percentile(values: list, percentile: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+# Name the innermost function of this package on the stack, and the station
+# if it runs in a charge point method
+def _get_handler(frame) -> tuple:
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(PACKAGE_DIR) and frame.f_code.co_filename != __file__:
+            station = getattr(frame.f_locals.get('self'), 'id', None)
+            return getattr(frame.f_code, 'co_qualname', frame.f_code.co_name), station
+        frame = frame.f_back
+    return None, None
+
+
+class LoopMonitor:
+    # A probe task sleeps `interval` seconds and records how late it wakes up
+    # (scheduling delay of the event loop). A watchdog thread checks the probe
+    # and, when the loop has not run it for `threshold` seconds, captures the
+    # stack of the loop thread: that is the callback blocking the loop.
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, summary_interval: float = 60, samples: int = 6000, max_slow: int = 100):
+        self.interval = interval
+        self.threshold = threshold
+        self.summary_interval = summary_interval
+        self.lags = deque(maxlen=samples)
+        self.slow = deque(maxlen=max_slow)
+        self.slow_handlers = Counter()
+        self.max_lag = 0.0
+        self._expected = None
+        self._stall = None
+        self._loop_thread = None
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        threading.Thread(target=self._watch, name='loop-monitor', daemon=True).start()
+        last_summary = time.monotonic()
+        last_slow = 0
+
+        while True:
+            self._expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self._expected)
+            self._expected = None
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            # The watchdog saw the stall, record how long it lasted
+            stall = self._stall
+            if stall is not None:
+                self._stall = None
+                stall['duration'] = round(lag, 4)
+                self.slow.append(stall)
+                self.slow_handlers[stall['handler']] += 1
+
+            if now - last_summary >= self.summary_interval:
+                slow = sum(self.slow_handlers.values()) - last_slow
+                message = f"Event loop lag p50 {_percentile(self.lags, 50) * 1000:.1f} ms, p99 {_percentile(self.lags, 99) * 1000:.1f} ms, max {self.max_lag * 1000:.1f} ms, {slow} slow callbacks in the last {int(now - last_summary)} s"
+                if slow:
+                    message += f", top: {', '.join(f'{handler} ({count})' for handler, count in self.slow_handlers.most_common(3))}"
+                (logging.warning if slow else logging.info)(message)
+                last_summary, last_slow = now, sum(self.slow_handlers.values())
+
+    # Runs in its own thread, so it keeps running while the loop is blocked
+    def _watch(self):
+        while True:
+            time.sleep(max(MIN_WATCH_INTERVAL, self.threshold / 2))
+            expected = self._expected
+            if expected is None or self._stall is not None or time.monotonic() - expected < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            handler, station = _get_handler(frame)
+            self._stall = {
+                'time': time.time(),
+                'duration': None,
+                'handler': handler or frame.f_code.co_name,
+                'station': station,
+                'stack': traceback.format_stack(frame),
+            }
+
+    def summary(self, stacks: int = 5) -> dict:
+        lags = list(self.lags)
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': len(lags),
+            'lag_ms': {
+                'p50': round(_percentile(lags, 50) * 1000, 2),
+                'p99': round(_percentile(lags, 99) * 1000, 2),
+                'max': round(self.max_lag * 1000, 2),
+            },
+            'slow_callbacks': sum(self.slow_handlers.values()),
+            'slow_handlers': dict(self.slow_handlers.most_common()),
+            'recent': [
+                {**stall, 'stack': ''.join(stall['stack'])} if i < stacks else {key: value for key, value in stall.items() if key != 'stack'}
+                for i, stall in enumerate(reversed(self.slow))
+            ],
+        }
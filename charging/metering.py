@@ -0,0 +1,269 @@
+import glob
+import json
+import logging
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+SEGMENT_DIR = 'charging/meter_segments'
+
+# Rows buffered in memory before a chunk is sealed and written as a segment
+CHUNK_ROWS = 65_536
+
+# Bytes of segment columns kept in memory for the next queries, least
+# recently used segments are read from disk again
+SEGMENT_CACHE_BYTES = 256 * 1024 * 1024
+
+ENERGY_MEASURAND = 'Energy.Active.Import.Register'
+
+# Column name -> array typecode (in memory) / numpy dtype (on disk)
+COLUMNS = {
+    'timestamp': ('d', np.float64),
+    'station': ('I', np.uint32),
+    'transaction': ('I', np.uint32),
+    'measurand': ('H', np.uint16),
+    'phase': ('B', np.uint8),
+    'value': ('d', np.float64),
+}
+
+
+def _parse_timestamp(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+# Normalise a sampled value to its base unit (Wh, W, A, ...)
+def _normalise(sample: Dict) -> float:
+    value = float(sample['value'])
+    # 2.x carries unit and power of ten multiplier in unit_of_measure, 1.6 a plain unit
+    unit_of_measure = sample.get('unit_of_measure', {})
+    value *= 10 ** unit_of_measure.get('multiplier', 0)
+    unit = unit_of_measure.get('unit', sample.get('unit', ''))
+    if unit[:1] == 'k':
+        value *= 1000
+    return value
+
+
+class Dictionary:
+    # Maps strings (stations, transactions, measurands, phases) to dense integer codes.
+    # Code 0 is reserved for "none".
+
+    def __init__(self):
+        self.values = ['']
+        self.codes = {'': 0}
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return 0
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+
+class MeterStore:
+    # Columnar store of sampled meter values. Samples are buffered in typed
+    # column arrays, sealed into chunks of CHUNK_ROWS rows and flushed to
+    # immutable, append-only segment files. Aggregations run vectorized over
+    # the columns of all segments overlapping the requested time range.
+
+    def __init__(self, path: str = SEGMENT_DIR, chunk_rows: int = CHUNK_ROWS, cache_bytes: int = SEGMENT_CACHE_BYTES):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.cache_bytes = cache_bytes
+        self.dictionaries = {name: Dictionary() for name in ('station', 'transaction', 'measurand', 'phase')}
+        self._persisted_codes = {name: 1 for name in self.dictionaries}
+        self._buffer = self._new_columns()
+        self._sealed = []
+        self._segments = {}
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._next_segment = 0
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self._load_dictionaries()
+
+    @staticmethod
+    def _new_columns() -> Dict[str, array]:
+        return {name: array(typecode) for name, (typecode, _) in COLUMNS.items()}
+
+    # Append every sampled value of a MeterValue list (1.6 or 2.x)
+    def ingest(self, station: str, meter_value: Optional[List], transaction_id: Optional[str] = None) -> int:
+        measurands = self.dictionaries['measurand']
+        phases = self.dictionaries['phase']
+        rows = 0
+
+        with self._lock:
+            station_code = self.dictionaries['station'].encode(station)
+            transaction_code = self.dictionaries['transaction'].encode(None if transaction_id is None else str(transaction_id))
+            columns = self._buffer
+            for value in meter_value or []:
+                try:
+                    timestamp = _parse_timestamp(value['timestamp'])
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    logging.warning(f'Discarding meter value with malformed timestamp from {station}: {value}')
+                    continue
+                for sample in value.get('sampled_value', []):
+                    try:
+                        reading = _normalise(sample)
+                    except (KeyError, TypeError, ValueError):
+                        logging.warning(f'Discarding malformed sampled value from {station}: {sample}')
+                        continue
+                    columns['timestamp'].append(timestamp)
+                    columns['station'].append(station_code)
+                    columns['transaction'].append(transaction_code)
+                    columns['measurand'].append(measurands.encode(sample.get('measurand', ENERGY_MEASURAND)))
+                    columns['phase'].append(phases.encode(sample.get('phase')))
+                    columns['value'].append(reading)
+                    rows += 1
+
+            if len(columns['timestamp']) >= self.chunk_rows:
+                self._sealed.append(columns)
+                self._buffer = self._new_columns()
+        return rows
+
+    # Write sealed chunks (and, if requested, the partial buffer) as segments.
+    # Blocking: run it from a thread when called from the event loop.
+    def flush(self, partial: bool = True) -> int:
+        with self._flush_lock:
+            with self._lock:
+                chunks = self._sealed
+                self._sealed = []
+                if partial and len(self._buffer['timestamp']):
+                    chunks.append(self._buffer)
+                    self._buffer = self._new_columns()
+                dictionary_values = {name: list(d.values) for name, d in self.dictionaries.items()}
+
+            # Dictionaries go first so every code in a segment can be decoded
+            if chunks:
+                self._save_dictionaries(dictionary_values)
+            for chunk in chunks:
+                self._write_segment({name: np.frombuffer(column, dtype=COLUMNS[name][1]) for name, column in chunk.items()})
+            return len(chunks)
+
+    def _write_segment(self, columns: Dict[str, np.ndarray]):
+        start, end = int(columns['timestamp'].min()), int(np.ceil(columns['timestamp'].max()))
+        filename = os.path.join(self.path, f'seg-{self._next_segment:08d}-{start}-{end}.npz')
+        self._next_segment += 1
+        # Write then rename, so a segment is either complete or absent
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(filename + '.tmp', filename)
+        self._segments[filename] = (start, end, None)
+
+    def _save_dictionaries(self, dictionary_values: Dict[str, List[str]]):
+        with open(os.path.join(self.path, 'dictionary.jsonl'), 'a') as f:
+            for name, values in dictionary_values.items():
+                for code in range(self._persisted_codes[name], len(values)):
+                    f.write(json.dumps([name, code, values[code]]) + '\n')
+                self._persisted_codes[name] = len(values)
+
+    def _load_dictionaries(self):
+        try:
+            with open(os.path.join(self.path, 'dictionary.jsonl'), 'r') as f:
+                for line in f:
+                    name, code, value = json.loads(line)
+                    dictionary = self.dictionaries[name]
+                    if code == len(dictionary.values):
+                        dictionary.encode(value)
+        except FileNotFoundError:
+            pass
+        for name, dictionary in self.dictionaries.items():
+            self._persisted_codes[name] = len(dictionary.values)
+
+        for filename in sorted(glob.glob(os.path.join(self.path, 'seg-*.npz'))):
+            sequence, start, end = os.path.basename(filename)[4:-4].split('-')
+            self._segments[filename] = (int(start), int(end), None)
+            self._next_segment = max(self._next_segment, int(sequence) + 1)
+
+    # Columns of a segment file, from the cache if it was read recently
+    def _load_segment(self, filename: str) -> Dict[str, np.ndarray]:
+        with self._cache_lock:
+            columns = self._cache.get(filename)
+            if columns is not None:
+                self._cache.move_to_end(filename)
+                return columns
+        with np.load(filename) as data:
+            columns = {name: data[name] for name in COLUMNS}
+        size = sum(column.nbytes for column in columns.values())
+        with self._cache_lock:
+            if filename not in self._cache and size <= self.cache_bytes:
+                self._cache[filename] = columns
+                self._cached_bytes += size
+                while self._cached_bytes > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= sum(column.nbytes for column in evicted.values())
+        return columns
+
+    # Concatenate the columns of every segment and buffered chunk overlapping [start, end)
+    def _scan(self, start: float = None, end: float = None) -> Dict[str, np.ndarray]:
+        parts = []
+        for filename, (segment_start, segment_end, columns) in list(self._segments.items()):
+            if (start is not None and segment_end < start) or (end is not None and segment_start >= end):
+                continue
+            if columns is None:
+                columns = self._load_segment(filename)
+            parts.append(columns)
+
+        with self._lock:
+            for chunk in self._sealed + [self._buffer]:
+                if len(chunk['timestamp']):
+                    parts.append({name: np.array(column, dtype=COLUMNS[name][1]) for name, column in chunk.items()})
+
+        if not parts:
+            return {name: np.empty(0, dtype=dtype) for name, (_, dtype) in COLUMNS.items()}
+
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+        mask = np.ones(len(columns['timestamp']), dtype=bool)
+        if start is not None:
+            mask &= columns['timestamp'] >= start
+        if end is not None:
+            mask &= columns['timestamp'] < end
+        return {name: column[mask] for name, column in columns.items()}
+
+    # Energy register increments between consecutive samples of the same station
+    def _energy_deltas(self, start: float = None, end: float = None):
+        columns = self._scan(start, end)
+        energy_code = self.dictionaries['measurand'].codes.get(ENERGY_MEASURAND)
+        mask = (columns['measurand'] == energy_code) & (columns['phase'] == 0)
+        timestamp, station, transaction, value = (columns[name][mask] for name in ('timestamp', 'station', 'transaction', 'value'))
+
+        order = np.lexsort((timestamp, station))
+        timestamp, station, transaction, value = timestamp[order], station[order], transaction[order], value[order]
+
+        delta = np.diff(value)
+        # A negative delta means the register was reset, it carries no energy
+        valid = (station[1:] == station[:-1]) & (delta >= 0)
+        same_transaction = valid & (transaction[1:] == transaction[:-1])
+        return timestamp[1:], station[1:], transaction[1:], delta, valid, same_transaction
+
+    def energy_per_transaction(self, start: float = None, end: float = None) -> Dict[str, float]:
+        _, _, transaction, delta, _, same_transaction = self._energy_deltas(start, end)
+        mask = same_transaction & (transaction != 0)
+        totals = np.bincount(transaction[mask], weights=delta[mask], minlength=len(self.dictionaries['transaction'].values))
+        values = self.dictionaries['transaction'].values
+        return {values[code]: float(totals[code] / 1000) for code in np.flatnonzero(totals)}
+
+    def energy_per_site(self, site_of: Callable[[str], str], start: float = None, end: float = None) -> Dict[str, float]:
+        _, station, _, delta, valid, _ = self._energy_deltas(start, end)
+        sites = Dictionary()
+        station_site = np.array([sites.encode(site_of(station_id)) for station_id in self.dictionaries['station'].values], dtype=np.uint32)
+        totals = np.bincount(station_site[station[valid]], weights=delta[valid], minlength=len(sites.values))
+        return {sites.values[code]: float(totals[code] / 1000) for code in np.flatnonzero(totals)}
+
+    def energy_per_hour(self, start: float = None, end: float = None) -> Dict[str, float]:
+        timestamp, _, _, delta, valid, _ = self._energy_deltas(start, end)
+        hours, inverse = np.unique((timestamp[valid] // 3600).astype(np.int64), return_inverse=True)
+        totals = np.bincount(inverse, weights=delta[valid], minlength=len(hours))
+        return {
+            datetime.fromtimestamp(hour * 3600, timezone.utc).strftime('%Y-%m-%dT%H:00:00Z'): float(total / 1000)
+            for hour, total in zip(hours, totals)
+        }
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import math
+from collections import Counter, defaultdict
+from typing import Dict, Tuple
+
+# Sub-buckets per power of two of the histograms: values are kept with a
+# relative error below 1 / SUB_BUCKETS (about 3 %)
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Bucket bounds (seconds) of the exported histograms
+EXPORT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EXPORT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    # HDR-style histogram of durations: log-linear buckets of microseconds,
+    # SUB_BUCKETS linear buckets per power of two, stored sparsely.
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(value: int) -> int:
+        exponent = value.bit_length() - 1
+        if exponent < SUB_BUCKET_BITS:
+            return value
+        return ((exponent - SUB_BUCKET_BITS + 1) << SUB_BUCKET_BITS) | ((value >> (exponent - SUB_BUCKET_BITS)) & (SUB_BUCKETS - 1))
+
+    # Highest value (seconds) counted in a bucket
+    @staticmethod
+    def _upper_bound(index: int) -> float:
+        shift = index >> SUB_BUCKET_BITS
+        if shift == 0:
+            return index / 1e6
+        sub_bucket = (index & (SUB_BUCKETS - 1)) | SUB_BUCKETS
+        return ((sub_bucket + 1) << (shift - 1)) / 1e6
+
+    def record(self, seconds: float):
+        self.buckets[self._index(max(1, int(seconds * 1e6)))] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, quantile: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(quantile * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+    # Cumulative counts at the given bounds
+    def cumulative(self, bounds=EXPORT_BUCKETS) -> list:
+        counts = [0] * len(bounds)
+        for index, count in self.buckets.items():
+            upper_bound = self._upper_bound(index)
+            for i, bound in enumerate(bounds):
+                if upper_bound <= bound:
+                    counts[i] += count
+        return counts
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], **extra) -> str:
+    items = [*labels, *extra.items()]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}' if items else ''
+
+
+class Registry:
+    # Counters and histograms keyed by metric name and label values
+
+    def __init__(self):
+        self.help: Dict[str, str] = {}
+        self.counters: Dict[str, Counter] = defaultdict(Counter)
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = defaultdict(dict)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[name][tuple(labels.items())] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = tuple(labels.items())
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram()
+        histogram.record(seconds)
+
+    # Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for name, values in self.counters.items():
+            lines.append(f'# HELP {name} {self.help.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in values.items():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for name, histograms in self.histograms.items():
+            lines.append(f'# HELP {name} {self.help.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in histograms.items():
+                for bound, count in zip(EXPORT_BUCKETS, histogram.cumulative()):
+                    lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+            # Quantiles of the HDR histograms, more precise than the buckets
+            lines.append(f'# HELP {name}_quantile {self.help.get(name, name)} (quantiles)')
+            lines.append(f'# TYPE {name}_quantile gauge')
+            for labels, histogram in histograms.items():
+                for quantile in EXPORT_QUANTILES:
+                    lines.append(f'{name}_quantile{_format_labels(labels, quantile=quantile)} {histogram.quantile(quantile)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+# Minimal HTTP server answering GET /metrics
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Skip the headers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, UnicodeDecodeError) as e:
+        logging.debug(f'Metrics request failed: {e}')
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_request, host, port)
@@ -0,0 +1,166 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Profiles are written here, named after the time they were taken
+PROFILE_DIR = 'charging/profiles'
+
+# Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# Longest profile that can be requested
+MAX_SECONDS = 300
+
+# Nothing below runs until an operator command asks for it, so profiling
+# costs nothing while it is disabled
+
+_profiling = False
+_last_snapshot = None
+
+
+def _get_filename(extension: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+
+def _frame_name(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}"
+
+
+# Deterministic profile of the event loop thread (cProfile only sees the thread that enabled it)
+async def _run_deterministic(seconds: float, top: int) -> str:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    filename = _get_filename('prof')
+    profiler.dump_stats(filename)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top)
+    return f"Profile written to {filename} (open with pstats or snakeviz)\n{output.getvalue()}"
+
+
+# Sampling profile: a thread records the stack of the event loop thread every
+# SAMPLE_INTERVAL seconds. The loop itself runs unmodified.
+async def _run_sampling(seconds: float, top: int) -> str:
+    loop_thread = threading.get_ident()
+    stacks = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(loop_thread)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, name='profiler-sampler', daemon=True)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        done.set()
+        await asyncio.to_thread(sampler.join)
+
+    # Collapsed stacks, the input format of flamegraph.pl and speedscope
+    filename = _get_filename('folded')
+    with open(filename, 'w') as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+
+    total = sum(stacks.values())
+    own, inclusive = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+
+    lines = [f"{total} samples written to {filename} (collapsed stacks)", "", "Own time:"]
+    lines += [f"{count / total:7.1%}  {frame}" for frame, count in own.most_common(top)]
+    lines += ["", "Including callees:"]
+    lines += [f"{count / total:7.1%}  {frame}" for frame, count in inclusive.most_common(top)]
+    return '\n'.join(lines)
+
+
+async def profile_cpu(seconds: float, mode: str = 'sampling', top: int = 20) -> str:
+    global _profiling
+    if _profiling:
+        return "A profile is already running"
+    if not 0 < seconds <= MAX_SECONDS:
+        return f"Profile length must be between 0 and {MAX_SECONDS} seconds"
+
+    _profiling = True
+    try:
+        if mode == 'deterministic':
+            return await _run_deterministic(seconds, top)
+        return await _run_sampling(seconds, top)
+    finally:
+        _profiling = False
+
+
+def memory_start(frames: int = 10) -> str:
+    global _last_snapshot
+    if tracemalloc.is_tracing():
+        return "Allocation tracing is already running"
+    tracemalloc.start(frames)
+    _last_snapshot = tracemalloc.take_snapshot()
+    return f"Allocation tracing started ({frames} frames per allocation)"
+
+
+# Top allocation sites that grew since the previous snapshot
+def memory_snapshot(top: int = 20) -> str:
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return "Allocation tracing is not running, start it with 'profile mem start'"
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    differences = snapshot.compare_to(_last_snapshot, 'lineno')
+    _last_snapshot = snapshot
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB), top {top} differences:"]
+    lines += [str(difference) for difference in differences[:top]]
+    return '\n'.join(lines)
+
+
+def memory_stop() -> str:
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return "Allocation tracing is not running"
+    tracemalloc.stop()
+    _last_snapshot = None
+    return "Allocation tracing stopped"
+
+
+# Operator command: profile cpu <seconds> [sampling|deterministic] [top] | profile mem <start|snapshot [top]|stop>
+async def handle_command(arguments: list) -> str:
+    try:
+        if arguments[:1] == ['cpu']:
+            mode = arguments[2] if len(arguments) > 2 else 'sampling'
+            if mode not in ('sampling', 'deterministic'):
+                return "Profiler must be 'sampling' or 'deterministic'"
+            return await profile_cpu(float(arguments[1]), mode, int(arguments[3]) if len(arguments) > 3 else 20)
+        if arguments[:2] == ['mem', 'start']:
+            return memory_start(int(arguments[2]) if len(arguments) > 2 else 10)
+        if arguments[:2] == ['mem', 'snapshot']:
+            return memory_snapshot(int(arguments[2]) if len(arguments) > 2 else 20)
+        if arguments[:2] == ['mem', 'stop']:
+            return memory_stop()
+    except (IndexError, ValueError):
+        pass
+    return "Usage: profile cpu <seconds> [sampling|deterministic] [top] | profile mem <start [frames]|snapshot [top]|stop>"
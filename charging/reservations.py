@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from charging.db import save_reservation
+
+# Reservations in these states hold their EVSE
+ACTIVE_STATUSES = ('Pending', 'Accepted')
+
+
+@dataclass
+class Reservation:
+    id: int
+    station: str
+    evse_id: int
+    id_token: Dict
+    expiry: float
+    status: str = 'Pending'
+
+    def save(self):
+        save_reservation(self.id, self.station, self.evse_id, self.id_token['id_token'], self.id_token['type'], self.expiry_date_time, self.status)
+
+    @property
+    def expiry_date_time(self) -> str:
+        return datetime.fromtimestamp(self.expiry, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'station': self.station,
+            'evse_id': self.evse_id,
+            'id_token': self.id_token,
+            'expiry_date_time': self.expiry_date_time,
+            'status': self.status,
+        }
+
+
+class ReservationEngine:
+    # Keeps the active reservations indexed by id, station, (station, EVSE) and
+    # token, and expires them from a single timer heap shared by all stations.
+
+    def __init__(self, next_id: int = 1):
+        self.next_id = next_id
+        self.by_id: Dict[int, Reservation] = {}
+        self.by_evse: Dict[Tuple[str, int], int] = {}
+        self.by_station: Dict[str, Set[int]] = defaultdict(set)
+        self.by_token: Dict[str, Set[int]] = defaultdict(set)
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        # Called with each reservation created or changing status
+        self.listeners: List[Callable[[Reservation], None]] = []
+
+    # Check if the EVSE (or, for evse_id 0, any EVSE of the station) is already reserved
+    def find_conflict(self, station: str, evse_id: int) -> Optional[Reservation]:
+        reservation_id = self.by_evse.get((station, evse_id)) or self.by_evse.get((station, 0))
+        if reservation_id is None and evse_id == 0 and self.by_station.get(station):
+            reservation_id = next(iter(self.by_station[station]))
+        return self.by_id.get(reservation_id)
+
+    # Create a reservation. It is stored with status 'Conflict' (and not indexed) if the EVSE is taken.
+    def reserve(self, station: str, id_token: Dict, expiry: float, evse_id: int = 0, id: int = None) -> Reservation:
+        if id is None:
+            id = self.next_id
+        self.next_id = max(self.next_id, id + 1)
+
+        reservation = Reservation(id, station, evse_id, id_token, expiry)
+        if self.find_conflict(station, evse_id) is not None:
+            reservation.status = 'Conflict'
+            logging.info(f"Reservation {id} for {station} EVSE {evse_id} conflicts with an active one")
+        else:
+            self._index(reservation)
+        reservation.save()
+        self._notify(reservation)
+        return reservation
+
+    # Restore a reservation loaded from the database
+    def restore(self, reservation: Reservation):
+        self.next_id = max(self.next_id, reservation.id + 1)
+        self._index(reservation)
+
+    def _index(self, reservation: Reservation):
+        self.by_id[reservation.id] = reservation
+        self.by_evse[(reservation.station, reservation.evse_id)] = reservation.id
+        self.by_station[reservation.station].add(reservation.id)
+        self.by_token[reservation.id_token['id_token']].add(reservation.id)
+        heapq.heappush(self._heap, (reservation.expiry, reservation.id))
+        # Wake the timer up if this reservation expires before the current head
+        if self._heap[0][1] == reservation.id:
+            self._wakeup.set()
+
+    def _unindex(self, reservation: Reservation):
+        self.by_id.pop(reservation.id, None)
+        self.by_evse.pop((reservation.station, reservation.evse_id), None)
+        self.by_station[reservation.station].discard(reservation.id)
+        if not self.by_station[reservation.station]:
+            del self.by_station[reservation.station]
+        self.by_token[reservation.id_token['id_token']].discard(reservation.id)
+        if not self.by_token[reservation.id_token['id_token']]:
+            del self.by_token[reservation.id_token['id_token']]
+
+    def set_status(self, reservation: Reservation, status: str):
+        reservation.status = status
+        if status not in ACTIVE_STATUSES:
+            self._unindex(reservation)
+        reservation.save()
+        self._notify(reservation)
+
+    def _notify(self, reservation: Reservation):
+        for listener in self.listeners:
+            listener(reservation)
+
+    def cancel(self, reservation_id: int) -> Optional[Reservation]:
+        reservation = self.by_id.get(reservation_id)
+        if reservation is not None:
+            self.set_status(reservation, 'Cancelled')
+        return reservation
+
+    def pending(self, station: str) -> List[Reservation]:
+        return [self.by_id[i] for i in sorted(self.by_station.get(station, ())) if self.by_id[i].status == 'Pending']
+
+    def for_station(self, station: str) -> List[Reservation]:
+        return [self.by_id[i] for i in sorted(self.by_station.get(station, ()))]
+
+    def for_token(self, id_token: str) -> List[Reservation]:
+        return [self.by_id[i] for i in sorted(self.by_token.get(id_token, ()))]
+
+    # Pop every reservation whose expiry is due. Stale heap entries
+    # (cancelled or already finished reservations) are skipped lazily.
+    def expire_due(self, now: float = None) -> List[Reservation]:
+        now = time.time() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expiry, reservation_id = heapq.heappop(self._heap)
+            reservation = self.by_id.get(reservation_id)
+            if reservation is None or reservation.expiry != expiry:
+                continue
+            self.set_status(reservation, 'Expired')
+            expired.append(reservation)
+        return expired
+
+    # Single timer for all reservations: sleep until the earliest expiry or until woken up
+    async def run(self, on_expired: Callable[[Reservation], Awaitable[None]] = None):
+        while True:
+            self._wakeup.clear()
+            for reservation in self.expire_due():
+                logging.info(f"Reservation {reservation.id} for {reservation.station} expired")
+                if on_expired is not None:
+                    await on_expired(reservation)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
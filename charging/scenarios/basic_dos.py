@@ -18,7 +18,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
         
-from charging.client import launch_client, ChargePointClientBase
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, args, configure_tracing
 
 N_INSTANCES = 10_000
 
@@ -58,4 +59,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    use_event_loop(args.loop)
+    configure_tracing('basic_dos')
     asyncio.run(main())
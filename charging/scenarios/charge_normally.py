@@ -18,7 +18,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
 
-from charging.client import launch_client, ChargePointClientBase, wait_for_button_press
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, wait_for_button_press, args, configure_tracing
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -89,6 +90,8 @@ async def charge_normally(cp: ChargePointClientBase):
 
 
 if __name__ == "__main__":
+    use_event_loop(args.loop)
+    configure_tracing('charge_normally')
 
     config = {
         'vendor_name': 'EmuOCPPCharge',
@@ -17,7 +17,8 @@ with open(CONFIG_FILE, "r") as file:
         print('Failed to parse server_config.yaml')
 
 
-from charging.client import launch_client, ChargePointClientBase, wait_for_button_press
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, wait_for_button_press, args, configure_tracing
 from charging.api_client import send_reservation_request
 
 
@@ -70,4 +71,6 @@ async def main():
 
 
 if __name__ == '__main__':
+    use_event_loop(args.loop)
+    configure_tracing('duplicate_charger')
     asyncio.run(main())
@@ -19,7 +19,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
 
-from charging.client import launch_client, ChargePointClientBase
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, args, configure_tracing
 
 # ID of the RFID token used to authenticate
 RFID_TOKEN = '11223344'
@@ -75,4 +76,6 @@ async def main():
     await malicious_client
 
 if __name__ == '__main__':
+    use_event_loop(args.loop)
+    configure_tracing('internal_dos')
     asyncio.run(main())
@@ -16,7 +16,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
 
-from charging.client import launch_client, ChargePointClientBase
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, args, configure_tracing
 
 def _define_parameters():
     ports={
@@ -32,4 +33,6 @@ def _define_parameters():
     asyncio.run(launch_client(**config, **ports))
 
 if __name__ == '__main__':
+    use_event_loop(args.loop)
+    configure_tracing('skip_authetication')
     _define_parameters()
@@ -16,7 +16,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
 
-from charging.client import launch_client
+from charging.loop import use_event_loop
+from charging.client import launch_client, args, configure_tracing
 
 async def main():
     config = {
@@ -32,4 +33,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    use_event_loop(args.loop)
+    configure_tracing('wrong_serial_number')
     asyncio.run(main())
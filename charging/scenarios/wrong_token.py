@@ -17,7 +17,8 @@ with open(CONFIG_FILE, "r") as file:
     except yaml.YAMLError as e:
         print('Failed to parse server_config.yaml')
 
-from charging.client import launch_client, ChargePointClientBase
+from charging.loop import use_event_loop
+from charging.client import launch_client, ChargePointClientBase, args, configure_tracing
 
 async def wrong_token(cp: ChargePointClientBase):
     # Send authorization request
@@ -32,6 +33,8 @@ async def wrong_token(cp: ChargePointClientBase):
 
 
 if __name__ == "__main__":
+    use_event_loop(args.loop)
+    configure_tracing('wrong_token')
 
     config = {
         'vendor_name': 'EmuOCPPCharge',
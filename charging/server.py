@@ -1,5 +1,6 @@
 import ast
 import base64
+import json
 from http import HTTPStatus
 import sys
 import os
@@ -8,6 +9,7 @@ sys.path.append('.')
 import asyncio
 import logging
 import re
+import signal
 import time
 from datetime import datetime, timedelta, timezone 
 from typing import Optional, Dict, Any, List
@@ -29,7 +31,23 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.x509.oid import NameOID
 
 
-from charging.db import get_event, purge_events, auth_user, get_cps
+from charging.db import add_event, get_pending_events, ack_events, compact_events, auth_user, get_cps, add_transaction_event, get_reservations, get_max_reservation_id, flush_writes, use_storage, STORAGES
+from charging.metering import MeterStore
+from charging.reservations import ReservationEngine, Reservation
+from charging.fleet import FleetStatus
+from charging.events import EventBus
+from charging.coalescer import StatusCoalescer
+from charging import idempotency
+from charging import api_server
+from charging.stream import STREAM_TYPES, EventStream
+from charging import metrics
+from charging import lifecycle
+from charging import profiling
+from charging import tracing
+from charging.loop import LOOPS, use_event_loop
+from charging.loop_monitor import LoopMonitor
+from charging.heartbeat import HeartbeatController
+from charging.snapshot import SNAPSHOT_FILE, get_state, save_snapshot, load_snapshot
 
 #import netifaces
 import argparse
@@ -43,12 +61,54 @@ CERTIFICATE_KEY_PATH =  './charging/installedCertificates/server/private_key.pem
 
 # Will be loaded from config.yaml on startup
 VERSION = 'v2.0.1'
-ACCEPTED_TOKENS = []
-ACCEPTED_CHARGES = []
+# (type, id_token) of the accepted tokens
+ACCEPTED_TOKENS = frozenset()
+# (vendor_name, model) -> compiled serial number regexes
+ACCEPTED_CHARGES = {}
 ALLOW_MULTIPLE_SERIAL_NUMBERS = 0
 MAX_CONNECTED_CLIENTS = 100_000
 HEARTBEAT_INTERVAL = 10
+METER_FLUSH_INTERVAL = 10
+RESERVATION_EXPIRY = 3600
+STATUS_COALESCE_WINDOW = 2
+# Seconds acked events are kept, seconds pending events are kept before being
+# dropped (0 keeps them), and seconds/rows of each pass of the event retention
+EVENT_RETENTION = 86400
+EVENT_PENDING_RETENTION = 604800
+EVENT_COMPACT_INTERVAL = 60
+EVENT_COMPACT_BATCH = 10000
+# Stations closed per batch and seconds between batches when draining
+DRAIN_BATCH_SIZE = 50
+DRAIN_BATCH_INTERVAL = 1
+# Seconds between event loop lag samples, and lag reported as a slow callback
+LOOP_LAG_INTERVAL = 0.1
+SLOW_CALLBACK_THRESHOLD = 0.1
+# Port of the Prometheus metrics endpoint
+METRICS_PORT = 9009
+# Port of the HTTP API served in the CSMS event loop (0 disables it, the API
+# then runs as charging/api_server.py), request and keep-alive timeouts
+API_PORT = 0
+API_REQUEST_TIMEOUT = 10
+API_KEEPALIVE_TIMEOUT = 75
+# Share of the OCPP messages traced to charging/traces (0 disables tracing)
+TRACE_SAMPLE_RATE = 0
+# Adaptive heartbeat: heartbeats per second allowed over all stations (0 for
+# no limit, the loop utilisation still stretches the interval), longest
+# interval, loop utilisation above which the interval is stretched, seconds
+# between adjustments and pacing of the updates
+HEARTBEAT_BUDGET = 1000
+HEARTBEAT_MAX_INTERVAL = 3600
+HEARTBEAT_TARGET_UTILISATION = 0.5
+HEARTBEAT_ADAPT_PERIOD = 30
+HEARTBEAT_BATCH_SIZE = 100
+HEARTBEAT_BATCH_INTERVAL = 1
+# (compiled serial number regex, site name)
+SITES = []
 IP = ''
+DNS = None
+EVENT_LOOP = 'asyncio'
+# Backend of charging.db, one of db.STORAGES
+STORAGE = 'sqlite'
 PORT0 = 9000
 PORT1 = 9001
 PORT2 = 9002
@@ -59,8 +119,108 @@ PORT6 = 9006
 PORT7 = 9007
 URL = ''
 
+# Values of the keys that can be reloaded, used when they are not in the
+# config file (also when removed from it while the server runs)
+CONFIG_DEFAULTS = {
+    'call_cache_size': idempotency.CACHE_SIZE,
+    'call_cache_ttl': idempotency.CACHE_TTL,
+    'drain_batch_interval': DRAIN_BATCH_INTERVAL,
+    'drain_batch_size': DRAIN_BATCH_SIZE,
+    'event_compact_batch': EVENT_COMPACT_BATCH,
+    'event_compact_interval': EVENT_COMPACT_INTERVAL,
+    'event_pending_retention': EVENT_PENDING_RETENTION,
+    'event_retention': EVENT_RETENTION,
+    'heartbeat_adapt_period': HEARTBEAT_ADAPT_PERIOD,
+    'heartbeat_batch_interval': HEARTBEAT_BATCH_INTERVAL,
+    'heartbeat_batch_size': HEARTBEAT_BATCH_SIZE,
+    'heartbeat_budget': HEARTBEAT_BUDGET,
+    'heartbeat_max_interval': HEARTBEAT_MAX_INTERVAL,
+    'heartbeat_target_utilisation': HEARTBEAT_TARGET_UTILISATION,
+    'loop_lag_interval': LOOP_LAG_INTERVAL,
+    'meter_flush_interval': METER_FLUSH_INTERVAL,
+    'reservation_expiry': RESERVATION_EXPIRY,
+    'security': {
+        'allow_multiple_serial_numbers': ALLOW_MULTIPLE_SERIAL_NUMBERS,
+        'heartbeat_interval': HEARTBEAT_INTERVAL,
+        'max_connected_clients': MAX_CONNECTED_CLIENTS,
+    },
+    'slow_callback_threshold': SLOW_CALLBACK_THRESHOLD,
+    'status_coalesce_window': STATUS_COALESCE_WINDOW,
+    'trace_sample_rate': TRACE_SAMPLE_RATE,
+}
+
 # Holds ID and instance of all connected clients
 connected_clients = []
+# Last connected instance of each CP by ID
+connected_index = {}
+
+# Websocket servers (stations, then operator), closed when draining
+servers = []
+draining = False
+# State of the stations of a drained server, by ID, until they reconnect
+warm_states = {}
+
+# Sampled meter values of all stations
+meter_store = MeterStore()
+
+# Active reservations of all stations, expired from a single timer
+reservation_engine = ReservationEngine()
+
+# Connector status of all stations with aggregated counters
+fleet_status = FleetStatus()
+
+# Station events published to the in-process consumers
+event_bus = EventBus()
+
+# Set when new events are committed, so the dispatcher does not wait for its next poll
+dispatch_wakeup = asyncio.Event()
+
+# Station events streamed to the API clients
+event_stream = EventStream(site_of=lambda serial_number: _get_site(serial_number))
+
+
+# Publish a coalesced connector status change
+def _publish_status(key: tuple, update: dict):
+    station, evse_id, connector_id = key
+    logging.info(f'Connector {connector_id} of EVSE {evse_id} of {station} is {update["status"]}')
+    if update['error_code'] not in (None, 'NoError'):
+        logging.error(f'Problem with connector {connector_id} of {station} with error: {update["error_code"]}')
+    event_bus.publish('status_notification', station, {'evse_id': evse_id, 'connector_id': connector_id, **update})
+
+# Collapses bursts of StatusNotification per connector before publishing them
+status_coalescer = StatusCoalescer(STATUS_COALESCE_WINDOW, _publish_status)
+
+metrics.registry.help.update({
+    'ocpp_calls_total': 'OCPP calls handled (in) and sent (out) by action, version, security profile and result',
+    'ocpp_call_duration_seconds': 'Time to answer a call of a station (in) or to get the answer of a station (out)',
+})
+
+# Event loop lag and callbacks blocking the loop
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, SLOW_CALLBACK_THRESHOLD)
+
+# Heartbeat interval given to the stations, adapted to the load
+heartbeat_controller = HeartbeatController(HEARTBEAT_INTERVAL, HEARTBEAT_MAX_INTERVAL, HEARTBEAT_BUDGET, HEARTBEAT_TARGET_UTILISATION)
+
+
+def _update_fleet_status(event_type: str, station: str, data: dict):
+    fleet_status.update_connector(station, data['evse_id'], data['connector_id'], data['status'])
+
+def _persist_event(event_type: str, station: str, data: dict):
+    # Already consumed by the in-process subscribers, stored for history and
+    # for the event stream, which reads it once committed
+    add_event(event_type, station, data, status='acked').add_done_callback(lambda _: event_stream.notify())
+
+def _publish_reservation(reservation: Reservation):
+    event_bus.publish('reservation_status', reservation.station, reservation.to_dict())
+
+# Record a transaction event in the ledger and publish it
+def _record_transaction_event(transaction_id, station: str, event_type: str, seq_no: int = 0, timestamp: str = None,
+                              id_token: str = None, meter: float = None):
+    add_transaction_event(transaction_id, station, event_type, seq_no, timestamp, id_token=id_token, meter=meter)
+    event_bus.publish('transaction_event', station, {
+        'transaction_id': str(transaction_id), 'event_type': event_type, 'seq_no': seq_no, 'timestamp': timestamp,
+        'id_token': id_token, 'meter': meter,
+    })
 
 # Create the parser
 parser = argparse.ArgumentParser(description="Process command-line arguments for server script") 
@@ -74,6 +234,7 @@ parser.add_argument('-url', type=str, required=False, help="URL to give to the D
 parser.add_argument('-multiple', type=int, required=False, help="Allow multiple serial numbers -> 0 (No) | 1 (Yes) | 2 (No, but allows to steal)")
 parser.add_argument('-max_connected', type=int, required=False, help="Maximum number of simultaneous clients connected to the server (e.g., 500)")
 parser.add_argument('-heartbeat', type=int, required=False, help="Heartbeat interval (e.g., 10)")
+parser.add_argument('-loop', type=str, required=False, choices=LOOPS, help="Event loop -> 'asyncio' or 'uvloop'")
 
 # Parse the arguments
 args = parser.parse_args()
@@ -98,6 +259,23 @@ def _get_personal_message(message: str) -> dict:
 
 
 
+# Return the last energy register reading (in Wh) of a MeterValue list
+def _get_energy_register(meter_value: Optional[List]) -> Optional[float]:
+    reading = None
+    for value in meter_value or []:
+        for sample in value.get('sampled_value', []):
+            if sample.get('measurand', 'Energy.Active.Import.Register') != 'Energy.Active.Import.Register':
+                continue
+            reading = float(sample['value'])
+            # 2.x carries a power of ten multiplier, 1.6 may report kWh
+            unit = sample.get('unit_of_measure', {})
+            reading *= 10 ** unit.get('multiplier', 0)
+            if unit.get('unit', sample.get('unit', 'Wh')) == 'kWh':
+                reading *= 1000
+    return reading
+
+
+
 # Check if user can be authorized
 def _check_authorized(id_token: Dict) -> str:
     # Check if type is correct
@@ -134,9 +312,8 @@ def _check_authorized(id_token: Dict) -> str:
         return 'Unknown'
 
     # Check if token is in allowed list
-    for i in ACCEPTED_TOKENS:
-        if i['type'] == id_token['type'] and i['id_token'] == id_token['id_token']:
-            return 'Accepted'
+    if (id_token['type'], id_token['id_token']) in ACCEPTED_TOKENS:
+        return 'Accepted'
 
     # If no matching token was found in list
     return 'Invalid'
@@ -145,21 +322,212 @@ def _check_authorized(id_token: Dict) -> str:
 
 # Check if new CP is authorized based on vendor, model and serial number
 def _check_charger(vendor_name: str, model: str, serial_number: str, password: str = None, certificate: str = None) -> bool:
-    for i in ACCEPTED_CHARGES:
-        # Check if vendor_name and model match
-        if i['vendor_name'] == vendor_name and i['model'] == model:
-            # Check if regex matches
-            if re.match(i['serial_number_regex'], serial_number):
-                return True
+    # Check if regex of the vendor_name and model matches
+    for regex in ACCEPTED_CHARGES.get((vendor_name, model), ()):
+        if regex.match(serial_number):
+            return True
     # If no model match, return False
     return False
 
-def load_config() -> bool:
+# Get the security profile of the server listening on a port
+def _get_security_profile(port: int) -> int:
+    if port in (PORT0, PORT4):
+        return 0
+    elif port in (PORT1, PORT5):
+        return 1
+    elif port in (PORT2, PORT6):
+        return 2
+    elif port in (PORT3, PORT7):
+        return 3
+    return 0
+
+# Get the site a CP belongs to, based on the serial number regex of each site
+def _get_site(serial_number: str) -> str:
+    for regex, name in SITES:
+        if regex.match(serial_number):
+            return name
+    return 'default'
+
+# Read the config file, validate it and build the lookup indexes of tokens,
+# chargers and sites. Raises ValueError if the file is not valid.
+def _read_config() -> tuple:
+    with open(CONFIG_FILE, "r") as file:
+        try:
+            # Parse YAML content
+            content = yaml.safe_load(file)
+        except yaml.YAMLError as e:
+            raise ValueError(f'Failed to parse {CONFIG_FILE}: {e}')
+
+    if not isinstance(content, dict):
+        raise ValueError(f'{CONFIG_FILE} is empty or not a mapping')
+
+    indexes = {}
+    try:
+        if "accepted_tokens" in content:
+            indexes['tokens'] = frozenset((i['type'], i['id_token']) for i in content["accepted_tokens"] or [])
+
+        if "accepted_chargers" in content:
+            chargers = {}
+            for i in content["accepted_chargers"] or []:
+                chargers.setdefault((i['vendor_name'], i['model']), []).append(re.compile(i['serial_number_regex']))
+            indexes['chargers'] = chargers
+
+        if "sites" in content:
+            indexes['sites'] = [(re.compile(site['serial_number_regex']), site['name']) for site in content["sites"] or []]
+    except (KeyError, TypeError, re.error) as e:
+        raise ValueError(f'Invalid token, charger or site in {CONFIG_FILE}: {e!r}')
+
+    security = content.get("security") or {}
+    for key in ("allow_multiple_serial_numbers", "max_connected_clients", "heartbeat_interval"):
+        if key in security and (not isinstance(security[key], int) or security[key] < 0):
+            raise ValueError(f'security.{key} must be a non-negative integer')
+    if security.get("heartbeat_interval", 1) == 0:
+        raise ValueError('security.heartbeat_interval must be a positive integer')
+    if content.get("event_loop", 'asyncio') not in LOOPS:
+        raise ValueError(f'event_loop must be one of {", ".join(LOOPS)}')
+    if content.get("storage", 'sqlite') not in STORAGES:
+        raise ValueError(f'storage must be one of {", ".join(STORAGES)}')
+    if security.get("allow_multiple_serial_numbers", 0) not in (0, 1, 2):
+        raise ValueError('security.allow_multiple_serial_numbers must be 0, 1 or 2')
+    # 0 disables or means "at once" for these
+    for key in ("status_coalesce_window", "call_cache_size", "call_cache_ttl", "drain_batch_interval", "trace_sample_rate",
+                "heartbeat_budget", "heartbeat_batch_interval", "event_retention", "event_pending_retention", "api_port"):
+        if key in content and (not isinstance(content[key], (int, float)) or content[key] < 0):
+            raise ValueError(f'{key} must be a non-negative number')
+    for key in ("meter_flush_interval", "reservation_expiry", "drain_batch_size", "loop_lag_interval", "slow_callback_threshold",
+                "heartbeat_max_interval", "heartbeat_target_utilisation", "heartbeat_adapt_period", "heartbeat_batch_size",
+                "event_compact_interval", "event_compact_batch", "api_request_timeout", "api_keepalive_timeout"):
+        if key in content and (not isinstance(content[key], (int, float)) or content[key] <= 0):
+            raise ValueError(f'{key} must be a positive number')
+
+    return content, indexes
+
+# Set the values that can change while the server is running
+def _apply_config(content: dict, indexes: dict):
     global ACCEPTED_TOKENS
     global ACCEPTED_CHARGES
     global ALLOW_MULTIPLE_SERIAL_NUMBERS
     global MAX_CONNECTED_CLIENTS
     global HEARTBEAT_INTERVAL
+    global SITES
+    global METER_FLUSH_INTERVAL
+    global RESERVATION_EXPIRY
+    global STATUS_COALESCE_WINDOW
+    global EVENT_RETENTION
+    global EVENT_PENDING_RETENTION
+    global EVENT_COMPACT_INTERVAL
+    global EVENT_COMPACT_BATCH
+    global DRAIN_BATCH_SIZE
+    global DRAIN_BATCH_INTERVAL
+    global LOOP_LAG_INTERVAL
+    global SLOW_CALLBACK_THRESHOLD
+    global TRACE_SAMPLE_RATE
+    global HEARTBEAT_BUDGET
+    global HEARTBEAT_MAX_INTERVAL
+    global HEARTBEAT_TARGET_UTILISATION
+    global HEARTBEAT_ADAPT_PERIOD
+    global HEARTBEAT_BATCH_SIZE
+    global HEARTBEAT_BATCH_INTERVAL
+
+    # Missing keys get their default
+    security = {**CONFIG_DEFAULTS['security'], **(content.get("security") or {})}
+    content = {**CONFIG_DEFAULTS, **content, 'security': security}
+
+    # Set accepted tokens
+    ACCEPTED_TOKENS = indexes.get("tokens", frozenset())
+
+    # Set accepted chargers
+    ACCEPTED_CHARGES = indexes.get("chargers", {})
+
+    # Set sites the chargers are grouped in
+    SITES = indexes.get("sites", [])
+
+    if "meter_flush_interval" in content:
+        METER_FLUSH_INTERVAL = content["meter_flush_interval"]
+
+    if "reservation_expiry" in content:
+        RESERVATION_EXPIRY = content["reservation_expiry"]
+
+    # Set event retention
+    if "event_retention" in content:
+        EVENT_RETENTION = int(content["event_retention"])
+
+    if "event_pending_retention" in content:
+        EVENT_PENDING_RETENTION = int(content["event_pending_retention"])
+
+    if "event_compact_interval" in content:
+        EVENT_COMPACT_INTERVAL = max(1, content["event_compact_interval"])
+
+    if "event_compact_batch" in content:
+        EVENT_COMPACT_BATCH = max(1, int(content["event_compact_batch"]))
+
+    if "status_coalesce_window" in content:
+        STATUS_COALESCE_WINDOW = content["status_coalesce_window"]
+        status_coalescer.window = STATUS_COALESCE_WINDOW
+
+    if "drain_batch_size" in content:
+        DRAIN_BATCH_SIZE = max(1, content["drain_batch_size"])
+
+    if "drain_batch_interval" in content:
+        DRAIN_BATCH_INTERVAL = content["drain_batch_interval"]
+
+    if "loop_lag_interval" in content:
+        LOOP_LAG_INTERVAL = content["loop_lag_interval"]
+        loop_monitor.interval = LOOP_LAG_INTERVAL
+
+    if "slow_callback_threshold" in content:
+        SLOW_CALLBACK_THRESHOLD = content["slow_callback_threshold"]
+        loop_monitor.threshold = SLOW_CALLBACK_THRESHOLD
+
+    if "trace_sample_rate" in content:
+        TRACE_SAMPLE_RATE = min(1, content["trace_sample_rate"])
+        tracing.SAMPLE_RATE = TRACE_SAMPLE_RATE
+
+    # Set cache of answers to retransmitted calls (applies to new caches)
+    if "call_cache_size" in content:
+        idempotency.CACHE_SIZE = content["call_cache_size"]
+
+    if "call_cache_ttl" in content:
+        idempotency.CACHE_TTL = content["call_cache_ttl"]
+
+    # Set security parameters
+    if content.get("security"):
+        if "allow_multiple_serial_numbers" in content["security"]:
+            ALLOW_MULTIPLE_SERIAL_NUMBERS = content["security"]["allow_multiple_serial_numbers"]
+
+        if "max_connected_clients" in content["security"]:
+            MAX_CONNECTED_CLIENTS = content["security"]["max_connected_clients"]
+
+        if "heartbeat_interval" in content["security"]:
+            HEARTBEAT_INTERVAL = content["security"]["heartbeat_interval"]
+
+    # Set adaptive heartbeat parameters
+    if "heartbeat_budget" in content:
+        HEARTBEAT_BUDGET = content["heartbeat_budget"]
+
+    if "heartbeat_max_interval" in content:
+        HEARTBEAT_MAX_INTERVAL = content["heartbeat_max_interval"]
+
+    if "heartbeat_target_utilisation" in content:
+        HEARTBEAT_TARGET_UTILISATION = content["heartbeat_target_utilisation"]
+
+    if "heartbeat_adapt_period" in content:
+        HEARTBEAT_ADAPT_PERIOD = max(1, content["heartbeat_adapt_period"])
+
+    if "heartbeat_batch_size" in content:
+        HEARTBEAT_BATCH_SIZE = max(1, content["heartbeat_batch_size"])
+
+    if "heartbeat_batch_interval" in content:
+        HEARTBEAT_BATCH_INTERVAL = content["heartbeat_batch_interval"]
+
+    heartbeat_controller.min_interval = HEARTBEAT_INTERVAL
+    heartbeat_controller.max_interval = max(HEARTBEAT_INTERVAL, HEARTBEAT_MAX_INTERVAL)
+    # Given to the stations booting before the next adjustment
+    heartbeat_controller.interval = min(heartbeat_controller.max_interval, max(HEARTBEAT_INTERVAL, heartbeat_controller.interval))
+    heartbeat_controller.budget = HEARTBEAT_BUDGET
+    heartbeat_controller.target_utilisation = HEARTBEAT_TARGET_UTILISATION
+
+def load_config() -> bool:
     global IP
     global PORT0
     global PORT1
@@ -171,70 +539,105 @@ def load_config() -> bool:
     global PORT7
     global URL
     global DNS
+    global EVENT_LOOP
+    global STORAGE
+    global METRICS_PORT
+    global API_PORT
+    global API_REQUEST_TIMEOUT
+    global API_KEEPALIVE_TIMEOUT
 
-    # Open server config file
-    with open(CONFIG_FILE, "r") as file:
-        try:
-            # Parse YAML content
-            content = yaml.safe_load(file)
+    try:
+        content, indexes = _read_config()
+    except (OSError, ValueError) as e:
+        print(e)
+        return False
 
-            if "ip" in content:
-                IP = content["ip"]
+    if "ip" in content:
+        IP = content["ip"]
 
-            if "port0" in content:
-                PORT0 = content["port0"]
+    if "port0" in content:
+        PORT0 = content["port0"]
 
-            if "port1" in content:
-                PORT1 = content["port1"]
-            
-            if "port2" in content:
-                PORT2 = content["port2"]
+    if "port1" in content:
+        PORT1 = content["port1"]
+    
+    if "port2" in content:
+        PORT2 = content["port2"]
 
-            if "port3" in content:
-                PORT3 = content["port3"]
+    if "port3" in content:
+        PORT3 = content["port3"]
 
-            if "port4" in content:
-                PORT4 = content["port4"]
+    if "port4" in content:
+        PORT4 = content["port4"]
 
-            if "port5" in content:
-                PORT5 = content["port5"]
-            
-            if "port6" in content:
-                PORT6 = content["port6"]
+    if "port5" in content:
+        PORT5 = content["port5"]
+    
+    if "port6" in content:
+        PORT6 = content["port6"]
 
-            if "port7" in content:
-                PORT7 = content["port7"]
-            
-            if "url" in content:
-                URL = content["url"]
+    if "port7" in content:
+        PORT7 = content["port7"]
+    
+    if "url" in content:
+        URL = content["url"]
 
-            if "dns" in content:
-                DNS = content["dns"]
+    if "dns" in content:
+        DNS = content["dns"]
 
-            # Set accepted tokens
-            if "accepted_tokens" in content:
-                ACCEPTED_TOKENS = content["accepted_tokens"]
+    if "event_loop" in content:
+        EVENT_LOOP = content["event_loop"]
 
-            # Set accepted chargers
-            if "accepted_chargers" in content:
-                ACCEPTED_CHARGES = content["accepted_chargers"]
+    if "storage" in content:
+        STORAGE = content["storage"]
 
-            # Set security parameters
-            if "security" in content:
-                if "allow_multiple_serial_numbers" in content["security"]:
-                    ALLOW_MULTIPLE_SERIAL_NUMBERS = content["security"]["allow_multiple_serial_numbers"]
+    if "metrics_port" in content:
+        METRICS_PORT = content["metrics_port"]
 
-                if "max_connected_clients" in content["security"]:
-                    MAX_CONNECTED_CLIENTS = content["security"]["max_connected_clients"]
+    if "api_port" in content:
+        API_PORT = int(content["api_port"])
 
-                if "heartbeat_interval" in content["security"]:
-                    HEARTBEAT_INTERVAL = content["security"]["heartbeat_interval"]
+    if "api_request_timeout" in content:
+        API_REQUEST_TIMEOUT = content["api_request_timeout"]
 
-        except yaml.YAMLError as e:
-            print('Failed to parse server_config.yaml')
-            return False
+    if "api_keepalive_timeout" in content:
+        API_KEEPALIVE_TIMEOUT = content["api_keepalive_timeout"]
+
+    _apply_config(content, indexes)
+    return True
 
-        return True
+# Reload the config file without restarting. Parsing and index building run
+# in a thread; the new values are swapped in at once, or not at all if the
+# file is not valid. Addresses, ports, the event loop, the storage and the API
+# settings need a restart and are kept.
+async def reload_config(reason: str) -> str:
+    try:
+        content, indexes = await asyncio.to_thread(_read_config)
+    except (OSError, ValueError) as e:
+        logging.error(f"Config reload ({reason}) rejected, keeping current config: {e}")
+        return f"Config reload failed: {e}"
+
+    current = {'ip': IP, 'url': URL, 'dns': DNS, 'event_loop': EVENT_LOOP, 'storage': STORAGE, 'metrics_port': METRICS_PORT, 'api_port': API_PORT, 'api_request_timeout': API_REQUEST_TIMEOUT, 'api_keepalive_timeout': API_KEEPALIVE_TIMEOUT, **{f'port{i}': port for i, port in enumerate((PORT0, PORT1, PORT2, PORT3, PORT4, PORT5, PORT6, PORT7))}}
+    ignored = [key for key, value in current.items() if key in content and content[key] != value]
+    if ignored:
+        logging.warning(f"Config reload ({reason}): {', '.join(ignored)} changed but need a restart")
+
+    _apply_config(content, indexes)
+    logging.info(f"Config reloaded ({reason})")
+    return "Config reloaded" + (f", restart needed for {', '.join(ignored)}" if ignored else "")
+
+# Reload the config when the file changes
+async def _watch_config(interval: int = 2):
+    last_modified = os.stat(CONFIG_FILE).st_mtime_ns
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            modified = os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            continue
+        if modified != last_modified:
+            last_modified = modified
+            await reload_config('file changed')
 
 def load_address(interface: str = 'ens33'):
     return "127.0.0.1"
@@ -271,6 +674,8 @@ def configuration():
         config['url'] = args.url
     if args.dns != None:
         config['dns'] = args.dns
+    if args.loop != None:
+        config['event_loop'] = args.loop
 
     with open(CONFIG_FILE, 'w') as file:
         yaml.safe_dump(config, file, default_flow_style=False)
@@ -278,14 +683,19 @@ def configuration():
 
 async def main():
 
-    configuration()
+    # Start event loop lag probe
+    asyncio.create_task(loop_monitor.run())
 
-    # Load config file
-    if not load_config():
-        quit(1)
+    # Start adaptive heartbeat
+    asyncio.create_task(_adapt_heartbeat())
+
+    # Start Prometheus metrics endpoint
+    await metrics.serve(IP, METRICS_PORT)
 
-    # Purge DB
-    purge_events()
+    # Warm start from the state left by a drained server
+    warm_states.update(load_snapshot())
+    if warm_states:
+        logging.info(f"Warm start with the state of {len(warm_states)} stations")
 
     
     # Check certificate
@@ -359,44 +769,72 @@ async def main():
     context3.check_hostname = True 
     context3.verify_mode = ssl.CERT_REQUIRED
 
+    # Start background writer of meter values
+    asyncio.create_task(_flush_meter_values())
+
+    # Start status notification pipeline
+    event_bus.subscribe('status_notification', _update_fleet_status)
+    for event_type in STREAM_TYPES:
+        event_bus.subscribe(event_type, _persist_event)
+    reservation_engine.listeners.append(_publish_reservation)
+    asyncio.create_task(status_coalescer.run())
+
+    # Reload the config on file change and on SIGHUP, drain on SIGTERM
+    asyncio.create_task(_watch_config())
+    if hasattr(signal, 'SIGHUP'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload_config('SIGHUP')))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(drain('SIGTERM')))
+
+    # Start reservation dispatcher and expiry timer
+    _load_reservations()
+    asyncio.create_task(_dispatch_events())
+    asyncio.create_task(_compact_events())
+    asyncio.create_task(reservation_engine.run())
+
+    # Start the HTTP API in this event loop, new events wake the dispatcher at once
+    if API_PORT:
+        await api_server.serve(IP, API_PORT, keepalive_timeout=API_KEEPALIVE_TIMEOUT, operator=_api_operator,
+                               notify=dispatch_wakeup.set, request_timeout=API_REQUEST_TIMEOUT, stream=event_stream,
+                               conflict=lambda station, evse_id: reservation_engine.find_conflict(station, evse_id) is not None)
+
     # Start websocket with callback function
     server_zero = await websockets.serve(
-        on_connect, IP, PORT0, subprotocols=[Subprotocol("ocpp1.6")]
+        on_connect, IP, PORT0, subprotocols=[Subprotocol("ocpp1.6")], create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
     server_one = await websockets.serve(
-        on_connect, IP, PORT1, subprotocols=[Subprotocol("ocpp1.6")], process_request=make_process_request(passwordType = 'Hex')
+        on_connect, IP, PORT1, subprotocols=[Subprotocol("ocpp1.6")], process_request=make_process_request(passwordType = 'Hex'), create_protocol=lifecycle.TimedServerProtocol
     )
     
     # Start websocket with callback function
     server_two = await websockets.serve(
-        on_connect, IP, PORT2, subprotocols=[Subprotocol("ocpp1.6")], process_request=make_process_request(passwordType = 'Hex'), ssl = context2
+        on_connect, IP, PORT2, subprotocols=[Subprotocol("ocpp1.6")], process_request=make_process_request(passwordType = 'Hex'), ssl = context2, create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
     server_three = await websockets.serve(
-        on_connect, IP, PORT3, subprotocols=[Subprotocol("ocpp1.6")], ssl = context3
+        on_connect, IP, PORT3, subprotocols=[Subprotocol("ocpp1.6")], ssl = context3, create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
     server_four = await websockets.serve(
-        on_connect, IP, PORT4, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")]
+        on_connect, IP, PORT4, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
     server_five = await websockets.serve(
-        on_connect, IP, PORT5, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], process_request=make_process_request(passwordType = 'nonHex')
+        on_connect, IP, PORT5, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], process_request=make_process_request(passwordType = 'nonHex'), create_protocol=lifecycle.TimedServerProtocol
     )
     
     # Start websocket with callback function
     server_six = await websockets.serve(
-        on_connect, IP, PORT6, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], process_request=make_process_request(passwordType = 'nonHex'), ssl = context2
+        on_connect, IP, PORT6, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], process_request=make_process_request(passwordType = 'nonHex'), ssl = context2, create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
     server_seven = await websockets.serve(
-        on_connect, IP, PORT7, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], ssl = context3
+        on_connect, IP, PORT7, subprotocols=[Subprotocol("ocpp2.0.1"), Subprotocol("ocpp2.0")], ssl = context3, create_protocol=lifecycle.TimedServerProtocol
     )
 
     # Start websocket with callback function
@@ -404,6 +842,8 @@ async def main():
         on_operator, IP, 9008
     )
 
+    servers.extend([server_zero, server_one, server_two, server_three, server_four, server_five, server_six, server_seven, server_eight])
+
     # Wait for server to be closed down
     await server_zero.wait_closed()
     await server_one.wait_closed()
@@ -415,7 +855,201 @@ async def main():
     await server_seven.wait_closed()
     await server_eight.wait_closed()
 
+
+
+# Stop accepting stations and write a snapshot of their state for the next
+# process, then close them in paced batches so they do not all reconnect
+# (and boot) at the same time. The server stops once every station is closed.
+async def drain(reason: str) -> str:
+    global draining
+    if draining:
+        return "Already draining"
+    draining = True
+    logging.info(f"Draining ({reason}), no longer accepting connections")
+
+    # Close the listening sockets of the station servers, keep their connections
+    for server in servers[:-1]:
+        server.server.close()
+
+    states = {cp_id: get_state(cp, fleet_status.stations.get(cp_id)) for cp_id, cp in connected_index.items()}
+    try:
+        count = await asyncio.to_thread(save_snapshot, states)
+        await asyncio.to_thread(meter_store.flush)
+        await asyncio.to_thread(flush_writes)
+    except OSError as e:
+        logging.error(f"Failed to write snapshot: {e}")
+        count = 0
+    logging.info(f"Snapshot of {count} stations written to {SNAPSHOT_FILE}")
+
+    asyncio.create_task(_close_stations())
+    return f"Draining, snapshot of {count} stations written to {SNAPSHOT_FILE}"
+
+async def _close_stations():
+    stations = [cp for _, cp, _ in connected_clients]
+    for i in range(0, len(stations), DRAIN_BATCH_SIZE):
+        # 1012: service restart, the station should reconnect
+        await asyncio.gather(*(cp._connection.close(1012, 'Service restart') for cp in stations[i:i + DRAIN_BATCH_SIZE]), return_exceptions=True)
+        logging.info(f"Drain: closed {min(i + DRAIN_BATCH_SIZE, len(stations))}/{len(stations)} stations")
+        await asyncio.sleep(DRAIN_BATCH_INTERVAL)
+    for server in servers:
+        server.close()
+
+# Adapt the heartbeat interval to the number of stations and the loop
+# utilisation, and push it to the stations in paced batches. Stations that
+# were not reached are updated on the next rounds.
+async def _adapt_heartbeat():
+    heartbeat_controller.sample_utilisation()
+    while True:
+        await asyncio.sleep(HEARTBEAT_ADAPT_PERIOD)
+        stations = len(connected_index)
+        if heartbeat_controller.update(stations):
+            logging.info(f"Heartbeat interval set to {heartbeat_controller.interval} s for {stations} stations (loop utilisation {heartbeat_controller.utilisation:.0%})")
+
+        interval = heartbeat_controller.interval
+        pending = [cp for cp in connected_index.values() if cp.is_booted and cp.heartbeat_interval != interval]
+        for i in range(0, len(pending), HEARTBEAT_BATCH_SIZE):
+            results = await asyncio.gather(*(cp.send_heartbeat_interval(interval) for cp in pending[i:i + HEARTBEAT_BATCH_SIZE]), return_exceptions=True)
+            rejected = sum(result is not True for result in results)
+            if rejected:
+                logging.warning(f"{rejected} stations did not accept heartbeat interval {interval} s")
+            await asyncio.sleep(HEARTBEAT_BATCH_INTERVAL)
+
+# Give a reconnecting station back the state it had before the restart
+def _restore_state(cp, state: dict):
+    for field in ('serial_number', 'is_booted', 'is_authorized', 'charging_state', 'last_reservation_id', 'transaction_counter', 'current_transaction_id'):
+        if state.get(field) is not None:
+            setattr(cp, field, state[field])
+    if state.get('model') is not None:
+        # Sites are matched by serial number, 2.x stations connect with another ID
+        fleet_status.register_station(cp.id, _get_site(cp.serial_number or cp.id), state['model'], state['version'])
+    logging.info(f"Restored state of {cp.id} from snapshot")
+
         
+# Remove old events in small batches so the Events table does not grow
+# forever and no write transaction holds the database for long
+async def _compact_events():
+    while True:
+        await asyncio.sleep(EVENT_COMPACT_INTERVAL)
+        acked = expired = 0
+        while True:
+            try:
+                counts = await asyncio.to_thread(compact_events, EVENT_RETENTION, EVENT_PENDING_RETENTION, EVENT_COMPACT_BATCH)
+            except AttributeError as e:
+                logging.error(f"Failed to compact events: {e}")
+                break
+            acked, expired = acked + counts[0], expired + counts[1]
+            if sum(counts) < EVENT_COMPACT_BATCH:
+                break
+            # Let the batch writer commit before the next batch
+            await asyncio.to_thread(flush_writes)
+        if expired:
+            logging.warning(f"Dropped {expired} events pending for more than {EVENT_PENDING_RETENTION} s")
+        if acked:
+            logging.info(f"Removed {acked} acked events older than {EVENT_RETENTION} s")
+
+
+# Periodically write buffered meter values to segment files
+async def _flush_meter_values():
+    while True:
+        await asyncio.sleep(METER_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(meter_store.flush)
+        except OSError as e:
+            logging.error(f"Failed to flush meter values: {e}")
+
+
+# Load the reservations that were still active when the server stopped
+def _load_reservations():
+    reservation_engine.next_id = get_max_reservation_id() + 1
+    for status in ('Pending', 'Accepted'):
+        for data in get_reservations(status=status, limit=-1):
+            expiry = datetime.fromisoformat(data['expiry_date_time'].replace('Z', '+00:00')).timestamp()
+            reservation_engine.restore(Reservation(data['id'], data['station'], data['evse_id'], data['id_token'], expiry, status))
+
+
+# Send a reservation to the CP and store the status it answered with
+async def _deliver_reservation(cp, reservation: Reservation):
+    try:
+        response = await cp.send_reserve_now(
+            id=reservation.id,
+            expiry_date_time=reservation.expiry_date_time,
+            id_token=reservation.id_token,
+            evse_id=reservation.evse_id
+        )
+    except Exception as e:
+        logging.error(f"Failed to send reservation {reservation.id} to {reservation.station}: {e}")
+        return
+
+    # Ignore the answer if the reservation was cancelled or expired meanwhile
+    if reservation.status != 'Pending':
+        return
+    reservation_engine.set_status(reservation, response.status if response != None else 'Rejected')
+    cp.last_reservation_id = reservation.id
+
+
+# Handle one reservation event
+def _handle_event(event_type: str, target: str, data: dict):
+    if event_type == 'reserve_now':
+        if 'expiry' in data:
+            expiry = datetime.fromisoformat(data['expiry'].replace('Z', '+00:00')).timestamp()
+        else:
+            expiry = time.time() + RESERVATION_EXPIRY
+        token = {'type': data['type'], 'id_token': data['id_token']}
+        reservation = reservation_engine.reserve(target, token, expiry, evse_id=int(data.get('evse_id', 0)))
+
+        # Deliver now if the CP is connected, otherwise once it boots
+        cp = connected_index.get(target)
+        if reservation.status == 'Pending' and cp != None and cp.is_booted:
+            asyncio.create_task(_deliver_reservation(cp, reservation))
+
+    elif event_type == 'cancel_reservation':
+        reservation = reservation_engine.by_id.get(data['id'])
+        if reservation is None:
+            logging.info(f"Reservation {data['id']} is not active, nothing to cancel")
+            return
+        delivered = reservation.status == 'Accepted'
+        reservation_engine.cancel(reservation.id)
+
+        cp = connected_index.get(reservation.station)
+        if delivered and cp != None:
+            asyncio.create_task(cp.send_cancel_reservation(reservation.id))
+
+
+# Consume reservation events for all stations with a single poller. Events
+# are acked once handled, so the ones left pending when the server stopped
+# are handled on the next start. An event that fails is logged and acked
+# too, it would fail again on every start otherwise.
+async def _dispatch_events(interval: int = 1, batch: int = 1000):
+    # Acks are committed by the batch writer, skip the events already read meanwhile
+    last_event_id = 0
+    while True:
+        try:
+            events = await asyncio.to_thread(get_pending_events, ('reserve_now', 'cancel_reservation'), last_event_id, batch)
+        except AttributeError as e:
+            logging.error(f"Failed to read events: {e}")
+            events = []
+        for event_id, event_type, target, data in events:
+            last_event_id = event_id
+            logging.info(f"Processing event {event_type} for {target} with data {data}")
+            try:
+                _handle_event(event_type, target, data)
+            except Exception:
+                logging.exception(f"Failed to process event {event_id} {event_type} for {target}, dropping it")
+
+        if events:
+            ack_events([event[0] for event in events])
+
+        # Keep draining without sleeping while there is a backlog, letting
+        # the stations run between pages
+        if len(events) < batch:
+            try:
+                await asyncio.wait_for(dispatch_wakeup.wait(), interval)
+            except TimeoutError:
+                pass
+            dispatch_wakeup.clear()
+        else:
+            await asyncio.sleep(0)
+
 
 # Define a base class with common functionality
 class ChargePointServerBase:
@@ -433,49 +1067,73 @@ class ChargePointServerBase:
 
     last_reservation_id = 0
     transaction_counter = 0
+    current_transaction_id = None
+    # Last heartbeat interval given to the CP (at boot or pushed)
+    heartbeat_interval = None
+
+    # Message id of the call being handled, to cache its CALLRESULT
+    _handled_call_id = None
+    _handled_call_result = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-    
-    # Periodically check for new reservation requests
-    async def _check_reservations(self, interval: int = 1):
-        while True:
-            # Get first reserve_now event
-            data = get_event('reserve_now', target=self.id, first_acceptable_id=self.last_reservation_id + 1)
-
-            # If event is there
-            if data is not None:
-                logging.info(f"Processing event reserve_now with data {data}")
-
-                event_id, token = data
-
-                # Send ReserveNow payload
-                if VERSION == "v2.0.1":
-                    await self.send_reserve_now(
-                        id=event_id,
-                        expiry_date_time=(datetime.utcnow() + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S") + "Z",
-                        id_token=token
-                    )
-                elif VERSION == "v2.0":
-                    await self.send_reserve_now(
-                        id=event_id,
-                        expiry_date_time=(datetime.utcnow() + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S") + "Z",
-                        id_token=token,
-                        evse_id={'id': 1}
-                    )
-                elif VERSION == 'v1.6':
-                    await self.send_reserve_now(
-                    id=event_id,
-                    expiry_date_time=(datetime.utcnow() + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S") + "Z",
-                    id_token=token["id_token"]
-                )
-
-                # Set new last reservation id to current id
-                self.last_reservation_id = event_id
-
-            # Wait for set time
-            await asyncio.sleep(interval)
+        self.SECURITY_PROFILE = _get_security_profile(self._connection.local_address[1])
+
+    def _record_call(self, direction: str, action: str, result: str, start: float):
+        labels = {'direction': direction, 'action': action, 'version': self._ocpp_version, 'security_profile': self.SECURITY_PROFILE}
+        metrics.registry.inc('ocpp_calls_total', **labels, result=result)
+        metrics.registry.observe('ocpp_call_duration_seconds', time.perf_counter() - start, **labels)
+
+    # Answer calls retransmitted by the CP (same message id) from the cache
+    # instead of running the handler again
+    async def _handle_call(self, msg):
+        with tracing.span(msg.action, 'handler', message_id=msg.unique_id, station=self.id):
+            start = time.perf_counter()
+            response = idempotency.get_cache(self.id).get(msg.unique_id)
+            if response is not None:
+                logging.info(f"Answering retransmitted {msg.action} {msg.unique_id} from {self.id} from cache")
+                await self._send(response)
+                self._record_call('in', msg.action, 'cached', start)
+                return
 
+            self._handled_call_id = msg.unique_id
+            self._handled_call_result = 'ok'
+            try:
+                return await super()._handle_call(msg)
+            except Exception:
+                self._handled_call_result = 'error'
+                raise
+            finally:
+                self._record_call('in', msg.action, self._handled_call_result, start)
+                self._handled_call_id = None
+
+    async def _send(self, message):
+        if self._handled_call_id is not None:
+            # Only the CALLRESULT of the handled call is cached, CALLERRORs are retried
+            if message.startswith(f'[3,{json.dumps(self._handled_call_id)},'):
+                idempotency.get_cache(self.id).put(self._handled_call_id, message)
+            elif message.startswith(f'[4,{json.dumps(self._handled_call_id)},'):
+                self._handled_call_result = 'error'
+        await super()._send(message)
+
+    # Calls to the CP, timed from sending until the answer (including the wait for the call lock)
+    async def call(self, payload, suppress=True, unique_id=None):
+        start = time.perf_counter()
+        action = payload.__class__.__name__[:-7]
+        unique_id = unique_id if unique_id is not None else str(self._unique_id_generator())
+        try:
+            with tracing.span(action, 'outbound_call', message_id=unique_id, station=self.id):
+                response = await super().call(payload, suppress, unique_id)
+        except asyncio.TimeoutError:
+            self._record_call('out', action, 'timeout', start)
+            raise
+        except Exception:
+            self._record_call('out', action, 'error', start)
+            raise
+        # A suppressed CALLERROR is returned as None
+        self._record_call('out', action, 'ok' if response is not None else 'error', start)
+        return response
+    
     async def _check_events(self, interval: int =1):
         while True:
             if self.csr_data != None:
@@ -588,6 +1246,24 @@ class ChargePointServerBase:
             final += f'{data[0][0]}: {response16.status}\n'
         return final
     
+    # Push a new heartbeat interval (adaptive heartbeat)
+    # The interval is only recorded once accepted, so a station that was not
+    # reached gets it again on the next adjustment
+    async def send_heartbeat_interval(self, interval: int) -> bool:
+        if self._ocpp_version == '1.6':
+            response = await self.call(call16.ChangeConfigurationPayload(key='HeartbeatInterval', value=str(interval)))
+            accepted = response != None and response.status == 'Accepted'
+        else:
+            data = [data201.SetVariableDataType(component={"name": "OCPPCommCtrlr"}, variable={"name": "HeartbeatInterval"}, attribute_value=str(interval))]
+            if self._ocpp_version == '2.0.1':
+                response = await self.call(call201.SetVariablesPayload(set_variable_data=data))
+            else:
+                response = await self.call(call20.SetVariablesPayload(set_variable_data=data))
+            accepted = response != None and response.set_variable_result[0]['attribute_status'] == 'Accepted'
+        if accepted:
+            self.heartbeat_interval = interval
+        return accepted
+
     async def send_reboot(
             self,
             version: str
@@ -667,23 +1343,7 @@ class ChargePointServerBase:
         custom_data: Optional[Dict[str, Any]] = None
     ):
 
-        port = self._connection.local_address[1] 
-        if port == PORT0:
-            self.SECURITY_PROFILE = 0
-        elif port == PORT1:
-            self.SECURITY_PROFILE = 1
-        elif port == PORT2:
-            self.SECURITY_PROFILE = 2
-        elif port == PORT3:
-            self.SECURITY_PROFILE = 3
-        elif port == PORT4:
-            self.SECURITY_PROFILE = 0
-        elif port == PORT5:
-            self.SECURITY_PROFILE = 1
-        elif port == PORT6:
-            self.SECURITY_PROFILE = 2
-        elif port == PORT7:
-            self.SECURITY_PROFILE = 3
+        self.SECURITY_PROFILE = _get_security_profile(self._connection.local_address[1])
 
         if VERSION == 'v1.6':
             logging.info(f"Got boot notification from {charge_point_serial_number} and security profile {self.SECURITY_PROFILE}")
@@ -697,27 +1357,42 @@ class ChargePointServerBase:
         else:
             self.is_booted = _check_charger(**charging_station)
 
+        lifecycle.record(self._connection, self.id, self.SECURITY_PROFILE, 'Accepted' if self.is_booted else 'Rejected')
+        station = self.chargePoint if VERSION == 'v1.6' else charging_station
+        event_bus.publish('boot_notification', self.id, {
+            'status': 'Accepted' if self.is_booted else 'Rejected', 'model': station.get('model'), 'vendor_name': station.get('vendor_name'),
+            'serial_number': station.get('serial_number'), 'version': VERSION, 'security_profile': self.SECURITY_PROFILE, 'reason': reason,
+        })
+
         if self.is_booted:
             self.serial_number = charge_point_serial_number if VERSION == 'v1.6' else charging_station['serial_number']
+            fleet_status.register_station(
+                self.id,
+                _get_site(self.serial_number),
+                charge_point_model if VERSION == 'v1.6' else charging_station['model'],
+                VERSION
+            )
+
+        self.heartbeat_interval = heartbeat_controller.interval
 
         if VERSION == 'v2.0.1':
             return call_result201.BootNotificationPayload(
                 current_time=_get_current_time(),
-                interval=HEARTBEAT_INTERVAL,
+                interval=self.heartbeat_interval,
                 status=('Accepted' if self.is_booted else 'Rejected')
             )
 
         elif VERSION == 'v2.0':
             return call_result20.BootNotificationPayload(
                 current_time=_get_current_time(),
-                interval=HEARTBEAT_INTERVAL,
+                interval=self.heartbeat_interval,
                 status=('Accepted' if self.is_booted else 'Rejected')
             )
         
         elif VERSION == 'v1.6':
             return call_result16.BootNotificationPayload(
                 current_time=_get_current_time(),
-                interval=HEARTBEAT_INTERVAL,
+                interval=self.heartbeat_interval,
                 status=('Accepted' if self.is_booted else 'Rejected')
             )
             
@@ -727,12 +1402,18 @@ class ChargePointServerBase:
         if not self.is_booted:
             # Force close websocket
             await self._connection.close()
+        else:
+            # Deliver the reservations made while the CP was offline
+            for reservation in reservation_engine.pending(self.id):
+                asyncio.create_task(_deliver_reservation(self, reservation))
 
     @on("Heartbeat")
     def on_heartbeat(
         self,
         custom_data: Optional[Dict[str, Any]] = None
     ):
+        fleet_status.touch(self.id)
+
         if VERSION == 'v2.0.1':
             return call_result201.HeartbeatPayload(
                 current_time=_get_current_time()
@@ -775,11 +1456,14 @@ class ChargePointServerBase:
         status: str = None,
         custom_data: Optional[Dict[str, Any]] = None
     ):
-        self.status = connector_status
-        if status:
-            logging.info(f'Connector: {connector_id} is {status}')
-        if error_code != 'NoError':
-            logging.error(f'Problem with connector: {connector_id} with error: {error_code}')
+        self.status = connector_status or status
+        fleet_status.touch(self.id)
+
+        # Acknowledged right away, consumers get the coalesced changes
+        status_coalescer.submit(
+            (self.id, evse_id or 0, connector_id or 0),
+            {'status': self.status, 'error_code': error_code, 'timestamp': timestamp}
+        )
 
         if VERSION == 'v2.0.1':
             return call_result201.StatusNotificationPayload()
@@ -789,29 +1473,52 @@ class ChargePointServerBase:
             return call_result16.StatusNotificationPayload()
 
 
-    @on("StartTransactionPayload")
-    def on_start_transaction(self, id_tag: str, meter_start: int, timestamp: str):
+    @on("StartTransaction")
+    def on_start_transaction(
+        self,
+        connector_id: int,
+        id_tag: str,
+        meter_start: int,
+        timestamp: str,
+        reservation_id: Optional[int] = None
+    ):
         logging.info(f"Starting transaction for ID tag {id_tag}")
 
         if not self.is_authorized:
             logging.error("User is not authorized to start transaction")
             return
 
-        transaction_counter += 1
+        self.transaction_counter += 1
         current_time = datetime.utcnow().strftime('%Y%m%d%H%M%S')
         transaction_id = f"{current_time}{self.transaction_counter:04}"
         transaction_id = int(transaction_id)
 
         self.current_transaction_id = transaction_id
 
+        # Record the transaction in the ledger
+        _record_transaction_event(transaction_id, self.id, 'Started', 0, timestamp, id_token=id_tag, meter=meter_start)
+
         return call_result16.StartTransactionPayload(
             transaction_id=transaction_id,
             id_tag_info=data16.IdTagInfo(status="Accepted")
         )
 
-    @on("StopTransactionPayload")
-    def on_stop_transaction(self, transaction_id: int, meter_stop: int, timestamp: str):
+    @on("StopTransaction")
+    def on_stop_transaction(
+        self,
+        transaction_id: int,
+        meter_stop: int,
+        timestamp: str,
+        id_tag: Optional[str] = None,
+        reason: Optional[str] = None,
+        transaction_data: Optional[List] = None
+    ):
         logging.info(f"Stopping transaction with ID {transaction_id}")
+        self.current_transaction_id = None
+
+        # Close the transaction in the ledger
+        _record_transaction_event(transaction_id, self.id, 'Ended', 1, timestamp, id_token=id_tag, meter=meter_stop)
+
         return call_result16.StopTransactionPayload(
            id_tag_info=data16.IdTagInfo(status="Accepted")
         )
@@ -836,6 +1543,19 @@ class ChargePointServerBase:
     ):
         logging.info(f"Got transaction event {event_type} because of {trigger_reason} with id {transaction_info['transaction_id']}")
 
+        # Record the event in the transaction ledger
+        _record_transaction_event(
+            transaction_info['transaction_id'],
+            self.id,
+            event_type,
+            seq_no,
+            timestamp,
+            id_token=id_token['id_token'] if id_token else None,
+            meter=_get_energy_register(meter_value)
+        )
+        meter_store.ingest(self.id, meter_value, transaction_info['transaction_id'])
+        self.current_transaction_id = None if event_type == 'Ended' else transaction_info['transaction_id']
+
         # When receiving an "Authorized" event
         if trigger_reason == "Authorized":
 
@@ -888,6 +1608,7 @@ class ChargePointServerBase:
 
             # Set correct charging state
             self.charging_state = transaction_info['charging_state']
+            fleet_status.update_charging_state(self.id, self.charging_state, evse['id'] if evse else None)
 
             # Get correct charging message
             if self.charging_state == "Charging":
@@ -919,6 +1640,25 @@ class ChargePointServerBase:
                 updated_personal_message=_get_personal_message("Not implemented")
             )
 
+    @on("MeterValues")
+    def on_meter_values(
+        self,
+        meter_value: List,
+        evse_id: Optional[int] = None,
+        connector_id: Optional[int] = None,
+        transaction_id: Optional[int] = None,
+        custom_data: Optional[Dict[str, Any]] = None
+    ):
+        # Samples outside a TransactionEvent belong to the ongoing transaction, if any
+        meter_store.ingest(self.id, meter_value, transaction_id if transaction_id != None else self.current_transaction_id)
+
+        if VERSION == 'v2.0.1':
+            return call_result201.MeterValuesPayload()
+        elif VERSION == 'v2.0':
+            return call_result20.MeterValuesPayload()
+        elif VERSION == 'v1.6':
+            return call_result16.MeterValuesPayload()
+
     @on('SignCertificate')
     async def on_sign_certificate(
             self,
@@ -960,43 +1700,64 @@ class ChargePointServerBase:
         custom_data: Optional[Dict[str, Any]] = None
     ):
         if VERSION == 'v2.0.1':
-            await self.call(call201.ReserveNowPayload(
+            return await self.call(call201.ReserveNowPayload(
                 id=id,
                 expiry_date_time=expiry_date_time,
                 id_token=id_token,
                 connector_type=connector_type,
-                evse_id=evse_id,
+                evse_id=evse_id or None,
                 group_id_token=group_id_token,
                 custom_data=custom_data
             ))
         elif VERSION == 'v2.0':
-             await self.call(call20.ReserveNowPayload(
+             return await self.call(call20.ReserveNowPayload(
                 id_token=id_token,
-                reservation = {"id": id, "expiry_date_time": expiry_date_time, "connector_code": connector_type, "evse": evse_id},
+                reservation = {"id": id, "expiry_date_time": expiry_date_time, "connector_code": connector_type, "evse": {'id': evse_id or 1}},
                 group_id_token=group_id_token
         ))
         elif VERSION == 'v1.6':
-            await self.call(call16.ReserveNowPayload( 
-                connector_id=1,
+            return await self.call(call16.ReserveNowPayload( 
+                connector_id=evse_id or 1,
                 expiry_date=expiry_date_time,
-                id_tag=id_token,
+                id_tag=id_token["id_token"],
                 reservation_id=id
             ))
 
+    async def send_cancel_reservation(
+        self,
+        reservation_id: int
+    ):
+        if VERSION == 'v2.0.1':
+            request = call201.CancelReservationPayload(reservation_id=reservation_id)
+        elif VERSION == 'v2.0':
+            request = call20.CancelReservationPayload(reservation_id=reservation_id)
+        elif VERSION == 'v1.6':
+            request = call16.CancelReservationPayload(reservation_id=reservation_id)
+
+        response = await self.call(request)
+
+        if response == None or response.status != "Accepted":
+            logging.error(f"Cancelling reservation {reservation_id} failed")
+            return False
+        else:
+            logging.info(f'Reservation {reservation_id} cancelled in {self.serial_number}')
+            return True
+
 # Factory function to create the correct subclass
+# (ChargePointServerBase goes first so it can hook into the message handling)
 def ChargePointServerFactory(version):
     if version == "v2.0.1":
-        class ChargePointServer(Cp201, ChargePointServerBase):
+        class ChargePointServer(ChargePointServerBase, Cp201):
             pass
         return ChargePointServer
 
     elif version == "v2.0":
-        class ChargePointServer(Cp20, ChargePointServerBase):
+        class ChargePointServer(ChargePointServerBase, Cp20):
             pass
         return ChargePointServer
     
     elif version == "v1.6":
-        class ChargePointServer(Cp16, ChargePointServerBase):
+        class ChargePointServer(ChargePointServerBase, Cp16):
             pass
         return ChargePointServer
 
@@ -1012,6 +1773,15 @@ def load_certificate(cert_path):
         raise ValueError("Certificate exceeds maximum allowed length (5500 characters).")
     return cert_data
 
+# Operator commands of the HTTP API served in this process, answered without the operator channel
+async def _api_operator(command: str):
+    messageParts = command.split(' ')
+    if messageParts[0] == 'fleet':
+        return fleet_status.summary(messageParts[1] if len(messageParts) > 1 else None)
+    if messageParts[0] == 'status':
+        return fleet_status.station(messageParts[1]) if len(messageParts) > 1 else None
+    raise ValueError(f'Unknown command {command}')
+
 async def on_operator(websocket, path):
     async for message in websocket:
         if message == "list":
@@ -1128,11 +1898,60 @@ async def on_operator(websocket, path):
                     break
             if not var:
                 await websocket.send(f"Charging station with ID :{serial} not found")
+        elif message.startswith("fleet"):
+            messageParts = message.split(' ')
+            dimension = messageParts[1] if len(messageParts) > 1 else None
+            await websocket.send(json.dumps(fleet_status.summary(dimension)))
+        elif message.startswith("status"):
+            messageParts = message.split(' ')
+            await websocket.send(json.dumps(fleet_status.station(messageParts[1]) if len(messageParts) > 1 else None))
+        elif message == "drain":
+            await websocket.send(await drain('operator'))
+        elif message == "reload":
+            await websocket.send(await reload_config('operator'))
+        elif message.startswith("loop"):
+            # Lag of the event loop and last slow callbacks, with the stack of the N most recent
+            messageParts = message.split(' ')
+            stacks = int(messageParts[1]) if len(messageParts) > 1 and messageParts[1].isdigit() else 5
+            await websocket.send(json.dumps(loop_monitor.summary(stacks)))
+        elif message.startswith("connections"):
+            # Phase timings per security profile and the N slowest connections
+            messageParts = message.split(' ')
+            n = int(messageParts[1]) if len(messageParts) > 1 and messageParts[1].isdigit() else 10
+            await websocket.send(json.dumps({'profiles': lifecycle.get_summary(), 'slowest': lifecycle.get_slowest(n)}))
+        elif message == "heartbeat":
+            # Adaptive heartbeat interval and stations not updated yet
+            pending = sum(cp.heartbeat_interval != heartbeat_controller.interval for cp in connected_index.values() if cp.is_booted)
+            await websocket.send(json.dumps({
+                'interval': heartbeat_controller.interval,
+                'stations': len(connected_index),
+                'pending': pending,
+                'loop_utilisation': round(heartbeat_controller.utilisation, 3),
+                'budget': heartbeat_controller.budget,
+            }))
+        elif message.startswith("profile"):
+            await websocket.send(await profiling.handle_command(message.split(' ')[1:]))
+        elif message == "cache":
+            await websocket.send(json.dumps(idempotency.get_stats()))
+        elif message.startswith("energy"):
+            messageParts = message.split(' ')
+            group = messageParts[1] if len(messageParts) > 1 else 'transaction'
+            if group == 'transaction':
+                energy = await asyncio.to_thread(meter_store.energy_per_transaction)
+            elif group == 'site':
+                energy = await asyncio.to_thread(meter_store.energy_per_site, _get_site)
+            elif group == 'hour':
+                energy = await asyncio.to_thread(meter_store.energy_per_hour)
+            else:
+                await websocket.send(f"Unknown energy grouping: {group}")
+                continue
+            await websocket.send(f"Energy (kWh): {json.dumps(energy)}")
         else:
             await websocket.send(f"Unknown order: {message}")
 
 async def on_connect(websocket, path):
     global VERSION
+    websocket.mark('opened')
     # Extract the SSL object to access certificate details
     ssl_object = websocket.transport.get_extra_info('ssl_object')
     if ssl_object:
@@ -1158,6 +1977,7 @@ async def on_connect(websocket, path):
                 print(f"Unauthorized client, closing connection.")
                 await websocket.close()
                 return
+    websocket.mark('cert_checked')
 
     try:
         requested_protocols = websocket.request_headers["Sec-WebSocket-Protocol"]
@@ -1181,11 +2001,17 @@ async def on_connect(websocket, path):
 
     # Get id from path
     charge_point_id = path.strip("/")
+
+    # Connections accepted before the listener was closed
+    if draining:
+        return await websocket.close(1012, 'Service restart')
     
     # Initialize CP
 
     ChargePointServer = ChargePointServerFactory(VERSION)
     cp = ChargePointServer(charge_point_id, websocket)
+    if charge_point_id in warm_states:
+        _restore_state(cp, warm_states.pop(charge_point_id))
     added = False
     # If only one CP per id is allowed, check it doesn't exist
     for cp_id, cp_ws, version in connected_clients:
@@ -1196,6 +2022,7 @@ async def on_connect(websocket, path):
             elif ALLOW_MULTIPLE_SERIAL_NUMBERS == 1:
                 logging.info(f'Client duplicated detected with ID {cp_id}')
                 connected_clients.append((charge_point_id, cp, VERSION))
+                connected_index[charge_point_id] = cp
                 added = True
                 break
             elif ALLOW_MULTIPLE_SERIAL_NUMBERS == 2:
@@ -1203,9 +2030,11 @@ async def on_connect(websocket, path):
                 connected_clients.remove((cp_id, cp_ws, version))
                 await cp_ws._connection.close()
                 connected_clients.append((charge_point_id, cp, VERSION))
+                connected_index[charge_point_id] = cp
                 added = True
     if not added:
         connected_clients.append((charge_point_id, cp, VERSION))
+        connected_index[charge_point_id] = cp
 
 
     if len(connected_clients) >= MAX_CONNECTED_CLIENTS:
@@ -1214,15 +2043,29 @@ async def on_connect(websocket, path):
 
     # Start and await for disconnection
     try:
-        await asyncio.gather(cp.start(), cp._check_reservations(), cp._check_events())
+        await asyncio.gather(cp.start(), cp._check_events())
     except websockets.exceptions.ConnectionClosed:
         logging.info(f"Client {charge_point_id} disconnected")
         if (charge_point_id, cp, VERSION) in connected_clients:
             # Remove from list of connected clients
             connected_clients.remove((charge_point_id, cp, VERSION))
+        if connected_index.get(charge_point_id) is cp:
+            del connected_index[charge_point_id]
+            fleet_status.set_offline(charge_point_id)
+            idempotency.release(charge_point_id)
     except Exception as e:
         print(e)
 
 
 if __name__ == "__main__":
+    configuration()
+
+    # Load config file
+    if not load_config():
+        quit(1)
+
+    # The event loop has to be chosen before it is started
+    use_event_loop(EVENT_LOOP)
+    use_storage(STORAGES[STORAGE]())
+    tracing.configure('server')
     asyncio.run(main())
\ No newline at end of file
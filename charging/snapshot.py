@@ -0,0 +1,57 @@
+import gzip
+import json
+import logging
+import os
+import time
+from typing import Dict
+
+SNAPSHOT_FILE = 'charging/station_snapshot.json.gz'
+
+# Snapshots older than this are not used for a warm start
+SNAPSHOT_MAX_AGE = 600
+
+# Per-station state kept across a restart, stored as one row per station
+FIELDS = ('serial_number', 'is_booted', 'is_authorized', 'charging_state', 'last_reservation_id', 'transaction_counter',
+          'current_transaction_id', 'model', 'version')
+
+
+def get_state(cp, fleet_meta: dict = None) -> dict:
+    state = {field: getattr(cp, field, None) for field in FIELDS}
+    if fleet_meta is not None:
+        state['model'] = fleet_meta['model']
+        state['version'] = fleet_meta['version']
+    return state
+
+
+# Write the state of every station as gzipped JSON rows. Write then rename,
+# so a snapshot is either complete or absent.
+def save_snapshot(states: Dict[str, dict], path: str = SNAPSHOT_FILE) -> int:
+    snapshot = {
+        'created': time.time(),
+        'fields': FIELDS,
+        'stations': {station: [state.get(field) for field in FIELDS] for station, state in states.items()},
+    }
+    with gzip.open(path + '.tmp', 'wt') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+    return len(states)
+
+
+# Read the snapshot and remove it, so it is used by a single warm start
+def load_snapshot(path: str = SNAPSHOT_FILE, max_age: float = SNAPSHOT_MAX_AGE) -> Dict[str, dict]:
+    try:
+        with gzip.open(path, 'rt') as f:
+            snapshot = json.load(f)
+        os.remove(path)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f'Ignoring unreadable snapshot {path}: {e}')
+        return {}
+
+    age = time.time() - snapshot['created']
+    if age > max_age:
+        logging.warning(f'Ignoring snapshot {path}, it is {age:.0f} s old')
+        return {}
+    fields = snapshot['fields']
+    return {station: dict(zip(fields, row)) for station, row in snapshot['stations'].items()}
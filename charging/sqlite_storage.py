@@ -0,0 +1,748 @@
+import collections
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from charging.storage import CREDENTIAL_GENERATORS, Storage
+
+# Write-behind batching: one commit per BATCH_MAX_SIZE statements or BATCH_MAX_DELAY_MS
+BATCH_MAX_SIZE = 500
+BATCH_MAX_DELAY_MS = 50
+
+# Stored in PRAGMA user_version once the migrations below are applied
+SCHEMA_VERSION = 1
+
+
+# Whether a unique index of a table covers exactly the given columns
+def _has_unique(conn: sqlite3.Connection, table: str, columns: set) -> bool:
+    for _, name, unique, *_ in conn.execute(f"PRAGMA index_list({table});").fetchall():
+        if unique and {row[2] for row in conn.execute(f"PRAGMA index_info({name});")} == columns:
+            return True
+    return False
+
+
+# Open a database and create the schema if it doesn't exist already
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys=ON;")
+    # WAL lets the batch writer commit while other connections keep reading
+    conn.execute("PRAGMA journal_mode=WAL;")
+    # 64 MB page cache, memory-mapped reads and in-memory sorts for the
+    # queries of large fleets
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+
+    # Events form a durable queue: consumers read the pending events of their
+    # types and ack them, so nothing is lost or replayed across restarts.
+    # Acked events are kept for history until the retention removes them.
+    conn.execute(
+        """
+CREATE TABLE IF NOT EXISTS Events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type VARCHAR(255) NOT NULL,
+    timestamp DATETIME NOT NULL DEFAULT current_timestamp,
+    target VARCHAR(255) NOT NULL DEFAULT '*',
+    data text NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    acked_at DATETIME
+);
+"""
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(Events);")]
+    if "status" not in columns:
+        # Databases of older versions, their events were purged at every
+        # start so they are considered consumed
+        conn.execute("ALTER TABLE Events ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'pending';")
+        conn.execute("ALTER TABLE Events ADD COLUMN acked_at DATETIME;")
+        conn.execute("UPDATE Events SET status='acked', acked_at=current_timestamp;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type_target ON Events (type, target, id);")
+    # Keyset pagination by type or by target
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type ON Events (type, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_target ON Events (target, id);")
+    # Partial indexes stay as small as the backlog (dequeue) and the history (retention)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_pending ON Events (type, id) WHERE status='pending';")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_acked ON Events (acked_at) WHERE status='acked';")
+
+    # Consumers resume from the status of the events, the offsets kept by
+    # earlier versions were never read
+    conn.execute("DROP TABLE IF EXISTS EventOffsets;")
+
+    # Number of changes (added, acked or deleted events) per target, '' for
+    # all the events. Bumped in the transactions changing the events, so the
+    # events version is a key lookup whatever the size of the table.
+    conn.execute(
+        """
+CREATE TABLE IF NOT EXISTS EventVersions (
+    target VARCHAR(255) PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+    )
+
+    conn.execute(
+        """
+CREATE TABLE IF NOT EXISTS Users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user VARCHAR(255) NOT NULL UNIQUE,
+    password VARCHAR(255)
+);
+"""
+    )
+
+    # One ledger row per transaction of a station: 1.6 transaction ids are
+    # only unique per station
+    transactions_table = """
+CREATE TABLE IF NOT EXISTS Transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id VARCHAR(255) NOT NULL,
+    station VARCHAR(255) NOT NULL,
+    id_token VARCHAR(255),
+    seq_no INTEGER NOT NULL DEFAULT 0,
+    meter_start REAL,
+    meter_stop REAL,
+    started_at DATETIME,
+    stopped_at DATETIME,
+    updated_at DATETIME NOT NULL DEFAULT current_timestamp,
+    UNIQUE (station, transaction_id)
+);
+"""
+    conn.execute(transactions_table)
+    schema_version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    if schema_version < 1 and not _has_unique(conn, "Transactions", {"station", "transaction_id"}):
+        # Ledgers of older versions, keyed by the transaction id alone
+        conn.execute("ALTER TABLE Transactions RENAME TO Transactions_old;")
+        conn.execute("DROP INDEX IF EXISTS idx_transactions_station;")
+        conn.execute("DROP INDEX IF EXISTS idx_transactions_token;")
+        conn.execute(transactions_table)
+        conn.execute("INSERT INTO Transactions SELECT * FROM Transactions_old;")
+        conn.execute("DROP TABLE Transactions_old;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_station ON Transactions (station, started_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_token ON Transactions (id_token, started_at);")
+
+    conn.execute(
+        """
+CREATE TABLE IF NOT EXISTS Reservations (
+    id INTEGER PRIMARY KEY,
+    station VARCHAR(255) NOT NULL,
+    evse_id INTEGER NOT NULL DEFAULT 0,
+    id_token VARCHAR(255) NOT NULL,
+    token_type VARCHAR(255) NOT NULL,
+    expiry DATETIME NOT NULL,
+    status VARCHAR(32) NOT NULL,
+    updated_at DATETIME NOT NULL DEFAULT current_timestamp
+);
+"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_station ON Reservations (station, evse_id, status);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_token ON Reservations (id_token, status);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_status ON Reservations (status, expiry);")
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+    conn.commit()
+    return conn
+
+
+class BatchWriter:
+    # Groups queued statements into a single transaction, committed from a
+    # background thread every `max_batch` statements or `max_delay_ms` ms.
+    # Each submit returns a Future resolved with the number of changed rows
+    # once committed (await it with asyncio.wrap_future), or failed with an
+    # AttributeError if the statement could not be applied.
+
+    def __init__(self, path: str, max_batch: int = BATCH_MAX_SIZE, max_delay_ms: int = BATCH_MAX_DELAY_MS):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, sql: str, params: tuple = ()) -> Future:
+        return self._put(sql, params, False)
+
+    # Same statement for each row of `rows`, applied in the same transaction
+    def submit_many(self, sql: str, rows: list) -> Future:
+        return self._put(sql, rows, True)
+
+    # Run function(conn) in the batch transaction, for writes depending on
+    # reads. The Future gets its return value. It may run twice if another
+    # statement of the batch fails, so it must only touch the database.
+    def submit_transaction(self, function: Callable[[sqlite3.Connection], Any]) -> Future:
+        return self._put(function, None, False)
+
+    def _put(self, sql: str, params, many: bool) -> Future:
+        self._start()
+        future = Future()
+        self._queue.put((sql, params, many, future))
+        return future
+
+    # Block until everything submitted so far is committed
+    def flush(self, timeout: float = None) -> bool:
+        if self._thread is None:
+            return True
+        done = Future()
+        self._queue.put((None, (), False, done))
+        try:
+            done.result(timeout)
+        except TimeoutError:
+            return False
+        return True
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-batch-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            # Collect until the batch is full, the delay expired or a flush was requested
+            while len(batch) < self.max_batch and batch[-1][0] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                # Never stop the writer, later writes and flushes would hang
+                logging.exception(f"Batch writer failed to commit {len(batch)} items")
+            finally:
+                for sql, _, _, done in batch:
+                    if sql is None:
+                        done.set_result(0)
+
+    @staticmethod
+    def _execute(conn: sqlite3.Connection, sql, params, many: bool):
+        if callable(sql):
+            return sql(conn)
+        if many:
+            return conn.executemany(sql, params).rowcount
+        return conn.execute(sql, params).rowcount
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        # Statements whose Future was cancelled are not applied, the others
+        # can not be cancelled any more
+        statements = [item for item in batch if item[0] is not None and item[3].set_running_or_notify_cancel()]
+        results = []
+        try:
+            with conn:
+                for sql, params, many, _ in statements:
+                    results.append(self._execute(conn, sql, params, many))
+            for (_, _, _, future), rowcount in zip(statements, results):
+                future.set_result(rowcount)
+        except Exception as e:
+            # Retry one by one so a single bad row or failing function does
+            # not drop the whole batch
+            logging.error(f"Batch of {len(statements)} statements failed ({e}), retrying individually")
+            for sql, params, many, future in statements:
+                try:
+                    with conn:
+                        future.set_result(self._execute(conn, sql, params, many))
+                except Exception as e:
+                    logging.error(f"Dropping statement {str(getattr(sql, '__name__', sql)).split('(')[0].strip()}: {e}")
+                    future.set_exception(AttributeError(e))
+
+
+_EVENT_INSERT = "INSERT INTO Events (type, target, data, status, acked_at) VALUES (?, ?, ?, ?, CASE WHEN ? = 'acked' THEN current_timestamp END);"
+
+
+def _event_row(event_type: str, target: str = "*", event_data=None, status: str = "pending") -> tuple:
+    return event_type, target, json.dumps(event_data if event_data is not None else {}), status, status
+
+
+# One more change of the events version for each of `targets` and for all the events
+def _bump_versions(conn: sqlite3.Connection, targets: list[str]):
+    counts = collections.Counter(targets)
+    counts[''] += len(targets)
+    conn.executemany(
+        "INSERT INTO EventVersions (target, version) VALUES (?, ?) ON CONFLICT(target) DO UPDATE SET version = version + excluded.version;",
+        counts.items(),
+    )
+
+
+def _insert_events(rows: list[tuple], conn: sqlite3.Connection) -> int:
+    count = conn.executemany(_EVENT_INSERT, rows).rowcount
+    _bump_versions(conn, [row[1] for row in rows])
+    return count
+
+
+def _ack_events(event_ids: list[int], conn: sqlite3.Connection) -> int:
+    count, targets = 0, []
+    for i in range(0, len(event_ids), 500):
+        chunk = event_ids[i:i + 500]
+        condition = "WHERE status='pending' and id IN (" + ", ".join("?" * len(chunk)) + ");"
+        targets += [row[0] for row in conn.execute("SELECT target FROM Events " + condition, chunk)]
+        count += conn.execute("UPDATE Events SET status='acked', acked_at=current_timestamp " + condition, chunk).rowcount
+    _bump_versions(conn, targets)
+    return count
+
+
+def _delete_events(events: list[tuple[int, str]], conn: sqlite3.Connection) -> int:
+    count = conn.execute(
+        "DELETE FROM Events WHERE id IN (" + ", ".join("?" * len(events)) + ");", [event_id for event_id, _ in events]
+    ).rowcount
+    _bump_versions(conn, [target for _, target in events])
+    return count
+
+
+def _provision(records: list[tuple], conn: sqlite3.Connection) -> dict[str, str | None]:
+    existing = {}
+    serials = [record[0] for record in records]
+    for i in range(0, len(serials), 500):
+        chunk = serials[i:i + 500]
+        existing.update(conn.execute(
+            "SELECT user, password FROM Users WHERE user IN (" + ", ".join("?" * len(chunk)) + ");", chunk
+        ).fetchall())
+
+    credentials = {}
+    for serial, password, *generate in records:
+        if generate and generate[0] is not None:
+            # Keep the credential generated by a previous run
+            password = existing.get(serial) or CREDENTIAL_GENERATORS[generate[0]]()
+        credentials[serial] = password
+
+    conn.executemany(
+        "INSERT INTO Users (user, password) VALUES (?, ?) ON CONFLICT(user) DO UPDATE SET password = excluded.password;",
+        list(credentials.items()),
+    )
+    return credentials
+
+
+def _reservation_to_dict(row: tuple) -> dict:
+    return {
+        "id": row[0],
+        "station": row[1],
+        "evse_id": row[2],
+        "id_token": {"id_token": row[3], "type": row[4]},
+        "expiry_date_time": row[5],
+        "status": row[6],
+    }
+
+
+class SQLiteStorage(Storage):
+    # Production backend: reads on a shared connection, writes grouped into
+    # transactions by a BatchWriter
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = connect(path)
+        self._writer = BatchWriter(path)
+
+    def flush(self, timeout: float = None) -> bool:
+        return self._writer.flush(timeout)
+
+    def purge_events(self):
+        # Delete all data
+        self._db.execute("UPDATE EventVersions SET version = version + 1;")
+        self._db.execute("DELETE FROM Events;")
+        self._db.execute("DELETE FROM sqlite_sequence WHERE name='Events';")
+        self._db.commit()
+
+    def add_event(self, event_type: str, target: str = "*", event_data=None, status: str = "pending") -> Future:
+        # Events consumed in-process when they are stored are added as 'acked'
+        rows = [_event_row(event_type, target, event_data, status)]
+        return self._writer.submit_transaction(lambda conn: _insert_events(rows, conn))
+
+    def add_events(self, events: list[tuple]) -> Future:
+        # Bulk add_event of (event_type, target, event_data[, status]) tuples, in one transaction
+        rows = [_event_row(*event) for event in events]
+        return self._writer.submit_transaction(lambda conn: _insert_events(rows, conn))
+
+    def add_user(self, user: str, password: str = None) -> Future:
+        # Fails with AttributeError if the user exists
+        return self._writer.submit("INSERT INTO Users (user, password) VALUES (?, ?);", (user, password))
+
+    def add_users(self, users: list[tuple[str, str]]) -> Future:
+        # Bulk add_user of (user, password) tuples in one transaction. Existing
+        # users are left unchanged, the Future gives the number of users added.
+        return self._writer.submit_many(
+            "INSERT INTO Users (user, password) VALUES (?, ?) ON CONFLICT(user) DO NOTHING;", [tuple(user) for user in users]
+        )
+
+    def chg_password(self, user: str, new_password: str) -> Future:
+        return self._writer.submit("UPDATE Users SET password=? WHERE user=?;", (new_password, user))
+
+    def remove_user(self, user: str) -> Future:
+        # The Future gives 0 if the user did not exist
+        return self._writer.submit("DELETE FROM Users WHERE user=?;", (user,))
+
+    def provision_users(self, records: list[tuple]) -> Future:
+        # Create or update the users of (serial, password[, generate]) records in
+        # one transaction. A password of None stores a user without password,
+        # generate 'key' or 'password' generates the credential unless the user
+        # already has one, so running it again gives the same credentials. The
+        # Future gives {serial: password}.
+        return self._writer.submit_transaction(lambda conn: _provision(records, conn))
+
+    def get_event(
+        self,
+        event_type: str, target: str = "*", first_acceptable_id: int = 1
+    ) -> tuple[int, dict[str, str]] | None:
+        cursor = self._db.cursor()
+
+        try:
+            # Get first un-executed event by event_type and target
+            raw_data = cursor.execute(
+                "SELECT id, data FROM Events WHERE type=? and target=? and id>=? ORDER BY id LIMIT 1;",
+                (event_type, target, first_acceptable_id),
+            ).fetchone()
+
+            # If no event are available return None
+            if raw_data is None:
+                return None
+
+            # Parse json and return it
+            return int(raw_data[0]), json.loads(raw_data[1])
+
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+    def get_events_after(self, last_id: int, event_types: tuple, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        cursor = self._db.cursor()
+        try:
+            # Get the next events of the given types for every target, in order
+            raw_data = cursor.execute(
+                "SELECT id, type, target, data FROM Events WHERE id>? and type IN ("
+                + ", ".join("?" * len(event_types))
+                + ") ORDER BY id LIMIT ?;",
+                (last_id, *event_types, limit),
+            ).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        return [(int(row[0]), row[1], row[2], json.loads(row[3])) for row in raw_data]
+
+    def get_pending_events(self, event_types: tuple, after_id: int = 0, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        cursor = self._db.cursor()
+        try:
+            # Next pending events of the given types, in order. Only the pending
+            # index is read, so the cost does not depend on the acked history.
+            raw_data = cursor.execute(
+                "SELECT id, type, target, data FROM Events WHERE status='pending' and id>? and type IN ("
+                + ", ".join("?" * len(event_types))
+                + ") ORDER BY id LIMIT ?;",
+                (after_id, *event_types, limit),
+            ).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        return [(int(row[0]), row[1], row[2], json.loads(row[3])) for row in raw_data]
+
+    def ack_events(self, event_ids: list[int]) -> Future:
+        # Mark the events consumed through the batch writer, the Future gives
+        # the number of events that were pending
+        return self._writer.submit_transaction(lambda conn: _ack_events(event_ids, conn))
+
+    def get_last_event_id(self) -> int:
+        try:
+            raw_data = self._db.execute("SELECT MAX(id) FROM Events;").fetchone()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+        return raw_data[0] or 0
+
+    def get_events_version(self, target: str = None) -> str:
+        # Last id and number of changes, both key lookups
+        condition, params = ("", ()) if target is None else (" WHERE target=?", (target,))
+        try:
+            last_id = self._db.execute("SELECT MAX(id) FROM Events" + condition + ";", params).fetchone()[0]
+            version = self._db.execute(
+                "SELECT version FROM EventVersions WHERE target=?;", ('' if target is None else target,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+        return f"{last_id or 0}-{version[0] if version is not None else 0}"
+
+    def compact_events(self, retention: int, pending_retention: int = 0, limit: int = 10000) -> tuple[int, int]:
+        # Delete up to `limit` events acked more than `retention` seconds ago and
+        # pending events older than `pending_retention` seconds (0 keeps them).
+        # Returns (acked, expired) counts. Call it repeatedly while it returns
+        # `limit` to remove a backlog without long write transactions.
+        cursor = self._db.cursor()
+        try:
+            acked = cursor.execute(
+                "SELECT id, target FROM Events WHERE status='acked' and acked_at < datetime('now', ?) ORDER BY acked_at LIMIT ?;",
+                (f"-{retention} seconds", limit),
+            ).fetchall()
+            expired = []
+            if pending_retention > 0 and len(acked) < limit:
+                expired = cursor.execute(
+                    "SELECT id, target FROM Events WHERE status='pending' and timestamp < datetime('now', ?) LIMIT ?;",
+                    (f"-{pending_retention} seconds", limit - len(acked)),
+                ).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        events = acked + expired
+        for i in range(0, len(events), 500):
+            chunk = events[i:i + 500]
+            self._writer.submit_transaction(lambda conn, chunk=chunk: _delete_events(chunk, conn))
+        return len(acked), len(expired)
+
+    # First event id stored at or after a timestamp ('YYYY-MM-DD HH:MM:SS' UTC).
+    # Ids grow with the timestamps, so a binary search over the ids finds it
+    # with a few primary key lookups and no index on the timestamps.
+    def _get_first_id_at(self, timestamp: str) -> int | None:
+        low, high = self._db.execute("SELECT MIN(id), MAX(id) FROM Events;").fetchone()
+        if low is None:
+            return None
+        # Smallest id from which the first existing event (ids have gaps after
+        # the retention) is not older than the timestamp
+        high += 1
+        while low < high:
+            middle = (low + high) // 2
+            event_id, event_timestamp = self._db.execute(
+                "SELECT id, timestamp FROM Events WHERE id >= ? ORDER BY id LIMIT 1;", (middle,)
+            ).fetchone()
+            if event_timestamp < timestamp:
+                low = event_id + 1
+            else:
+                high = middle
+        raw_data = self._db.execute("SELECT id FROM Events WHERE id >= ? ORDER BY id LIMIT 1;", (low,)).fetchone()
+        return raw_data[0] if raw_data is not None else None
+
+    def get_events_page(
+        self,
+        after_id: int = 0,
+        limit: int = 1000,
+        event_type: str = None,
+        target: str = None,
+        since: str = None,
+        until: str = None,
+        data: dict = None,
+    ) -> list[dict]:
+        # Events with an id above `after_id` matching the filters, in id order.
+        # Pass the id of the last event as `after_id` to get the next page: each
+        # page is an index range scan, however deep the client pages.
+        query = "SELECT id, type, timestamp, target, data, status FROM Events WHERE id>?"
+        params = [after_id]
+        try:
+            if since is not None:
+                first_id = self._get_first_id_at(since)
+                if first_id is None:
+                    return []
+                params[0] = max(after_id, first_id - 1)
+                query += " and timestamp>=?"
+                params.append(since)
+            if until is not None:
+                end_id = self._get_first_id_at(until)
+                if end_id is not None:
+                    query += " and id<?"
+                    params.append(end_id)
+                query += " and timestamp<?"
+                params.append(until)
+            if event_type is not None:
+                query += " and type=?"
+                params.append(event_type)
+            if target is not None:
+                query += " and target=?"
+                params.append(target)
+            if data is not None:
+                query += " and data=?"
+                params.append(json.dumps(data))
+            raw_data = self._db.execute(query + " ORDER BY id LIMIT ?;", (*params, limit)).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        return [
+            {"id": row[0], "type": row[1], "timestamp": row[2], "target": row[3], "data": json.loads(row[4]), "status": row[5]}
+            for row in raw_data
+        ]
+
+    def get_cps(self, target: str = "*", data: dict = {}) -> str:
+        cursor = self._db.cursor()
+        text_json = json.dumps(data).replace("%20", " ")
+        target = target.replace("%20", " ")
+        try:
+            # Get first un-executed event by event_type and target
+            raw_data = cursor.execute(
+                "SELECT user FROM Users;"
+            ).fetchall()
+
+            # If no event are available return None
+            if raw_data is None:
+                return None
+
+            # Parse json and return it
+            return str(raw_data)
+
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+    def auth_user(self, user: str, password: str) -> bool:
+        cursor = self._db.cursor()
+        try:
+            # Gets the password of the user if exists
+            raw_data = cursor.execute(
+                "SELECT * FROM Users WHERE user=? and password=?;", (user, password)
+            ).fetchone()
+
+            # If no event are available return None
+            if raw_data is None:
+                return False
+
+            # Parse json and return it
+            return True
+
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+    def check_user(self, user: str) -> str:
+        cursor = self._db.cursor()
+        try:
+            # Gets the password of the user if exists
+            raw_data = cursor.execute(
+                "SELECT user FROM Users WHERE user=?;", (user,)
+            ).fetchone()
+
+            # If no event are available return None
+            if raw_data is None:
+                return None
+
+            # Parse json and return it
+            return str(raw_data)
+
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+    def add_transaction_event(
+        self,
+        transaction_id: str,
+        station: str,
+        event_type: str,
+        seq_no: int = 0,
+        timestamp: str = None,
+        id_token: str = None,
+        meter: float = None,
+    ):
+        # Upsert the ledger row for the transaction through the batch writer.
+        # The first event seen sets the start data, 'Ended' sets the stop data.
+        ended = event_type == "Ended"
+        self._writer.submit(
+            """
+    INSERT INTO Transactions (transaction_id, station, id_token, seq_no, meter_start, meter_stop, started_at, stopped_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, current_timestamp)
+    ON CONFLICT(station, transaction_id) DO UPDATE SET
+        id_token = COALESCE(excluded.id_token, id_token),
+        seq_no = MAX(seq_no, excluded.seq_no),
+        meter_start = COALESCE(meter_start, excluded.meter_start),
+        meter_stop = COALESCE(excluded.meter_stop, meter_stop),
+        started_at = COALESCE(started_at, excluded.started_at),
+        stopped_at = COALESCE(excluded.stopped_at, stopped_at),
+        updated_at = current_timestamp;
+    """,
+            (
+                str(transaction_id),
+                station,
+                id_token,
+                seq_no,
+                meter,
+                meter if ended else None,
+                timestamp,
+                timestamp if ended else None,
+            ),
+        )
+
+    def get_transactions(self, station: str = None, id_token: str = None, limit: int = 100) -> list[dict]:
+        cursor = self._db.cursor()
+        query = "SELECT transaction_id, station, id_token, seq_no, meter_start, meter_stop, started_at, stopped_at FROM Transactions"
+        conditions, params = [], []
+        if station is not None:
+            conditions.append("station=?")
+            params.append(station)
+        if id_token is not None:
+            conditions.append("id_token=?")
+            params.append(id_token)
+        if conditions:
+            query += " WHERE " + " and ".join(conditions)
+        try:
+            raw_data = cursor.execute(query + " ORDER BY started_at DESC LIMIT ?;", (*params, limit)).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        columns = ("transaction_id", "station", "id_token", "seq_no", "meter_start", "meter_stop", "started_at", "stopped_at")
+        return [dict(zip(columns, row)) for row in raw_data]
+
+    def save_reservation(
+        self,
+        reservation_id: int,
+        station: str,
+        evse_id: int,
+        id_token: str,
+        token_type: str,
+        expiry: str,
+        status: str,
+    ):
+        self._writer.submit(
+            """
+    INSERT INTO Reservations (id, station, evse_id, id_token, token_type, expiry, status, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, current_timestamp)
+    ON CONFLICT(id) DO UPDATE SET
+        expiry = excluded.expiry,
+        status = excluded.status,
+        updated_at = current_timestamp;
+    """,
+            (reservation_id, station, evse_id, id_token, token_type, expiry, status),
+        )
+
+    def get_reservations(
+        self,
+        station: str = None, id_token: str = None, status: str = None, limit: int = 100
+    ) -> list[dict]:
+        cursor = self._db.cursor()
+        query = "SELECT id, station, evse_id, id_token, token_type, expiry, status FROM Reservations"
+        conditions, params = [], []
+        if station is not None:
+            conditions.append("station=?")
+            params.append(station)
+        if id_token is not None:
+            conditions.append("id_token=?")
+            params.append(id_token)
+        if status is not None:
+            conditions.append("status=?")
+            params.append(status)
+        if conditions:
+            query += " WHERE " + " and ".join(conditions)
+        try:
+            raw_data = cursor.execute(query + " ORDER BY id DESC LIMIT ?;", (*params, limit)).fetchall()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        return [_reservation_to_dict(row) for row in raw_data]
+
+    def get_reservation(self, reservation_id: int) -> dict | None:
+        cursor = self._db.cursor()
+        try:
+            raw_data = cursor.execute(
+                "SELECT id, station, evse_id, id_token, token_type, expiry, status FROM Reservations WHERE id=?;",
+                (reservation_id,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+
+        if raw_data is None:
+            return None
+        return _reservation_to_dict(raw_data)
+
+    def get_max_reservation_id(self) -> int:
+        try:
+            raw_data = self._db.execute("SELECT MAX(id) FROM Reservations;").fetchone()
+        except sqlite3.Error as e:
+            raise AttributeError(e)
+        return raw_data[0] or 0
+
@@ -0,0 +1,464 @@
+import abc
+import heapq
+import itertools
+import json
+import secrets
+import string
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future
+from typing import Any, Callable
+
+
+# Credential of the 1.6 security profiles (AuthorizationKey, hex)
+def generate_random_key(min_bytes=16, max_bytes=20):
+    num_bytes = secrets.choice(range(min_bytes, max_bytes + 1))
+    return secrets.token_bytes(num_bytes).hex()
+
+
+# Credential of the 2.x security profiles (BasicAuthPassword)
+def generate_random_password(min_chars=16, max_chars=40):
+    allowed_chars = string.ascii_letters + string.digits + "*-_=|@."
+    password_length = secrets.choice(range(min_chars, max_chars + 1))
+    return ''.join(secrets.choice(allowed_chars) for _ in range(password_length))
+
+
+CREDENTIAL_GENERATORS = {'key': generate_random_key, 'password': generate_random_password}
+
+
+class Storage(abc.ABC):
+    # Interface of the storage backends behind charging.db: events (a queue
+    # with acks and retention), users, the transaction ledger and
+    # reservations. Backends must implement every method. Writes return a Future resolved with the
+    # number of changed rows once the write is durable for the backend, or
+    # failed with an AttributeError. Reads raise AttributeError on storage
+    # errors. Timestamps are 'YYYY-MM-DD HH:MM:SS' UTC strings.
+
+    @abc.abstractmethod
+    def flush(self, timeout: float = None) -> bool:
+        raise NotImplementedError
+
+    # Events
+
+    @abc.abstractmethod
+    def purge_events(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_event(self, event_type: str, target: str = "*", event_data=None, status: str = "pending") -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_events(self, events: list[tuple]) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_event(self, event_type: str, target: str = "*", first_acceptable_id: int = 1) -> tuple[int, dict[str, str]] | None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_events_after(self, last_id: int, event_types: tuple, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_pending_events(self, event_types: tuple, after_id: int = 0, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack_events(self, event_ids: list[int]) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_last_event_id(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_events_version(self, target: str = None) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def compact_events(self, retention: int, pending_retention: int = 0, limit: int = 10000) -> tuple[int, int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_events_page(self, after_id: int = 0, limit: int = 1000, event_type: str = None, target: str = None,
+                        since: str = None, until: str = None, data: dict = None) -> list[dict]:
+        raise NotImplementedError
+
+    # Users
+
+    @abc.abstractmethod
+    def add_user(self, user: str, password: str = None) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_users(self, users: list[tuple[str, str]]) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def chg_password(self, user: str, new_password: str) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_user(self, user: str) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def provision_users(self, records: list[tuple]) -> Future:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_cps(self, target: str = "*", data: dict = {}) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def auth_user(self, user: str, password: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def check_user(self, user: str) -> str:
+        raise NotImplementedError
+
+    # Transactions
+
+    @abc.abstractmethod
+    def add_transaction_event(self, transaction_id: str, station: str, event_type: str, seq_no: int = 0,
+                              timestamp: str = None, id_token: str = None, meter: float = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_transactions(self, station: str = None, id_token: str = None, limit: int = 100) -> list[dict]:
+        raise NotImplementedError
+
+    # Reservations
+
+    @abc.abstractmethod
+    def save_reservation(self, reservation_id: int, station: str, evse_id: int, id_token: str, token_type: str,
+                         expiry: str, status: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_reservations(self, station: str = None, id_token: str = None, status: str = None, limit: int = 100) -> list[dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_reservation(self, reservation_id: int) -> dict | None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_max_reservation_id(self) -> int:
+        raise NotImplementedError
+
+
+def _now(seconds_ago: float = 0) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - seconds_ago))
+
+
+def _done(value: Any = None) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+# SQLite LIMIT semantics: a negative limit means no limit
+def _limit(rows, limit: int) -> list:
+    return list(rows) if limit < 0 else list(itertools.islice(rows, limit))
+
+
+class MemoryStorage(Storage):
+    # Backend keeping everything in dicts, for tests and simulations that
+    # should not touch the disk. Nothing survives the process. Writes are
+    # applied at once and return completed Futures.
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._events = {}
+        self._next_event_id = 1
+        # Ids in order, per type and per (type, target), and the pending and
+        # acked ids in the order they reached that status
+        self._ids = []
+        self._ids_by_type = {}
+        self._ids_by_target = {}
+        self._ids_by_type_target = {}
+        self._pending_by_type = {}
+        self._acked = {}
+        # Number of changes per target, None for all the events
+        self._versions = {}
+        self._users = {}
+        self._transactions = {}
+        self._reservations = {}
+
+    def flush(self, timeout: float = None) -> bool:
+        return True
+
+    def _run(self, function: Callable[[], Any]) -> Future:
+        try:
+            with self._lock:
+                return _done(function())
+        except AttributeError as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    # Events
+
+    def _index_event(self, event: dict):
+        event_id = event['id']
+        self._ids.append(event_id)
+        self._ids_by_type.setdefault(event['type'], []).append(event_id)
+        self._ids_by_target.setdefault(event['target'], []).append(event_id)
+        self._ids_by_type_target.setdefault((event['type'], event['target']), []).append(event_id)
+        if event['status'] == 'pending':
+            self._pending_by_type.setdefault(event['type'], {})[event_id] = None
+        else:
+            self._acked[event_id] = None
+
+    def _rebuild_indexes(self):
+        self._ids, self._ids_by_type, self._ids_by_target, self._ids_by_type_target = [], {}, {}, {}
+        self._pending_by_type, acked = {}, self._acked
+        self._acked = {}
+        for event in self._events.values():
+            self._index_event(event)
+        # Keep the ack order for the retention
+        self._acked = {event_id: None for event_id in acked if event_id in self._events}
+
+    def _bump_version(self, target: str):
+        self._versions[target] = self._versions.get(target, 0) + 1
+        self._versions[None] = self._versions.get(None, 0) + 1
+
+    def _insert_event(self, event_type: str, target: str = "*", event_data=None, status: str = "pending"):
+        now = _now()
+        event = {
+            'id': self._next_event_id, 'type': event_type, 'timestamp': now, 'target': target,
+            'data': json.dumps(event_data if event_data is not None else {}), 'status': status,
+            'acked_at': now if status == 'acked' else None,
+        }
+        self._next_event_id += 1
+        self._events[event['id']] = event
+        self._index_event(event)
+        self._bump_version(target)
+
+    def purge_events(self):
+        with self._lock:
+            for event in self._events.values():
+                self._bump_version(event['target'])
+            self._events = {}
+            self._next_event_id = 1
+            self._rebuild_indexes()
+
+    def add_event(self, event_type: str, target: str = "*", event_data=None, status: str = "pending") -> Future:
+        return self._run(lambda: self._insert_event(event_type, target, event_data, status) or 1)
+
+    def add_events(self, events: list[tuple]) -> Future:
+        def insert():
+            for event in events:
+                self._insert_event(*event)
+            return len(events)
+        return self._run(insert)
+
+    def get_event(self, event_type: str, target: str = "*", first_acceptable_id: int = 1) -> tuple[int, dict[str, str]] | None:
+        with self._lock:
+            ids = self._ids_by_type_target.get((event_type, target), [])
+            index = bisect_left(ids, first_acceptable_id)
+            if index == len(ids):
+                return None
+            event = self._events[ids[index]]
+            return event['id'], json.loads(event['data'])
+
+    def _as_tuple(self, event_id: int) -> tuple[int, str, str, dict]:
+        event = self._events[event_id]
+        return event_id, event['type'], event['target'], json.loads(event['data'])
+
+    def get_events_after(self, last_id: int, event_types: tuple, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        with self._lock:
+            lists = [self._ids_by_type.get(event_type, []) for event_type in event_types]
+            ids = heapq.merge(*(ids[bisect_right(ids, last_id):] for ids in lists))
+            return [self._as_tuple(event_id) for event_id in _limit(ids, limit)]
+
+    def get_pending_events(self, event_types: tuple, after_id: int = 0, limit: int = 1000) -> list[tuple[int, str, str, dict]]:
+        with self._lock:
+            pending = [(event_id for event_id in self._pending_by_type.get(event_type, {}) if event_id > after_id)
+                       for event_type in event_types]
+            return [self._as_tuple(event_id) for event_id in _limit(heapq.merge(*pending), limit)]
+
+    def ack_events(self, event_ids: list[int]) -> Future:
+        def ack():
+            now = _now()
+            count = 0
+            for event_id in event_ids:
+                event = self._events.get(event_id)
+                if event is not None and event['status'] == 'pending':
+                    event['status'], event['acked_at'] = 'acked', now
+                    del self._pending_by_type[event['type']][event_id]
+                    self._acked[event_id] = None
+                    self._bump_version(event['target'])
+                    count += 1
+            return count
+        return self._run(ack)
+
+    def get_last_event_id(self) -> int:
+        with self._lock:
+            return self._ids[-1] if self._ids else 0
+
+    def get_events_version(self, target: str = None) -> str:
+        with self._lock:
+            ids = self._ids if target is None else self._ids_by_target.get(target, [])
+            return f"{ids[-1] if ids else 0}-{self._versions.get(target, 0)}"
+
+    def compact_events(self, retention: int, pending_retention: int = 0, limit: int = 10000) -> tuple[int, int]:
+        with self._lock:
+            cutoff = _now(retention)
+            acked = list(itertools.islice(
+                itertools.takewhile(lambda event_id: self._events[event_id]['acked_at'] < cutoff, self._acked), limit
+            ))
+            expired = []
+            if pending_retention > 0 and len(acked) < limit:
+                cutoff = _now(pending_retention)
+                pending = heapq.merge(*self._pending_by_type.values())
+                expired = list(itertools.islice(
+                    itertools.takewhile(lambda event_id: self._events[event_id]['timestamp'] < cutoff, pending), limit - len(acked)
+                ))
+            for event_id in acked + expired:
+                self._bump_version(self._events.pop(event_id)['target'])
+            if acked or expired:
+                self._rebuild_indexes()
+            return len(acked), len(expired)
+
+    def get_events_page(self, after_id: int = 0, limit: int = 1000, event_type: str = None, target: str = None,
+                        since: str = None, until: str = None, data: dict = None) -> list[dict]:
+        with self._lock:
+            if event_type is not None and target is not None:
+                ids = self._ids_by_type_target.get((event_type, target), [])
+            elif event_type is not None:
+                ids = self._ids_by_type.get(event_type, [])
+            elif target is not None:
+                ids = self._ids_by_target.get(target, [])
+            else:
+                ids = self._ids
+            # Ids grow with the timestamps
+            start = bisect_right(ids, after_id)
+            if since is not None:
+                start = max(start, bisect_left(ids, since, key=lambda event_id: self._events[event_id]['timestamp']))
+            end = len(ids) if until is None else bisect_left(ids, until, key=lambda event_id: self._events[event_id]['timestamp'])
+            text = json.dumps(data) if data is not None else None
+
+            page = []
+            for event_id in itertools.islice(ids, start, end):
+                event = self._events[event_id]
+                if text is not None and event['data'] != text:
+                    continue
+                page.append({key: json.loads(value) if key == 'data' else value for key, value in event.items() if key != 'acked_at'})
+                if len(page) == limit:
+                    break
+            return page
+
+    # Users
+
+    def _insert_user(self, user: str, password: str = None):
+        if user in self._users:
+            raise AttributeError('UNIQUE constraint failed: Users.user')
+        self._users[user] = password
+        return 1
+
+    def add_user(self, user: str, password: str = None) -> Future:
+        return self._run(lambda: self._insert_user(user, password))
+
+    def add_users(self, users: list[tuple[str, str]]) -> Future:
+        def insert():
+            added = {user: password for user, password in reversed(users) if user not in self._users}
+            self._users.update(added)
+            return len(added)
+        return self._run(insert)
+
+    def chg_password(self, user: str, new_password: str) -> Future:
+        def update():
+            if user not in self._users:
+                return 0
+            self._users[user] = new_password
+            return 1
+        return self._run(update)
+
+    def remove_user(self, user: str) -> Future:
+        return self._run(lambda: 1 if self._users.pop(user, False) is not False else 0)
+
+    def provision_users(self, records: list[tuple]) -> Future:
+        def provision():
+            credentials = {}
+            for serial, password, *generate in records:
+                if generate and generate[0] is not None:
+                    password = self._users.get(serial) or CREDENTIAL_GENERATORS[generate[0]]()
+                credentials[serial] = password
+            self._users.update(credentials)
+            return credentials
+        return self._run(provision)
+
+    def get_cps(self, target: str = "*", data: dict = {}) -> str:
+        with self._lock:
+            return str([(user,) for user in self._users])
+
+    def auth_user(self, user: str, password: str) -> bool:
+        with self._lock:
+            return user in self._users and password is not None and self._users[user] == password
+
+    def check_user(self, user: str) -> str:
+        with self._lock:
+            return str((user,)) if user in self._users else None
+
+    # Transactions
+
+    def add_transaction_event(self, transaction_id: str, station: str, event_type: str, seq_no: int = 0,
+                              timestamp: str = None, id_token: str = None, meter: float = None):
+        # Same merge as the SQLite upsert: the first event sets the start
+        # data, 'Ended' sets the stop data
+        ended = event_type == "Ended"
+        with self._lock:
+            row = self._transactions.setdefault((station, str(transaction_id)), {
+                'transaction_id': str(transaction_id), 'station': station, 'id_token': None, 'seq_no': seq_no,
+                'meter_start': None, 'meter_stop': None, 'started_at': None, 'stopped_at': None,
+            })
+            row['id_token'] = id_token if id_token is not None else row['id_token']
+            row['seq_no'] = max(row['seq_no'], seq_no)
+            row['meter_start'] = row['meter_start'] if row['meter_start'] is not None else meter
+            row['meter_stop'] = meter if ended and meter is not None else row['meter_stop']
+            row['started_at'] = row['started_at'] if row['started_at'] is not None else timestamp
+            row['stopped_at'] = timestamp if ended and timestamp is not None else row['stopped_at']
+
+    def get_transactions(self, station: str = None, id_token: str = None, limit: int = 100) -> list[dict]:
+        with self._lock:
+            rows = [dict(row) for row in self._transactions.values()
+                    if (station is None or row['station'] == station) and (id_token is None or row['id_token'] == id_token)]
+        # SQLite sorts NULL last in descending order
+        rows.sort(key=lambda row: (row['started_at'] is not None, row['started_at'] or ''), reverse=True)
+        return _limit(rows, limit)
+
+    # Reservations
+
+    def save_reservation(self, reservation_id: int, station: str, evse_id: int, id_token: str, token_type: str,
+                         expiry: str, status: str):
+        with self._lock:
+            row = self._reservations.get(reservation_id)
+            if row is None:
+                self._reservations[reservation_id] = {
+                    'id': reservation_id, 'station': station, 'evse_id': evse_id,
+                    'id_token': {'id_token': id_token, 'type': token_type}, 'expiry_date_time': expiry, 'status': status,
+                }
+            else:
+                row['expiry_date_time'], row['status'] = expiry, status
+
+    def get_reservations(self, station: str = None, id_token: str = None, status: str = None, limit: int = 100) -> list[dict]:
+        with self._lock:
+            rows = (row for _, row in sorted(self._reservations.items(), reverse=True)
+                    if (station is None or row['station'] == station)
+                    and (id_token is None or row['id_token']['id_token'] == id_token)
+                    and (status is None or row['status'] == status))
+            return [{**row, 'id_token': dict(row['id_token'])} for row in _limit(rows, limit)]
+
+    def get_reservation(self, reservation_id: int) -> dict | None:
+        with self._lock:
+            row = self._reservations.get(reservation_id)
+            return {**row, 'id_token': dict(row['id_token'])} if row is not None else None
+
+    def get_max_reservation_id(self) -> int:
+        with self._lock:
+            return max(self._reservations, default=0)
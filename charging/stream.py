@@ -0,0 +1,195 @@
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional
+
+from charging.db import get_events_after, get_events_page, get_last_event_id
+
+# Station events published to the stream subscribers
+STREAM_TYPES = ('boot_notification', 'status_notification', 'transaction_event', 'reservation_status')
+# Events a subscriber may have waiting before it is switched to catch-up
+QUEUE_SIZE = 1000
+# Events read per query
+PAGE_SIZE = 1000
+
+
+# Stream event, with its JSON text encoded once for all the subscribers
+class StreamEvent:
+    __slots__ = ('id', 'type', 'station', 'data', 'json')
+
+    def __init__(self, event_id: int, event_type: str, station: str, data: dict):
+        self.id = event_id
+        self.type = event_type
+        self.station = station
+        self.data = data
+        self.json = json.dumps({'id': event_id, 'type': event_type, 'station': station, 'data': data})
+
+
+class Subscription:
+    # Live events of one stream client, filtered by type, station and site.
+    # While the client keeps up it gets the events from its bounded queue.
+    # When the queue is full (slow client) or the client resumes from an old
+    # id, it is `lagging` and reads the events it missed from the database
+    # itself, until it reaches the stream again.
+
+    def __init__(self, stream: 'EventStream', types: tuple, station: str = None, site: str = None, after_id: int = None):
+        self.stream = stream
+        self.types = types
+        self.station = station
+        self.site = site
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        # Events up to this id were sent to the client or do not match
+        self.cursor = stream.last_id if after_id is None else after_id
+        self.lagging = after_id is not None and after_id < stream.last_id
+
+    def matches(self, event: StreamEvent) -> bool:
+        return (event.type in self.types
+                and (self.station is None or event.station == self.station)
+                and (self.site is None or self.stream.site(event.station) == self.site))
+
+    # Next events to send, None after `timeout` seconds without any
+    async def get(self, timeout: float) -> Optional[List[StreamEvent]]:
+        while True:
+            if self.lagging and self.queue.empty():
+                events = await self._catch_up()
+                if events:
+                    return events
+                continue
+            events = []
+            if self.queue.empty():
+                try:
+                    events.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except TimeoutError:
+                    return None
+            while not self.queue.empty():
+                events.append(self.queue.get_nowait())
+            # Skip the ones already sent while catching up
+            events = [event for event in events if event.id > self.cursor]
+            if events:
+                self.cursor = events[-1].id
+                return events
+
+    # Matching events after the cursor, read from the database. Only the
+    # events the stream has passed are taken, it delivers the next ones once
+    # the subscription is back on it.
+    async def _catch_up(self) -> List[StreamEvent]:
+        # Committed, so the read below sees every event up to it
+        committed_id = self.stream.last_id
+        if self.station is not None:
+            rows = await asyncio.to_thread(get_events_page, self.cursor, PAGE_SIZE, target=self.station)
+            scanned = [(row['id'], row['type'], row['target'], row['data']) for row in rows]
+        else:
+            scanned = await asyncio.to_thread(get_events_after, self.cursor, self.types, PAGE_SIZE)
+
+        stream_id = self.stream.last_id
+        passed = [row for row in scanned if row[0] <= stream_id]
+        if len(passed) < len(scanned):
+            # The read went past the stream
+            self.cursor = stream_id
+        elif len(scanned) < PAGE_SIZE:
+            # End of the table when read
+            self.cursor = max(self.cursor, committed_id, passed[-1][0] if passed else 0)
+        else:
+            self.cursor = passed[-1][0]
+        if self.cursor >= stream_id:
+            self.lagging = False
+        events = (StreamEvent(*row) for row in passed)
+        return [event for event in events if self.matches(event)]
+
+    def close(self):
+        self.stream.unsubscribe(self)
+
+
+class EventStream:
+    # Fan-out of the station events to the stream clients. A single reader
+    # follows the events table and hands each new event to the queues of the
+    # matching subscriptions, so the database is read once however many
+    # clients are attached. It is woken up by notify() once events are
+    # committed, and reads every `poll_interval` seconds for the events
+    # written by other processes.
+    #
+    # Sites are matched by serial number (`site_of`) while events carry the
+    # station ID, so the serial number of each station is taken from its
+    # boot notifications.
+
+    def __init__(self, site_of: Callable[[str], str] = lambda serial_number: None, poll_interval: float = 1, types: tuple = STREAM_TYPES):
+        self.site_of = site_of
+        self.serial_numbers: Dict[str, str] = {}
+        self.poll_interval = poll_interval
+        self.types = types
+        self.last_id = 0
+        self._subscriptions: List[Subscription] = []
+        self._wakeup = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._notified = False
+
+    def site(self, station: str) -> str:
+        return self.site_of(self.serial_numbers.get(station, station))
+
+    def _learn(self, event_type: str, station: str, data):
+        if event_type == 'boot_notification' and isinstance(data, dict) and isinstance(data.get('serial_number'), str):
+            self.serial_numbers[station] = data['serial_number']
+
+    # Serial numbers of the stations booted after an event id
+    async def _load_serial_numbers(self, after_id: int):
+        while True:
+            page = await asyncio.to_thread(get_events_page, after_id, PAGE_SIZE, event_type='boot_notification')
+            for row in page:
+                self._learn(row['type'], row['target'], row['data'])
+            if len(page) < PAGE_SIZE:
+                return
+            after_id = page[-1]['id']
+
+    def subscribe(self, types: tuple = None, station: str = None, site: str = None, after_id: int = None) -> Subscription:
+        subscription = Subscription(self, tuple(types or self.types), station, site, after_id)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    # Wake the reader up, from any thread (the batch writer calls it on commit)
+    def notify(self):
+        if self._loop is None or self._notified:
+            return
+        self._notified = True
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _publish(self, event: StreamEvent):
+        for subscription in self._subscriptions:
+            if subscription.lagging or not subscription.matches(event):
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.lagging = True
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self.last_id = await asyncio.to_thread(get_last_event_id)
+        await self._load_serial_numbers(0)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._notified = False
+
+            # Nobody to send them to, only keep the position (and the serial numbers)
+            if not self._subscriptions:
+                last_id = await asyncio.to_thread(get_last_event_id)
+                await self._load_serial_numbers(self.last_id)
+                if not self._subscriptions:
+                    self.last_id = last_id
+                continue
+
+            while True:
+                rows = await asyncio.to_thread(get_events_after, self.last_id, self.types, PAGE_SIZE)
+                for row in rows:
+                    self._learn(*row[1:])
+                    self._publish(StreamEvent(*row))
+                if rows:
+                    self.last_id = rows[-1][0]
+                if len(rows) < PAGE_SIZE:
+                    break
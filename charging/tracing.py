@@ -0,0 +1,158 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict, List
+
+TRACE_DIR = 'charging/traces'
+
+# Share of the OCPP messages traced, 0 disables tracing. Client and server
+# make the same decision for a message id, so sampled traces are complete.
+SAMPLE_RATE = 0.0
+
+# Size a trace file is rotated at, and rotated files kept
+MAX_BYTES = 50_000_000
+BACKUP_COUNT = 3
+
+# (message id, track) of the call being traced in the current task
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def is_sampled(key: str) -> bool:
+    return SAMPLE_RATE > 0 and zlib.crc32(str(key).encode()) < SAMPLE_RATE * 2 ** 32
+
+
+class TraceWriter:
+    # Buffers complete events and appends them every second, from a thread, to
+    # a file in the Chrome trace JSON array format (chrome://tracing, Perfetto,
+    # speedscope). Each station gets its own track.
+
+    def __init__(self, name: str):
+        self.name = name
+        self._events: List[dict] = []
+        self._tracks: Dict[str, int] = {}
+        self._named = set()
+        # add() takes _lock from the event loop, so it only guards the buffer;
+        # the file is written under _flush_lock
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(TRACE_DIR, f'{self.name}-{os.getpid()}.json')
+
+    def add(self, name: str, category: str, start_ns: int, duration_ns: int, track: str, args: dict):
+        with self._lock:
+            tid = self._tracks.setdefault(track, len(self._tracks) + 1)
+            self._events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'ts': start_ns // 1000, 'dur': duration_ns // 1000,
+                'pid': os.getpid(), 'tid': tid, 'args': args,
+            })
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(1)
+            self.flush()
+
+    # Names of the process (once per file) and of the tracks not named in the file yet
+    def _metadata(self, new_file: bool, tracks: Dict[str, int]) -> List[dict]:
+        pid = os.getpid()
+        metadata = []
+        if new_file:
+            self._named = set()
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': self.name}})
+        for track, tid in tracks.items():
+            if track not in self._named:
+                self._named.add(track)
+                metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': track}})
+        return metadata
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                tracks = dict(self._tracks)
+            if not events:
+                return
+            try:
+                os.makedirs(TRACE_DIR, exist_ok=True)
+                path = self.path
+                if os.path.exists(path) and os.path.getsize(path) >= MAX_BYTES:
+                    for i in range(BACKUP_COUNT - 1, 0, -1):
+                        if os.path.exists(f'{path}.{i}'):
+                            os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+                    os.replace(path, f'{path}.1')
+                new_file = not os.path.exists(path)
+                # The closing bracket of the array is optional in this format,
+                # so every flush can just append
+                with open(path, 'a') as f:
+                    if new_file:
+                        f.write('[\n')
+                    for event in self._metadata(new_file, tracks) + events:
+                        f.write(json.dumps(event, separators=(',', ':'), default=str) + ',\n')
+            except OSError as e:
+                logging.error(f'Failed to write trace events: {e}')
+
+
+_writer = TraceWriter('trace')
+atexit.register(_writer.flush)
+
+
+# Name the trace file of this process and set the sampling rate
+def configure(name: str, sample_rate: float = None):
+    global SAMPLE_RATE
+    _writer.name = name
+    if sample_rate is not None:
+        SAMPLE_RATE = sample_rate
+
+
+# Span of a block. With a message id it starts a trace (if sampled), without
+# it is a child of the trace of the current task, if any. Spans are shown on
+# the track of their station.
+@contextmanager
+def span(name: str, category: str, message_id: str = None, station: str = None, **args):
+    current = _current.get()
+    if message_id is not None:
+        current = (message_id, station or threading.current_thread().name)
+    if current is None or not is_sampled(current[0]):
+        yield
+        return
+
+    token = _current.set(current)
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        _writer.add(name, category, start, time.time_ns() - start, current[1], {'message_id': current[0], **args})
+
+
+# Span of something that already happened, traced with its own key (e.g. the station of a connection)
+def record(name: str, category: str, trace_id: str, seconds_ago: float, duration: float, station: str = None, **args):
+    if not is_sampled(trace_id):
+        return
+    start = time.time_ns() - int(seconds_ago * 1e9)
+    _writer.add(name, category, start, int(duration * 1e9), station or threading.current_thread().name, {'trace_id': trace_id, **args})
+
+
+# Decorator adding a span to every call made inside a trace
+def traced(category: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return function(*args, **kwargs)
+            with span(function.__name__, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator